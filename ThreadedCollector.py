@@ -46,12 +46,12 @@ from tweepy.streaming import StreamListener, Stream
 from tweepy.error import TweepError
 from tweepy import OAuthHandler
 from tweepy.api import API
-from pymongo import MongoClient
 
 import httplib
 from socket import timeout
 import ssl
 import threading
+import signal
 import os.path
 import json
 import ConfigParser
@@ -62,25 +62,31 @@ import time
 from time import sleep
 import traceback
 import sys
+import stageprofiler
+import mongoclient
+import jobmanifest
+import freshness
+from stageprofiler import timer
 
 # Config file includes paths, parameters, and oauth information for this module
 # Complete the directions in "example_platform.ini" for configuration before proceeding
 
 PLATFORM_CONFIG_FILE = 'platform.ini'
 
-# Connect to Mongo
-connection = MongoClient()
-db = connection.config
-mongo_config = db.config
+# Mongo, connected on first use (see mongoclient.py)
+connection = mongoclient.client
+mongo_config = mongoclient.config_collection
 
 # Program thread
 e = threading.Event()
+# Set by SIGTERM (e.g. from supervisor.py): stop like run=0, without changing the flags
+stopping = threading.Event()
 
 class fileOutListener(StreamListener):
     """ This listener handles tweets as they come in by converting them
     to JSON and sending them to a file. Each line in the file is a tweet.
     """
-    def __init__(self, tweetsOutFilePath, tweetsOutFileDateFrmt, tweetsOutFile, logger, collection_type, db_name):
+    def __init__(self, tweetsOutFilePath, tweetsOutFileDateFrmt, tweetsOutFile, logger, collection_type, db_name, profiler=None, manifest=None, freshness=None):
         self.logger = logger
         self.logger.info('COLLECTION LISTENER: Initializing Stream Listener...')
         self.buffer = ''
@@ -105,13 +111,39 @@ class fileOutListener(StreamListener):
         self.delete_db = connection[self.delete_db]
         self.delete_tweets = self.delete_db['tweets']
 
+        # Optional StageProfiler; its breakdown is logged each time the output file rolls over
+        self.profiler = profiler
+        self.profiledFileName = self.tweetsOutFileName
+
+        # Optional JobManifest; a file is recorded as sealed once the next one of its kind is started
+        self.manifest = manifest
+        self.open_files = {}
+
+        # Optional FreshnessTracker; the lag of the tweets written to each file is published when it rolls over
+        self.freshness = freshness
+        self.freshnessFileName = self.tweetsOutFileName
+
+    # Records the file of this kind written to before JSONfileName as sealed in the job manifest
+    def seal_previous(self, kind, JSONfileName):
+        previous = self.open_files.get(kind)
+        self.open_files[kind] = JSONfileName
+        if self.manifest and previous and os.path.isfile(previous):
+            try:
+                self.manifest.add('raw', previous, 'sealed')
+            except Exception, exception:
+                # the processors' rescan of the directory will find it
+                self.logger.warning('COLLECTION LISTENER: could not record %s in the job manifest: %s' % (previous, exception))
 
     def on_data(self, data):
         self.buffer += data
 
         if data.endswith('\r\n') and self.buffer.strip():
+            prof = self.profiler.sample() if self.profiler else None
+            if prof: stage_t = timer()
+
             # complete message received so convert to JSON and proceed
             message = json.loads(self.buffer)
+            if prof: stage_t = prof.add('loads', stage_t)
             self.buffer = ''
             msg = ''
             # Rate limiting logging
@@ -148,6 +180,8 @@ class fileOutListener(StreamListener):
 
                 timestr = time.strftime(self.tweetsOutFileDateFrmt)
                 JSONfileName = self.tweetsOutFilePath + timestr + '-delete-' + self.tweetsOutFile
+                if self.open_files.get('delete') != JSONfileName:
+                    self.seal_previous('delete', JSONfileName)
                 if not os.path.isfile(JSONfileName):
                     self.logger.info('Creating new file: %s' % JSONfileName)
                 myFile = open(JSONfileName,'a')
@@ -164,12 +198,24 @@ class fileOutListener(StreamListener):
                 timestr = time.strftime(self.tweetsOutFileDateFrmt)
                 # this creates the filename. If the file exists, it just adds to it, otherwise it creates it
                 JSONfileName = self.tweetsOutFilePath + timestr + '-' + self.collection_type + '-' + self.tweetsOutFile
+                if self.open_files.get('tweets') != JSONfileName:
+                    self.seal_previous('tweets', JSONfileName)
                 if not os.path.isfile(JSONfileName):
                     self.logger.info('Creating new file: %s' % JSONfileName)
+                    if self.profiler:
+                        self.profiler.report(self.logger, self.profiledFileName)
+                        self.profiledFileName = JSONfileName
+                    if self.freshness:
+                        self.freshness.file_done(self.freshnessFileName)
+                        self.freshnessFileName = JSONfileName
                 myFile = open(JSONfileName,'a')
                 myFile.write(json.dumps(message).encode('utf-8'))
                 myFile.write('\n')
                 myFile.close()
+                if prof: stage_t = prof.add('write', stage_t)
+                if self.freshness:
+                    self.freshness.record(message)
+                    if prof: prof.add('freshness', stage_t)
                 return True
 
     # Twitter's http error codes are listed here:
@@ -357,6 +403,9 @@ if __name__ == "__main__":
 
     Config = ConfigParser.ConfigParser()
     Config.read(PLATFORM_CONFIG_FILE)
+    mongoclient.configure(Config)
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
 
     # Grabs logging director info & creates if doesn't exist
     logDir = Config.get('files', 'log_dir', 0)
@@ -448,7 +497,7 @@ if __name__ == "__main__":
         exception = None
         try:
             mongoConfigs = mongo_config.find_one({"module" : config_name})
-            runCollector = mongoConfigs['run']
+            runCollector = mongoConfigs['run'] and not stopping.is_set()
             collectSignal = mongoConfigs['collect']
             updateSignal = mongoConfigs['update']
         except Exception, exception:
@@ -472,8 +521,9 @@ if __name__ == "__main__":
             # Entire process trigerred to stop
             if not runCollector:
                 logger.info('MAIN: received EXIT signal. Attempting to stop collection thread')
-                mongo_config.update({"module" : config_name}, {'$set' : {'collect': 0}})
-                mongo_config.update({"module" : config_name}, {'$set' : {'update': 0}})
+                if not stopping.is_set():
+                    mongo_config.update({"module" : config_name}, {'$set' : {'collect': 0}})
+                    mongo_config.update({"module" : config_name}, {'$set' : {'update': 0}})
                 collectSignal = 0
 
             # Send stream disconnect signal, kills thread
@@ -625,7 +675,10 @@ if __name__ == "__main__":
 
             print 'COLLECTION THREAD: Initializing Tweepy listener instance...'
             logger.info('COLLECTION THREAD: Initializing Tweepy listener instance...')
-            l = fileOutListener(tweetsOutFilePath, tweetsOutFileDateFrmt, tweetsOutFile, logger, collection_type, db_name)
+            l = fileOutListener(tweetsOutFilePath, tweetsOutFileDateFrmt, tweetsOutFile, logger, collection_type, db_name,
+                profiler=stageprofiler.profiler_from_config(Config, config_name),
+                manifest=jobmanifest.manifest_from_config(Config, logger),
+                freshness=freshness.tracker_from_config(Config, 'collector', logger))
 
             print 'TOOLKIT STREAM: Initializing Tweepy stream listener...'
             logger.info('TOOLKIT STREAM: Initializing Tweepy stream listener...')
@@ -0,0 +1,404 @@
+#-------------------------------------------------------------------------------
+# Name:        Archive compactor.
+# Purpose:     Merges a day's raw and processed files in tweet_archive_dir
+#              into compressed segment files with an index by tweet id and
+#              hour, and applies the retention policy to old segments.
+#
+# Each day and kind (raw or _processed) becomes segment_dir/<YYYYMMDD>-<kind>-<n>:
+#   .seg.gz    the lines of every file of the day, in blocks of about block_bytes,
+#              each block its own gzip member: zcat still reads the whole segment,
+#              and a single block can be read without the rest. A block never
+#              spans two source files
+#   .idx       (tweet id, block, offset in block) records sorted by id, 16 bytes
+#              each; delete notices are indexed by the deleted status id
+#   .json      the source files (name, lines, bytes, blocks), the offset and
+#              length of every block and the blocks holding each hour
+# A day is compacted once it is compact_after_days old, no raw file of it is
+# left to process and none of its files changed for settle_seconds. The
+# source files are removed once the segment is written. Files that arrive for
+# a day after it was compacted go into its next segment.
+#
+# Retention (0 keeps forever): raw segments older than raw_tier_days move to
+# tier_dir (cheaper storage), raw segments older than raw_retention_days and
+# processed segments older than processed_retention_days are removed.
+#
+#   python archivecompactor.py run                  compact and apply retention every interval_seconds
+#   python archivecompactor.py compact              compact every settled day once
+#   python archivecompactor.py retention            apply the retention policy once
+#   python archivecompactor.py list                 the segments, with their size and tweets
+#   python archivecompactor.py get <tweet id>       the archived lines of a tweet
+#   python archivecompactor.py hour <YYYYmmddHH> [raw | processed]   the lines of an hour
+#-------------------------------------------------------------------------------
+
+import os
+import sys
+import glob
+import time
+import zlib
+import mmap
+import struct
+import shutil
+import signal
+import logging
+import threading
+import ConfigParser
+from datetime import datetime, timedelta
+
+import simplejson
+import platformconfig
+import tweetprocessing
+
+PLATFORM_CONFIG_FILE = 'platform.ini'
+KINDS = ['raw', 'processed']
+COMPACT_AFTER_DAYS = 1
+SETTLE_SECONDS = 600
+BLOCK_BYTES = 1024 * 1024
+COMPRESS_LEVEL = 6
+INTERVAL_SECONDS = 3600
+SEGMENT_EXTENSION = '.seg.gz'
+INDEX_EXTENSION = '.idx'
+META_EXTENSION = '.json'
+INDEX_RECORD = struct.Struct('<qII')
+
+logger = logging.getLogger('archive_compactor')
+
+
+class ArchiveSettings(object):
+    def __init__(self, Config):
+        self.archive_dir = Config.get('files', 'tweet_archive_dir', 0)
+        self.raw_dir = Config.get('files', 'raw_tweets_file_path', 0)
+        self.date_format = Config.get('files', 'tweets_file_date_frmt', 0)
+        self.tweets_file = Config.get('files', 'tweets_file', 0)
+        self.segment_dir = platformconfig.get_option(Config, 'archive', 'segment_dir', os.path.join(self.archive_dir, 'segments'))
+        self.tier_dir = platformconfig.get_option(Config, 'archive', 'tier_dir')
+        self.compact_after_days = platformconfig.get_int_option(Config, 'archive', 'compact_after_days', COMPACT_AFTER_DAYS)
+        self.settle_seconds = platformconfig.get_int_option(Config, 'archive', 'settle_seconds', SETTLE_SECONDS)
+        self.block_bytes = platformconfig.get_int_option(Config, 'archive', 'block_bytes', BLOCK_BYTES)
+        self.compress_level = platformconfig.get_int_option(Config, 'archive', 'compress_level', COMPRESS_LEVEL)
+        self.raw_tier_days = platformconfig.get_int_option(Config, 'archive', 'raw_tier_days', 0)
+        self.raw_retention_days = platformconfig.get_int_option(Config, 'archive', 'raw_retention_days', 0)
+        self.processed_retention_days = platformconfig.get_int_option(Config, 'archive', 'processed_retention_days', 0)
+        self.interval_seconds = platformconfig.get_int_option(Config, 'archive', 'interval_seconds', INTERVAL_SECONDS)
+
+    def segment_dirs(self):
+        return [directory for directory in [self.segment_dir, self.tier_dir] if directory]
+
+# The date in the tweets_file_date_frmt prefix of an archived file name, or None
+def archive_file_date(name, date_format):
+    try:
+        return datetime.strptime(os.path.basename(name)[:len(time.strftime(date_format))], date_format)
+    except ValueError:
+        return None
+
+def file_kind(name):
+    return 'processed' if os.path.splitext(name)[0].endswith('_processed') else 'raw'
+
+# {(YYYYMMDD, kind): [files]} of the files in the archive directory
+def archived_days(settings):
+    stem, extension = os.path.splitext(settings.tweets_file)
+    days = {}
+    for archive_file in sorted(glob.glob(os.path.join(settings.archive_dir, '*'))):
+        name = os.path.basename(archive_file)
+        if not name.endswith(settings.tweets_file) and not name.endswith(stem + '_processed' + extension):
+            continue
+        file_date = archive_file_date(name, settings.date_format)
+        if file_date is None:
+            continue
+        days.setdefault((file_date.strftime('%Y%m%d'), file_kind(name)), []).append(archive_file)
+    return days
+
+# A day is settled once it is old enough, the processor has nothing left of it and
+# none of its files is still being written.
+def day_settled(settings, day, files, now):
+    if datetime.strptime(day, '%Y%m%d') > datetime.fromtimestamp(now) - timedelta(days=settings.compact_after_days + 1):
+        return False
+    for raw_file in glob.glob(os.path.join(settings.raw_dir, '*')):
+        file_date = archive_file_date(raw_file, settings.date_format)
+        if file_date is not None and file_date.strftime('%Y%m%d') == day:
+            return False
+    return all(now - os.path.getmtime(archive_file) >= settings.settle_seconds for archive_file in files)
+
+def segment_base(directory, day, kind, number):
+    return os.path.join(directory, '%s-%s-%d' % (day, kind, number))
+
+def segment_day(path):
+    return os.path.basename(path).split('-')[0]
+
+def segment_kind(path):
+    return os.path.basename(path).split('-')[1]
+
+def list_segments(settings, kind=None):
+    segments = []
+    for directory in settings.segment_dirs():
+        segments.extend(glob.glob(os.path.join(directory, '*-%s-*%s' % (kind or '*', SEGMENT_EXTENSION))))
+    return sorted(segments, key=lambda path: (segment_day(path), os.path.basename(path)))
+
+def next_segment_base(settings, day, kind):
+    number = 1
+    while any(os.path.exists(segment_base(directory, day, kind, number) + SEGMENT_EXTENSION) for directory in settings.segment_dirs()):
+        number += 1
+    return segment_base(settings.segment_dir, day, kind, number)
+
+# (tweet id, YYYYmmddHH or None) of an archived line, or None for lines that are
+# not tweets or delete notices
+def line_key(line):
+    try:
+        message = simplejson.loads(line)
+        if 'delete' in message:
+            return message['delete']['status']['id'], None
+        if 'created_ts' in message:
+            return message['id'], message['created_ts'][:13].replace('-', '').replace(' ', '')
+        return message['id'], tweetprocessing.to_datetime(message['created_at']).strftime('%Y%m%d%H')
+    except (ValueError, TypeError, KeyError, AttributeError):
+        return None
+
+def write_file(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+class SegmentWriter(object):
+    """ Writes one segment under temporary names; commit() renames the index, the
+        metadata and then the segment into place.
+    """
+    def __init__(self, base, block_bytes, compress_level):
+        self.base = base
+        self.block_bytes = block_bytes
+        self.compress_level = compress_level
+        self.out = open(base + SEGMENT_EXTENSION + '.tmp', 'wb')
+        self.sources = []
+        self.blocks = []
+        self.hours = {}
+        self.index = []
+        self.block_lines = []
+        self.block_size = 0
+
+    def add_file(self, path):
+        source = {'name': os.path.basename(path), 'lines': 0, 'bytes': os.path.getsize(path), 'first_block': len(self.blocks)}
+        self.sources.append(source)
+        with open(path, 'rb') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    line += '\n'
+                key = line_key(line)
+                if key is not None:
+                    tweet_id, hour = key
+                    self.index.append((tweet_id, len(self.blocks), self.block_size))
+                    if hour is not None:
+                        blocks = self.hours.setdefault(hour, [])
+                        if not blocks or blocks[-1] != len(self.blocks):
+                            blocks.append(len(self.blocks))
+                self.block_lines.append(line)
+                self.block_size += len(line)
+                source['lines'] += 1
+                if self.block_size >= self.block_bytes:
+                    self.flush_block()
+        self.flush_block()
+        source['blocks'] = len(self.blocks) - source['first_block']
+
+    def flush_block(self):
+        if not self.block_lines:
+            return
+        compressor = zlib.compressobj(self.compress_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        data = compressor.compress(''.join(self.block_lines)) + compressor.flush()
+        self.blocks.append([self.out.tell(), len(data), len(self.sources) - 1, len(self.block_lines)])
+        self.out.write(data)
+        self.block_lines = []
+        self.block_size = 0
+
+    def commit(self):
+        self.flush_block()
+        self.out.flush()
+        os.fsync(self.out.fileno())
+        self.out.close()
+        self.index.sort()
+        write_file(self.base + INDEX_EXTENSION + '.tmp', ''.join(INDEX_RECORD.pack(*record) for record in self.index))
+        write_file(self.base + META_EXTENSION + '.tmp', simplejson.dumps({'sources': self.sources, 'blocks': self.blocks,
+            'hours': self.hours, 'indexed': len(self.index), 'created': time.strftime('%Y-%m-%d %H:%M:%S')}))
+        for extension in [INDEX_EXTENSION, META_EXTENSION, SEGMENT_EXTENSION]:
+            os.rename(self.base + extension + '.tmp', self.base + extension)
+        return self.base + SEGMENT_EXTENSION
+
+
+class Segment(object):
+    """ Reads a segment:
+            segment = Segment(path)
+            segment.get(tweet_id)        the lines of a tweet (or its delete notice)
+            segment.hour('2014082713')   the lines of an hour
+            segment.lines(source_name)   every line, or those of one source file
+    """
+    def __init__(self, path):
+        self.path = path
+        self.base = path[:-len(SEGMENT_EXTENSION)]
+        with open(self.base + META_EXTENSION) as f:
+            self.meta = simplejson.load(f)
+        self.day = segment_day(path)
+        self.kind = segment_kind(path)
+
+    def block(self, number):
+        offset, length = self.meta['blocks'][number][:2]
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+        return zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(data)
+
+    def lookup(self, tweet_id):
+        locations = []
+        size = os.path.getsize(self.base + INDEX_EXTENSION)
+        if not size:
+            return locations
+        with open(self.base + INDEX_EXTENSION, 'rb') as f:
+            index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            low, high = 0, size / INDEX_RECORD.size
+            while low < high:
+                middle = (low + high) / 2
+                if INDEX_RECORD.unpack_from(index, middle * INDEX_RECORD.size)[0] < tweet_id:
+                    low = middle + 1
+                else:
+                    high = middle
+            while low * INDEX_RECORD.size < size:
+                record = INDEX_RECORD.unpack_from(index, low * INDEX_RECORD.size)
+                if record[0] != tweet_id:
+                    break
+                locations.append(record[1:])
+                low += 1
+        finally:
+            index.close()
+        return locations
+
+    def get(self, tweet_id):
+        lines = []
+        blocks = {}
+        for block_number, offset in self.lookup(tweet_id):
+            if block_number not in blocks:
+                blocks[block_number] = self.block(block_number)
+            data = blocks[block_number]
+            lines.append(data[offset:data.index('\n', offset) + 1])
+        return lines
+
+    def hour(self, hour):
+        for block_number in self.meta['hours'].get(hour, []):
+            for line in self.block(block_number).splitlines(True):
+                key = line_key(line)
+                if key is not None and key[1] == hour:
+                    yield line
+
+    def lines(self, source_name=None):
+        for number, block in enumerate(self.meta['blocks']):
+            if source_name is None or self.meta['sources'][block[2]]['name'] == source_name:
+                for line in self.block(number).splitlines(True):
+                    yield line
+
+# Writes the segment of one day and kind and removes its source files.
+def compact_day(settings, day, kind, files, logger):
+    if not os.path.exists(settings.segment_dir):
+        os.makedirs(settings.segment_dir)
+    start = time.time()
+    writer = SegmentWriter(next_segment_base(settings, day, kind), settings.block_bytes, settings.compress_level)
+    for archive_file in files:
+        writer.add_file(archive_file)
+    segment = writer.commit()
+    for archive_file in files:
+        os.remove(archive_file)
+    source_bytes = sum(source['bytes'] for source in writer.sources)
+    logger.info('Compacted %d %s files of %s (%.1f MB) into %s (%.1f MB, %d blocks, %d indexed) in %.1fs' % (len(files), kind, day,
+        source_bytes / 1048576.0, segment, os.path.getsize(segment) / 1048576.0, len(writer.blocks), len(writer.index), time.time() - start))
+    return segment
+
+def compact(settings, logger, now=None):
+    now = now or time.time()
+    segments = []
+    for (day, kind), files in sorted(archived_days(settings).items()):
+        if day_settled(settings, day, files, now):
+            segments.append(compact_day(settings, day, kind, files, logger))
+    return segments
+
+def segment_files(segment):
+    base = segment[:-len(SEGMENT_EXTENSION)]
+    return [base + extension for extension in [SEGMENT_EXTENSION, INDEX_EXTENSION, META_EXTENSION]]
+
+def retention(settings, logger, now=None):
+    today = datetime.fromtimestamp(now or time.time())
+    removed = 0
+    tiered = 0
+    for segment in list_segments(settings):
+        age = (today - datetime.strptime(segment_day(segment), '%Y%m%d')).days
+        kind = segment_kind(segment)
+        retention_days = settings.raw_retention_days if kind == 'raw' else settings.processed_retention_days
+        if retention_days and age > retention_days:
+            for path in segment_files(segment):
+                os.remove(path)
+            logger.info('Removed %s, %d days old' % (segment, age))
+            removed += 1
+        elif kind == 'raw' and settings.tier_dir and settings.raw_tier_days and age > settings.raw_tier_days \
+                and os.path.dirname(os.path.abspath(segment)) != os.path.abspath(settings.tier_dir):
+            if not os.path.exists(settings.tier_dir):
+                os.makedirs(settings.tier_dir)
+            # the segment goes last so a half moved one is not listed
+            for path in reversed(segment_files(segment)):
+                shutil.move(path, os.path.join(settings.tier_dir, os.path.basename(path)))
+            logger.info('Moved %s to %s, %d days old' % (segment, settings.tier_dir, age))
+            tiered += 1
+    return removed, tiered
+
+def run(settings, logger, stopping):
+    while not stopping.is_set():
+        try:
+            compact(settings, logger)
+            retention(settings, logger)
+        except (IOError, OSError), e:
+            logger.warning('Archive compaction failed, trying again in %ds: %s' % (settings.interval_seconds, e))
+        stopping.wait(settings.interval_seconds)
+
+
+if __name__ == '__main__':
+
+    commands = ['run', 'compact', 'retention', 'list', 'get', 'hour']
+    if len(sys.argv) < 2 or sys.argv[1] not in commands or (sys.argv[1] in ('get', 'hour') and len(sys.argv) < 3) \
+            or (sys.argv[1] == 'hour' and len(sys.argv) > 3 and sys.argv[3] not in KINDS):
+        print "To run: python archivecompactor.py run | compact | retention | list"
+        print "        python archivecompactor.py get <tweet id>"
+        print "        python archivecompactor.py hour <YYYYmmddHH> [raw | processed]"
+        sys.exit()
+
+    Config = ConfigParser.ConfigParser()
+    Config.read(PLATFORM_CONFIG_FILE)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s', datefmt='%m-%d %H:%M')
+    logger = logging.getLogger('archive_compactor')
+
+    settings = ArchiveSettings(Config)
+    command = sys.argv[1]
+
+    if command == 'run':
+        stopping = threading.Event()
+        signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+        logger.info('Compacting %s into %s every %ds' % (settings.archive_dir, settings.segment_dir, settings.interval_seconds))
+        try:
+            run(settings, logger, stopping)
+        except KeyboardInterrupt:
+            pass
+    elif command == 'compact':
+        print 'Wrote %d segments' % len(compact(settings, logger))
+    elif command == 'retention':
+        print 'Removed %d segments, moved %d to the tier directory' % retention(settings, logger)
+    elif command == 'list':
+        print '%-40s %8s %10s %10s %10s' % ('segment', 'files', 'indexed', 'MB in', 'MB')
+        for segment in list_segments(settings):
+            meta = Segment(segment).meta
+            print '%-40s %8d %10d %10.1f %10.1f' % (os.path.basename(segment), len(meta['sources']), meta['indexed'],
+                sum(source['bytes'] for source in meta['sources']) / 1048576.0, os.path.getsize(segment) / 1048576.0)
+    elif command == 'get':
+        tweet_id = int(sys.argv[2])
+        for segment in list_segments(settings):
+            for line in Segment(segment).get(tweet_id):
+                sys.stdout.write(line)
+    elif command == 'hour':
+        kind = sys.argv[3] if len(sys.argv) > 3 else 'processed'
+        for segment in list_segments(settings, kind):
+            if segment_day(segment) == sys.argv[2][:8]:
+                for line in Segment(segment).hour(sys.argv[2]):
+                    sys.stdout.write(line)
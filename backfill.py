@@ -0,0 +1,233 @@
+#-------------------------------------------------------------------------------
+# Name:        Archive backfill.
+# Purpose:     Reruns the raw tweet files of a date range in tweet_archive_dir
+#              through enrich_tweet with a (new) terms list, on a pool of
+#              processes, after collection.terms or process_tweet changed.
+#
+#   python backfill.py updates <start> <end> [terms file] [workers]
+#       writes the recomputed derived fields (hashtags, codes, mentions,
+#       track_kw, counts, text_hash) of every tweet as field update files,
+#       <raw name minus extension>-update-<tweets_file>_processed, to the
+#       insert queue. mongoBatchInsert.py sets them on the stored tweets
+#   python backfill.py processed <start> <end> [terms file] [workers]
+#       writes whole reprocessed files, <raw name>_processed, to
+#       tweet_archive_dir/backfill/, for bulkload.py or the insert queue
+#
+# start and end are YYYY-MM-DD, end excluded; a file's date is taken from the
+# tweets_file_date_frmt prefix of its name. The terms file defaults to
+# terms_file and workers to the number of CPUs. Files already compacted into
+# raw segments (archivecompactor.py) are read from there. Delete status files
+# are skipped. Progress, tweets per second and an estimate of the time left are
+# printed as each file finishes. The hourly rollups are not touched; they are
+# rebuilt (python rollups.py rebuild) from the processed files in the archive,
+# so move a processed backfill over those first.
+#-------------------------------------------------------------------------------
+
+import os
+import sys
+import glob
+import time
+import logging
+import ConfigParser
+import multiprocessing
+from datetime import datetime, timedelta
+
+import simplejson
+import tweetprocessing
+import quarantine
+import jobmanifest
+import linereader
+import archivecompactor
+
+PLATFORM_CONFIG_FILE = 'platform.ini'
+MODES = ['updates', 'processed']
+# the fields enrich_tweet derives; created_ts goes along to route the update
+DERIVED_FIELDS = ['hashtags', 'codes', 'mentions', 'track_kw', 'counts', 'text_hash']
+UPDATE_MARK = '-update-'
+
+logger = logging.getLogger('backfill')
+
+# state of each pool process, set once by init_worker
+worker_state = {}
+
+
+# The raw tweet files whose name dates fall in [start, end): the files still in
+# tweet_archive_dir by path, and those already compacted (archivecompactor.py) as
+# (segment, file name)
+def archived_raw_files(Config, start, end):
+    tweet_archive_dir = Config.get('files', 'tweet_archive_dir', 0)
+    date_format = Config.get('files', 'tweets_file_date_frmt', 0)
+    tweets_file = Config.get('files', 'tweets_file', 0)
+
+    selected = []
+    for raw_file in sorted(glob.glob(os.path.join(tweet_archive_dir, '*' + tweets_file))):
+        name = os.path.basename(raw_file)
+        file_date = archivecompactor.archive_file_date(name, date_format)
+        if '-delete-' not in name and file_date is not None and start <= file_date < end:
+            selected.append(raw_file)
+
+    settings = archivecompactor.ArchiveSettings(Config)
+    for segment in archivecompactor.list_segments(settings, 'raw'):
+        day = datetime.strptime(archivecompactor.segment_day(segment), '%Y%m%d')
+        if day + timedelta(days=1) <= start or day >= end:
+            continue
+        for source in archivecompactor.Segment(segment).meta['sources']:
+            file_date = archivecompactor.archive_file_date(source['name'], date_format)
+            if '-delete-' not in source['name'] and file_date is not None and start <= file_date < end:
+                selected.append((segment, source['name']))
+    return selected
+
+def source_name(raw_file):
+    return raw_file[1] if isinstance(raw_file, tuple) else os.path.basename(raw_file)
+
+def source_size(raw_file):
+    if isinstance(raw_file, tuple):
+        segment, name = raw_file
+        return sum(source['bytes'] for source in archivecompactor.Segment(segment).meta['sources'] if source['name'] == name)
+    return os.path.getsize(raw_file)
+
+def source_lines(raw_file):
+    if isinstance(raw_file, tuple):
+        segment, name = raw_file
+        return archivecompactor.Segment(segment).lines(name)
+    return (line for offset, line in linereader.iter_lines(raw_file))
+
+def output_file_name(Config, raw_file, mode, out_dir):
+    stem, extension = os.path.splitext(source_name(raw_file))
+    if mode == 'updates':
+        tweets_file = os.path.splitext(Config.get('files', 'tweets_file', 0))[0]
+        stem = stem[:-len(tweets_file)].rstrip('-') + UPDATE_MARK + tweets_file
+    return os.path.join(out_dir, stem + '_processed' + extension)
+
+def update_line(tweet):
+    fields = dict((field, tweet[field]) for field in DERIVED_FIELDS if field in tweet)
+    return simplejson.dumps({'update': {'id': tweet['id'], 'id_str': tweet['id_str'],
+        'created_ts': tweet['created_ts'], 'set': fields}}) + '\n'
+
+def init_worker(Config, track_list, mode, out_dir):
+    worker_state['Config'] = Config
+    worker_state['track_list'] = track_list
+    worker_state['mode'] = mode
+    worker_state['out_dir'] = out_dir
+    worker_state['rt_cache'] = tweetprocessing.RetweetCache(tweetprocessing.RETWEET_CACHE_SIZE)
+    worker_state['quarantine'] = quarantine.quarantine_from_config(Config, 'backfill', logger)
+
+# Reprocesses one raw file in a pool process. The output is written under a name
+# the inserters do not look for and renamed once complete.
+# Returns (raw file, output file, tweets written, lines lost, seconds).
+def backfill_file(raw_file):
+    start = time.time()
+    Config = worker_state['Config']
+    mode = worker_state['mode']
+    tweet_quarantine = worker_state['quarantine']
+    out_file = output_file_name(Config, raw_file, mode, worker_state['out_dir'])
+
+    written = 0
+    lost = 0
+    line_number = 0
+    with open(out_file + '.copying', 'w') as f_out:
+        for line in source_lines(raw_file):
+            try:
+                line_number += 1
+                tweet = tweetprocessing.enrich_tweet(simplejson.loads(line), worker_state['track_list'], rt_cache=worker_state['rt_cache'])
+                if mode == 'updates':
+                    # notices and limit messages have nothing stored to update
+                    if 'created_ts' not in tweet:
+                        continue
+                    f_out.write(update_line(tweet))
+                else:
+                    f_out.write(tweetprocessing.tweet_to_string(tweet))
+                written += 1
+            except (ValueError, TypeError, KeyError), e:
+                lost += 1
+                tweet_quarantine.add(source_name(raw_file), line_number, e, line.strip())
+
+    os.rename(out_file + '.copying', out_file)
+    tweet_quarantine.file_summary(source_name(raw_file))
+    return raw_file, out_file, written, lost, time.time() - start
+
+def format_seconds(seconds):
+    if seconds < 120:
+        return '%.0fs' % seconds
+    if seconds < 7200:
+        return '%.0fm' % (seconds / 60)
+    return '%.1fh' % (seconds / 3600)
+
+# Runs the files through a pool of workers, reporting as each one finishes.
+# Returns (tweets written, lines lost).
+def backfill(Config, raw_files, track_list, mode, workers, logger):
+    if mode == 'updates':
+        out_dir = Config.get('files', 'tweet_insert_queue', 0)
+    else:
+        out_dir = os.path.join(Config.get('files', 'tweet_archive_dir', 0), 'backfill')
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    manifest = jobmanifest.manifest_from_config(Config, logger) if mode == 'updates' else None
+
+    sizes = dict((raw_file, source_size(raw_file)) for raw_file in raw_files)
+    total_bytes = sum(sizes.values())
+    done_bytes = 0
+    tweets = 0
+    lost = 0
+    start = time.time()
+
+    pool = multiprocessing.Pool(workers, init_worker, (Config, track_list, mode, out_dir))
+    try:
+        for done, (raw_file, out_file, written, file_lost, seconds) in enumerate(pool.imap_unordered(backfill_file, raw_files), 1):
+            tweets += written
+            lost += file_lost
+            done_bytes += sizes[raw_file]
+            if manifest:
+                manifest.add('insert', out_file, 'queued', source=source_name(raw_file))
+
+            elapsed = time.time() - start
+            remaining = elapsed * (total_bytes - done_bytes) / done_bytes if done_bytes else 0
+            progress = '[%d/%d] %s: %d tweets, %d lost in %.1fs | %d tweets at %.0f/s, %s left' % (
+                done, len(raw_files), source_name(raw_file), written, file_lost, seconds,
+                tweets, tweets / elapsed if elapsed else 0, format_seconds(remaining))
+            print progress
+            logger.info(progress)
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    elapsed = time.time() - start
+    summary = 'Backfilled %d files into %s: %d tweets, %d lost in %s (%.0f tweets/s, %d workers)' % (
+        len(raw_files), out_dir, tweets, lost, format_seconds(elapsed), tweets / elapsed if elapsed else 0, workers)
+    print summary
+    logger.info(summary)
+    return tweets, lost
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 4 or sys.argv[1] not in MODES:
+        print "To run: python backfill.py <%s> <start YYYY-MM-DD> <end YYYY-MM-DD> [terms file] [workers]" % ' | '.join(MODES)
+        sys.exit()
+
+    Config = ConfigParser.ConfigParser()
+    Config.read(PLATFORM_CONFIG_FILE)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s', datefmt='%m-%d %H:%M')
+    logger = logging.getLogger('backfill')
+
+    mode = sys.argv[1]
+    start = datetime.strptime(sys.argv[2], '%Y-%m-%d')
+    end = datetime.strptime(sys.argv[3], '%Y-%m-%d')
+    termsListFile = sys.argv[4] if len(sys.argv) > 4 else Config.get('files', 'terms_file', 0)
+    workers = int(sys.argv[5]) if len(sys.argv) > 5 else multiprocessing.cpu_count()
+
+    with open(termsListFile) as f:
+        track_list = f.read().splitlines()
+
+    raw_files = archived_raw_files(Config, start, end)
+    if not raw_files:
+        print 'No raw tweet files in the archive from %s to %s' % (sys.argv[2], sys.argv[3])
+        sys.exit()
+
+    logger.info('Backfilling %d files from %s to %s with %d terms from %s' % (len(raw_files), sys.argv[2], sys.argv[3], len(track_list), termsListFile))
+    backfill(Config, raw_files, track_list, mode, workers, logger)
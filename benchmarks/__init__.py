@@ -0,0 +1,5 @@
+"""
+	Benchmarks for the toolkit's processing stages.
+	Run them from the repository root, e.g. python -m benchmarks.bench_retweet_cache
+
+"""
@@ -0,0 +1,127 @@
+"""
+	Compares ways of reading the lines of a large tweets file: the text mode
+	line iterator with strip() the stages used, linereader.iter_lines and the
+	zero-copy linereader.iter_mapped, each on its own and with simplejson.loads
+	on every line, and iter_lines over split_chunks on a pool of processes.
+
+	python -m benchmarks.bench_linereader <tweets file | size in MB> [workers]
+
+	Given a size, a synthetic file of that many MB of raw tweets is written to
+	a temporary directory first (and removed afterwards); pass 2048 or more for
+	multi-GB runs. The file is read once before timing so every pass sees a
+	warm page cache.
+
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import multiprocessing
+
+import simplejson
+import linereader
+from benchmarks import synthetic
+
+
+def write_synthetic_file(path, megabytes):
+    lines = list(synthetic.TweetGenerator().lines(20000))
+    block = '\n'.join(lines) + '\n'
+    with open(path, 'w') as f:
+        for i in range(int(megabytes * 1024 * 1024 / len(block)) + 1):
+            f.write(block)
+
+def read_text(path):
+    count = 0
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            count += 1
+    return count
+
+def read_lines(path):
+    count = 0
+    for offset, line in linereader.iter_lines(path):
+        count += 1
+    return count
+
+def read_mapped(path):
+    count = 0
+    for offset, line in linereader.iter_mapped(path):
+        count += 1
+    return count
+
+def parse_text(path):
+    count = 0
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            try:
+                simplejson.loads(line)
+            except ValueError:
+                pass
+            count += 1
+    return count
+
+def parse_lines(path, start=0, end=None):
+    count = 0
+    for offset, line in linereader.iter_lines(path, start, end):
+        try:
+            simplejson.loads(line)
+        except ValueError:
+            pass
+        count += 1
+    return count
+
+def parse_chunk(args):
+    return parse_lines(*args)
+
+def parse_chunks(path, workers):
+    pool = multiprocessing.Pool(workers)
+    try:
+        return sum(pool.map(parse_chunk, [(path, start, end) for start, end in linereader.split_chunks(path, workers)]))
+    finally:
+        pool.close()
+        pool.join()
+
+def timed(name, size, function, *args):
+    start = time.time()
+    lines = function(*args)
+    seconds = time.time() - start
+    print '%-28s %10d lines %8.2fs %9.1f MB/s %12.0f lines/s' % (name, lines, seconds, size / 1048576.0 / seconds, lines / seconds)
+    return lines
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2:
+        print "To run: python -m benchmarks.bench_linereader <tweets file | size in MB> [workers]"
+        sys.exit()
+
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else multiprocessing.cpu_count()
+    workdir = None
+    if os.path.exists(sys.argv[1]):
+        path = sys.argv[1]
+    else:
+        workdir = tempfile.mkdtemp(prefix='ssmc-linereader-')
+        path = os.path.join(workdir, 'bench-track-tweets_out.json')
+        write_synthetic_file(path, float(sys.argv[1]))
+
+    try:
+        size = os.path.getsize(path)
+        print '%s: %.1f MB' % (path, size / 1048576.0)
+        read_text(path)
+
+        counts = [
+            timed('text mode + strip', size, read_text, path),
+            timed('iter_lines', size, read_lines, path),
+            timed('iter_mapped (buffers)', size, read_mapped, path),
+            timed('text mode + strip + loads', size, parse_text, path),
+            timed('iter_lines + loads', size, parse_lines, path),
+            timed('%d chunks + loads' % workers, size, parse_chunks, path, workers)
+            ]
+        if len(set(counts)) != 1:
+            print 'line counts differ: %s' % counts
+    finally:
+        if workdir:
+            shutil.rmtree(workdir)
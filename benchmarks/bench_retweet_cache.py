@@ -0,0 +1,61 @@
+"""
+	Compares process_tweet with and without the retweet cache on a file of raw tweets.
+
+	python -m benchmarks.bench_retweet_cache <raw tweets file> [terms file] [cache size]
+
+	A synthetic file can be made with python -m benchmarks.synthetic.
+
+"""
+
+import sys
+import time
+
+import tweetprocessing
+
+
+def run_pass(lines, track_list, rt_cache):
+    outputs = []
+    start = time.time()
+    for line in lines:
+        outputs.append(tweetprocessing.process_tweet(line, track_list, rt_cache=rt_cache))
+    return time.time() - start, outputs
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2:
+        print "To run: python -m benchmarks.bench_retweet_cache <raw tweets file> [terms file] [cache size]"
+        sys.exit()
+
+    rawTweetsFile = sys.argv[1]
+    termsListFile = sys.argv[2] if len(sys.argv) > 2 else './collection.terms'
+    cache_size = int(sys.argv[3]) if len(sys.argv) > 3 else tweetprocessing.RETWEET_CACHE_SIZE
+
+    with open(termsListFile) as f:
+        track_list = f.read().splitlines()
+    with open(rawTweetsFile) as f:
+        lines = [line.strip() for line in f if line.strip()]
+
+    retweets = sum(1 for line in lines if '"retweeted_status"' in line)
+    print '%d tweets, %d retweets (%.1f%%)' % (len(lines), retweets, 100.0 * retweets / max(len(lines), 1))
+
+    uncached_time, uncached_out = run_pass(lines, track_list, None)
+    rt_cache = tweetprocessing.RetweetCache(cache_size)
+    cached_time, cached_out = run_pass(lines, track_list, rt_cache)
+
+    print 'uncached: %.2fs (%.0f tweets/sec)' % (uncached_time, len(lines) / uncached_time)
+    print 'cached:   %.2fs (%.0f tweets/sec)' % (cached_time, len(lines) / cached_time)
+    print 'speedup:  %.2fx' % (uncached_time / cached_time)
+    print rt_cache.stats_string()
+
+    # track_kw lists come out of set intersections, so compare them unordered
+    mismatches = 0
+    for uncached, cached in zip(uncached_out, cached_out):
+        if uncached != cached:
+            a = tweetprocessing.simplejson.loads(uncached)
+            b = tweetprocessing.simplejson.loads(cached)
+            for tweet in (a, b):
+                for key in tweet.get('track_kw', {}):
+                    tweet['track_kw'][key].sort()
+            if a != b:
+                mismatches += 1
+    print 'output mismatches: %d' % mismatches
@@ -0,0 +1,50 @@
+"""
+	Compares process_tweet encoding the whole tweet again with the splice mode,
+	which splices the derived fields into the raw line, on a file of raw tweets,
+	and checks that both outputs decode to the same tweets.
+
+	python -m benchmarks.bench_splice <raw tweets file> [terms file]
+
+	A synthetic file can be made with python -m benchmarks.synthetic.
+
+"""
+
+import sys
+import time
+
+import simplejson
+import tweetprocessing
+
+
+def run_pass(lines, track_list, splice):
+    outputs = []
+    start = time.time()
+    for line in lines:
+        outputs.append(tweetprocessing.process_tweet(line, track_list, splice=splice))
+    return time.time() - start, outputs
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2:
+        print "To run: python -m benchmarks.bench_splice <raw tweets file> [terms file]"
+        sys.exit()
+
+    rawTweetsFile = sys.argv[1]
+    termsListFile = sys.argv[2] if len(sys.argv) > 2 else './collection.terms'
+
+    with open(termsListFile) as f:
+        track_list = f.read().splitlines()
+    with open(rawTweetsFile) as f:
+        lines = [line for line in f if line.strip()]
+
+    full_time, full_out = run_pass(lines, track_list, False)
+    splice_time, splice_out = run_pass(lines, track_list, True)
+
+    spliced = sum(1 for full, spliced in zip(full_out, splice_out) if full != spliced)
+    print '%d lines, %d spliced (%.1f%%), the rest encoded whole' % (len(lines), spliced, 100.0 * spliced / max(len(lines), 1))
+    print 'full:   %.2fs (%.0f lines/sec)' % (full_time, len(lines) / full_time)
+    print 'splice: %.2fs (%.0f lines/sec)' % (splice_time, len(lines) / splice_time)
+    print 'speedup: %.2fx' % (full_time / splice_time)
+
+    mismatches = sum(1 for full, spliced in zip(full_out, splice_out) if simplejson.loads(full) != simplejson.loads(spliced))
+    print 'output mismatches: %d' % mismatches
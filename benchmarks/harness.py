@@ -0,0 +1,105 @@
+"""
+	Measurement helpers shared by the benchmarks.
+	Each stage runs in a forked child so its peak RSS is its own, and results
+	are kept as plain dicts that can be saved to and compared from JSON.
+
+"""
+
+import os
+import sys
+import time
+import json
+import resource
+import platform
+import subprocess
+import traceback
+import multiprocessing
+
+
+def current_rss_kb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 1024
+    except IOError:
+        return 0
+
+def peak_rss_kb():
+    # ru_maxrss is in kilobytes on linux and bytes on OS X
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak /= 1024
+    return peak
+
+def _child(stage_function, args, result_queue, quiet):
+    if quiet:
+        # the daemons print progress for every batch; keep it out of the timing
+        sys.stdout = open(os.devnull, 'w')
+    try:
+        start_rss = current_rss_kb()
+        start = time.time()
+        items = stage_function(*args)
+        seconds = time.time() - start
+        result_queue.put({
+            'items': items,
+            'seconds': seconds,
+            'items_per_sec': items / seconds if seconds else 0.0,
+            'start_rss_kb': start_rss,
+            'peak_rss_kb': peak_rss_kb()
+            })
+    except Exception, e:
+        result_queue.put({'skipped': '%s: %s' % (e.__class__.__name__, e), 'traceback': traceback.format_exc()})
+
+# Runs stage_function(*args) in a child process. stage_function returns the number
+# of items it handled. With repeat > 1 the fastest run is kept.
+def measure(stage_function, args=(), repeat=1, quiet=True):
+    best = None
+    for i in range(repeat):
+        result_queue = multiprocessing.Queue()
+        child = multiprocessing.Process(target=_child, args=(stage_function, args, result_queue, quiet))
+        child.start()
+        result = result_queue.get()
+        child.join()
+        if 'skipped' in result:
+            return result
+        if best is None or result['seconds'] < best['seconds']:
+            best = result
+    best['repeat'] = repeat
+    return best
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def new_results(options):
+    return {
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'git_revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'options': options,
+        'stages': {}
+        }
+
+def save_results(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+def format_results(results, baseline=None):
+    lines = ['%-22s %10s %9s %14s %12s %s' % ('stage', 'items', 'seconds', 'items/sec', 'peak RSS MB', 'vs baseline' if baseline else '')]
+    for stage in sorted(results['stages']):
+        result = results['stages'][stage]
+        if 'skipped' in result:
+            lines.append('%-22s skipped (%s)' % (stage, result['skipped']))
+            continue
+        compare = ''
+        if baseline and stage in baseline['stages'] and baseline['stages'][stage].get('items_per_sec'):
+            compare = '%.2fx' % (result['items_per_sec'] / baseline['stages'][stage]['items_per_sec'])
+        lines.append('%-22s %10d %9.2f %14.0f %12.1f %s' % (stage, result['items'], result['seconds'],
+            result['items_per_sec'], result['peak_rss_kb'] / 1024.0, compare))
+    return '\n'.join(lines)
@@ -0,0 +1,134 @@
+"""
+	In-memory stand-in for the parts of pymongo the toolkit uses, so the insert
+	and collector harnesses can run without a mongod. Documents are BSON
+	encoded on insert (when bson is importable) so client side encoding cost
+	stays part of the measurement; only the server round trip is missing.
+	Documents are only counted, not kept, so they do not inflate peak RSS.
+	write_latency (seconds per bulk write) stands in for the server round
+	trip when measuring how well writes overlap with parsing.
+
+"""
+
+import time
+import itertools
+import threading
+
+try:
+    import bson
+except ImportError:
+    bson = None
+
+
+class MemoryBulk(object):
+    def __init__(self, collection):
+        self.collection = collection
+        self.docs = []
+        self.updates = []
+
+    def insert(self, doc):
+        self.docs.append(doc)
+
+    def find(self, spec):
+        return MemoryBulkUpdate(self, spec)
+
+    def execute(self, write_concern=None):
+        latency = self.collection.database.client.write_latency
+        if latency:
+            time.sleep(latency)
+        self.collection.insert(self.docs)
+        for spec, document, upsert in self.updates:
+            self.collection.update(spec, document, upsert=upsert)
+        return {'nInserted': len(self.docs), 'nUpserted': len(self.updates), 'writeErrors': []}
+
+class MemoryBulkUpdate(object):
+    def __init__(self, bulk, spec):
+        self.bulk = bulk
+        self.spec = spec
+        self.upserting = False
+
+    def upsert(self):
+        self.upserting = True
+        return self
+
+    def update(self, document):
+        self.bulk.updates.append((self.spec, document, self.upserting))
+
+class MemoryCollection(object):
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self.write_concern = {}
+        self.inserted = 0
+        self.updated = 0
+        self.encoded_bytes = 0
+        self.ids = itertools.count(1)
+        # the insert engine writes from several threads
+        self.lock = threading.Lock()
+
+    def insert(self, doc_or_docs, continue_on_error=False, **kwargs):
+        docs = doc_or_docs if isinstance(doc_or_docs, list) else [doc_or_docs]
+        ids = []
+        for doc in docs:
+            with self.lock:
+                if '_id' not in doc:
+                    doc['_id'] = next(self.ids)
+            encoded = len(bson.BSON.encode(doc)) if bson is not None else 0
+            with self.lock:
+                self.encoded_bytes += encoded
+                self.inserted += 1
+            ids.append(doc['_id'])
+        return ids if isinstance(doc_or_docs, list) else ids[0]
+
+    def initialize_unordered_bulk_op(self):
+        return MemoryBulk(self)
+
+    def update(self, spec, document, upsert=False, multi=False, **kwargs):
+        with self.lock:
+            self.updated += 1
+        return {'n': 0, 'updatedExisting': False}
+
+    def remove(self, spec_or_id=None, **kwargs):
+        return {'n': 0}
+
+    def ensure_index(self, key_or_list, **kwargs):
+        return None
+
+    def find_one(self, spec=None, *args, **kwargs):
+        return None
+
+    def count(self):
+        return self.inserted
+
+class MemoryDatabase(object):
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self.collections = {}
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            self.collections[name] = MemoryCollection(self, name)
+        return self.collections[name]
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return self[name]
+
+    def error(self):
+        return None
+
+class MemoryConnection(object):
+    def __init__(self, write_latency=0.0):
+        self.write_latency = write_latency
+        self.databases = {}
+
+    def __getitem__(self, name):
+        if name not in self.databases:
+            self.databases[name] = MemoryDatabase(self, name)
+        return self.databases[name]
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return self[name]
@@ -0,0 +1,214 @@
+"""
+	Runs the pipeline benchmarks on a synthetic stream and saves the results as JSON.
+
+	python -m benchmarks.run [--tweets N] [--seed S] [--stages collector,preprocess,insert]
+	                         [--mongo HOST:PORT] [--repeat N] [--out results.json]
+	                         [--compare baseline.json] [--option name=value ...]
+	                         [--write-latency SECONDS] [--inserter name=value ...]
+	                         [--backends memory,sqlite]
+
+	Stages:
+	  collector   fileOutListener.on_data for every message, writing the raw files
+	  preprocess  preprocess.process_raw_file on the raw tweet and delete files
+	  insert      mongoBatchInsert.insert_processed_file on the processed files,
+	              once per storage backend in --backends: mongo (the mongod
+	              at --mongo), memory (an in-memory Mongo stand-in that waits
+	              --write-latency seconds per bulk write) and sqlite (a
+	              SQLite database in the work directory); the default is
+	              mongo or memory, and sqlite. --inserter sets [inserter]
+	              options (batch_docs, writers...)
+
+"""
+
+import os
+import sys
+import shutil
+import logging
+import tempfile
+import argparse
+import ConfigParser
+
+from benchmarks import synthetic
+from benchmarks import harness
+from benchmarks.memorymongo import MemoryConnection
+import quarantine
+import storage
+
+STAGES = ['collector', 'preprocess', 'insert']
+BACKENDS = ['memory', 'mongo', 'sqlite']
+BENCHMARK_DB = 'ssmc_benchmark'
+
+logger = logging.getLogger('benchmark')
+logger.addHandler(logging.NullHandler())
+
+
+def bench_config(workdir):
+    Config = ConfigParser.ConfigParser()
+    Config.add_section('files')
+    Config.set('files', 'raw_tweets_file_path', os.path.join(workdir, 'raw') + '/')
+    Config.set('files', 'tweet_archive_dir', os.path.join(workdir, 'archive') + '/')
+    Config.set('files', 'tweet_insert_queue', os.path.join(workdir, 'queue') + '/')
+    Config.set('files', 'tweets_file_date_frmt', '%Y%m%d-%H')
+    Config.set('files', 'tweets_file', 'tweets_out.json')
+    Config.add_section('collection')
+    Config.set('collection', 'collection_name', 'tweets')
+    for section in ['files']:
+        for option in ['raw_tweets_file_path', 'tweet_archive_dir', 'tweet_insert_queue']:
+            path = Config.get(section, option, 0)
+            if not os.path.exists(path):
+                os.makedirs(path)
+    return Config
+
+# Splits the generated stream the way the collector does: tweets in one file,
+# delete notices in a -delete- file, limit notices dropped.
+def write_input_files(workdir, tweets, options):
+    raw_dir = os.path.join(workdir, 'input')
+    os.makedirs(raw_dir)
+    stream_file = os.path.join(raw_dir, 'stream.json')
+    tweets_file = os.path.join(raw_dir, 'bench-track-tweets_out.json')
+    delete_file = os.path.join(raw_dir, 'bench-delete-tweets_out.json')
+
+    generator = synthetic.TweetGenerator(**options)
+    with open(stream_file, 'w') as stream, open(tweets_file, 'w') as t, open(delete_file, 'w') as d:
+        for line in generator.lines(tweets):
+            stream.write(line + '\n')
+            if line.startswith('{"delete"'):
+                d.write(line + '\n')
+            elif not line.startswith('{"limit"'):
+                t.write(line + '\n')
+    return stream_file, [tweets_file, delete_file], generator.track_terms
+
+def collector_stage(workdir, stream_file):
+    import ThreadedCollector
+    connection = MemoryConnection()
+    ThreadedCollector.connection = connection
+    ThreadedCollector.mongo_config = connection.config.config
+
+    out_dir = tempfile.mkdtemp(prefix='collector-', dir=workdir) + '/'
+    listener = ThreadedCollector.fileOutListener(out_dir, '%Y%m%d-%H', 'tweets_out.json', logger, 'track', BENCHMARK_DB)
+    items = 0
+    with open(stream_file) as f:
+        for line in f:
+            listener.on_data(line.rstrip('\n') + '\r\n')
+            items += 1
+    return items
+
+def preprocess_stage(workdir, raw_files, track_list):
+    import preprocess
+    import tweetprocessing
+    Config = bench_config(workdir)
+    rt_cache = tweetprocessing.RetweetCache()
+    tweet_quarantine = quarantine.Quarantine(os.path.join(workdir, 'quarantine'), 'preprocess', logger)
+    items = 0
+    for raw_file in raw_files:
+        processed_file = os.path.join(workdir, 'archive', os.path.basename(raw_file).replace('.json', '_processed.json'))
+        processed, lost = preprocess.process_raw_file(Config, raw_file, processed_file, track_list, tweet_quarantine, logger, rt_cache=rt_cache)
+        items += processed + lost
+    return items
+
+def insert_stage(workdir, processed_files, backend, mongo_host=None, write_latency=0.0, inserter_options=()):
+    import mongoBatchInsert
+    Config = bench_config(workdir)
+    if inserter_options:
+        Config.add_section('inserter')
+        for name, value in inserter_options:
+            Config.set('inserter', name, value)
+    if backend == 'mongo':
+        import pymongo
+        connection = pymongo.MongoClient(mongo_host)
+        connection.drop_database(BENCHMARK_DB)
+        connection.drop_database(BENCHMARK_DB + '-delete')
+        tweet_storage = storage.MongoStorage(connection, BENCHMARK_DB)
+    elif backend == 'sqlite':
+        sqlite_path = os.path.join(workdir, 'bench.sqlite')
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.exists(sqlite_path + suffix):
+                os.remove(sqlite_path + suffix)
+        tweet_storage = storage.SQLiteStorage(sqlite_path)
+    else:
+        tweet_storage = storage.MongoStorage(MemoryConnection(write_latency), BENCHMARK_DB)
+    tweet_quarantine = quarantine.Quarantine(os.path.join(workdir, 'quarantine'), 'insert', logger)
+    items = 0
+    for processed_file in processed_files:
+        # insert_processed_file removes its input, so work on a copy
+        queued_file = os.path.join(workdir, 'queue', os.path.basename(processed_file))
+        shutil.copyfile(processed_file, queued_file)
+        lines, inserted, lost = mongoBatchInsert.insert_processed_file(Config, queued_file, tweet_storage, tweet_quarantine, logger)
+        items += lines
+    if backend == 'mongo':
+        connection.drop_database(BENCHMARK_DB)
+        connection.drop_database(BENCHMARK_DB + '-delete')
+    tweet_storage.close()
+    return items
+
+def prepare_processed_files(workdir, raw_files, track_list):
+    import tweetprocessing
+    processed_dir = os.path.join(workdir, 'processed')
+    os.makedirs(processed_dir)
+    processed_files = []
+    for raw_file in raw_files:
+        processed_file = os.path.join(processed_dir, os.path.basename(raw_file).replace('.json', '_processed.json'))
+        with open(raw_file) as f, open(processed_file, 'w') as f_out:
+            for line in f:
+                f_out.write(tweetprocessing.process_tweet(line.strip(), track_list))
+        processed_files.append(processed_file)
+    return processed_files
+
+def parse_option(value):
+    name, _, raw = value.partition('=')
+    if name not in synthetic.DEFAULT_OPTIONS:
+        raise argparse.ArgumentTypeError('unknown generator option %s' % name)
+    return name, type(synthetic.DEFAULT_OPTIONS[name])(raw)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the collection pipeline stages on synthetic tweets.')
+    parser.add_argument('--tweets', type=int, default=50000)
+    parser.add_argument('--seed', type=int, default=synthetic.DEFAULT_OPTIONS['seed'])
+    parser.add_argument('--stages', default=','.join(STAGES))
+    parser.add_argument('--mongo', default=None, help='host[:port] of a mongod to insert into (default: in-memory stand-in)')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--out', default=None, help='save results to this JSON file')
+    parser.add_argument('--compare', default=None, help='baseline results JSON to compare against')
+    parser.add_argument('--option', type=parse_option, action='append', default=[], help='generator option, e.g. retweet_ratio=0.8')
+    parser.add_argument('--write-latency', type=float, default=0.0, help='seconds the in-memory stand-in takes per bulk write')
+    parser.add_argument('--inserter', type=lambda value: tuple(value.split('=', 1)), action='append', default=[], help='[inserter] option for the insert stage, e.g. writers=4')
+    parser.add_argument('--backends', default=None, help='storage backends for the insert stage (default: mongo or memory, and sqlite)')
+    args = parser.parse_args()
+
+    stages = args.stages.split(',')
+    for stage in stages:
+        if stage not in STAGES:
+            parser.error('unknown stage %s' % stage)
+    backends = args.backends.split(',') if args.backends else ['mongo' if args.mongo else 'memory', 'sqlite']
+    for backend in backends:
+        if backend not in BACKENDS:
+            parser.error('unknown backend %s' % backend)
+        if backend == 'mongo' and not args.mongo:
+            parser.error('the mongo backend needs --mongo')
+
+    options = dict(args.option)
+    options['seed'] = args.seed
+    results = harness.new_results(dict(options, tweets=args.tweets, mongo=args.mongo, write_latency=args.write_latency, inserter=dict(args.inserter), backends=backends))
+
+    workdir = tempfile.mkdtemp(prefix='ssmc-bench-')
+    try:
+        stream_file, raw_files, track_list = write_input_files(workdir, args.tweets, options)
+
+        if 'collector' in stages:
+            results['stages']['collector'] = harness.measure(collector_stage, (workdir, stream_file), args.repeat)
+        if 'preprocess' in stages:
+            results['stages']['preprocess'] = harness.measure(preprocess_stage, (workdir, raw_files, track_list), args.repeat)
+        if 'insert' in stages:
+            processed_files = prepare_processed_files(workdir, raw_files, track_list)
+            for backend in backends:
+                results['stages']['insert-' + backend] = harness.measure(insert_stage, (workdir, processed_files, backend, args.mongo, args.write_latency, args.inserter), args.repeat)
+    finally:
+        shutil.rmtree(workdir)
+
+    baseline = harness.load_results(args.compare) if args.compare else None
+    print harness.format_results(results, baseline)
+    if args.out:
+        harness.save_results(results, args.out)
+        print 'Results saved to %s' % args.out
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+	Seeded generator of synthetic streaming API messages.
+	Produces tweets shaped like the ones the collector writes (entities, user,
+	retweeted_status), mixed with delete and limit notices. The same seed and
+	options always give the same lines, so benchmark runs can be compared.
+
+	python -m benchmarks.synthetic <out file> [tweets] [seed]
+
+"""
+
+import sys
+import random
+import json
+import time
+
+TRACK_TERMS = ['privacy', 'security', 'breach', 'encryption', 'surveillance']
+
+WORDS = ['the', 'a', 'data', 'news', 'today', 'people', 'new', 'report', 'just', 'via',
+    'leak', 'update', 'this', 'is', 'what', 'we', 'need', 'know', 'about', 'law',
+    'phone', 'app', 'users', 'government', 'policy', 'online', 'read', 'more', 'why', 'how']
+
+UNICODE_WORDS = [u'caf\xe9', u'na\xefve', u'日本', u'данные',
+    u'خصوصية', u'\U0001f512', u'❤', u'\xfcber']
+
+DEFAULT_OPTIONS = {
+    'seed': 42,
+    'retweet_ratio': 0.4,       # share of tweets that are retweets
+    'originals': 2000,          # pool of original tweets retweets are drawn from
+    'viral_skew': 1.2,          # zipf-like skew of retweets towards popular originals
+    'hashtags': 2,              # mean hashtags per tweet
+    'mentions': 1,              # mean mentions per tweet
+    'urls': 1,                  # mean urls per tweet
+    'text_words': 14,           # mean words of text
+    'unicode_ratio': 0.1,       # share of words drawn from non-ascii words
+    'track_ratio': 0.5,         # share of tweets containing a track term
+    'delete_ratio': 0.05,       # share of lines that are delete notices
+    'limit_ratio': 0.001,       # share of lines that are limit notices
+    'users': 50000,             # distinct users
+    'start_time': 1409140800,   # 2014-08-27 12:00:00 UTC
+    'tweets_per_second': 50.0   # advance of created_at between tweets
+    }
+
+
+def twitter_date(timestamp):
+    return time.strftime('%a %b %d %H:%M:%S +0000 %Y', time.gmtime(timestamp))
+
+
+class TweetGenerator(object):
+    """ Iterate over lines() to get raw message strings (no trailing newline). """
+    def __init__(self, **options):
+        unknown = set(options) - set(DEFAULT_OPTIONS)
+        if unknown:
+            raise ValueError('Unknown generator options: %s' % ', '.join(sorted(unknown)))
+        self.options = dict(DEFAULT_OPTIONS)
+        self.options.update(options)
+        self.track_terms = TRACK_TERMS
+        self.random = random.Random(self.options['seed'])
+        self.next_id = 500000000000000000
+        self.now = float(self.options['start_time'])
+        self.originals = [self.make_tweet(self.random.randint(0, self.options['users'] - 1))
+            for i in range(self.options['originals'])]
+
+    def count(self, mean):
+        # small geometric-ish counts with the given mean
+        n = 0
+        while self.random.random() < float(mean) / (mean + 1):
+            n += 1
+        return n
+
+    def word(self):
+        if self.random.random() < self.options['unicode_ratio']:
+            return self.random.choice(UNICODE_WORDS)
+        return self.random.choice(WORDS)
+
+    def user(self, user_id):
+        return {
+            'id': user_id,
+            'id_str': str(user_id),
+            'screen_name': 'user_%d' % user_id,
+            'name': 'User %d' % user_id,
+            'description': ' '.join(WORDS[(user_id + i) % len(WORDS)] for i in range(12)),
+            'followers_count': (user_id * 7919) % 100000,
+            'friends_count': (user_id * 104729) % 5000,
+            'statuses_count': (user_id * 31) % 200000,
+            'lang': 'en',
+            'created_at': twitter_date(1200000000 + (user_id * 9973) % 200000000)
+            }
+
+    def make_tweet(self, user_id):
+        self.next_id += self.random.randint(1, 5000)
+        options = self.options
+        words = [self.word() for i in range(max(self.count(options['text_words']), 1))]
+        if self.random.random() < options['track_ratio']:
+            words.insert(self.random.randint(0, len(words)), self.random.choice(self.track_terms))
+
+        hashtags = []
+        for i in range(self.count(options['hashtags'])):
+            text = self.random.choice(WORDS + self.track_terms) + ('' if self.random.random() < 0.7 else '_%d' % i)
+            hashtags.append({'text': text.capitalize(), 'indices': [0, 0]})
+            words.append('#' + hashtags[-1]['text'])
+
+        mentions = []
+        for i in range(self.count(options['mentions'])):
+            mentioned = self.random.randint(0, options['users'] - 1)
+            mentions.append({'screen_name': 'user_%d' % mentioned, 'name': 'User %d' % mentioned,
+                'id': mentioned, 'id_str': str(mentioned), 'indices': [0, 0]})
+            words.insert(0, '@user_%d' % mentioned)
+
+        urls = []
+        for i in range(self.count(options['urls'])):
+            short = 'http://t.co/%x' % self.random.getrandbits(40)
+            urls.append({'url': short, 'expanded_url': 'http://example.com/%x' % self.random.getrandbits(32),
+                'display_url': 'example.com/...', 'indices': [0, 0]})
+            words.append(short)
+
+        return {
+            'created_at': twitter_date(self.now),
+            'id': self.next_id,
+            'id_str': str(self.next_id),
+            'text': u' '.join(words),
+            'source': '<a href="http://twitter.com" rel="nofollow">Twitter Web Client</a>',
+            'truncated': False,
+            'in_reply_to_status_id': None,
+            'user': self.user(user_id),
+            'geo': None,
+            'coordinates': None,
+            'place': None,
+            'retweet_count': 0,
+            'favorite_count': 0,
+            'entities': {'hashtags': hashtags, 'symbols': [], 'urls': urls, 'user_mentions': mentions},
+            'favorited': False,
+            'retweeted': False,
+            'filter_level': 'low',
+            'lang': 'en',
+            'timestamp_ms': str(int(self.now * 1000))
+            }
+
+    def retweet(self, user_id):
+        # a few originals take most of the retweets, as in a viral event
+        index = int(len(self.originals) * (self.random.random() ** (1 + self.options['viral_skew'])))
+        original = self.originals[index]
+        tweet = self.make_tweet(user_id)
+        author = original['user']['screen_name']
+        tweet['text'] = (u'RT @%s: %s' % (author, original['text']))[:140]
+        tweet['entities'] = {
+            'hashtags': original['entities']['hashtags'],
+            'symbols': [],
+            'urls': original['entities']['urls'],
+            'user_mentions': [{'screen_name': author, 'name': original['user']['name'],
+                'id': original['user']['id'], 'id_str': original['user']['id_str'], 'indices': [3, 3 + len(author)]}]
+            }
+        tweet['retweeted_status'] = original
+        return tweet
+
+    def message(self):
+        options = self.options
+        self.now += self.random.expovariate(options['tweets_per_second'])
+        draw = self.random.random()
+        if draw < options['limit_ratio']:
+            return {'limit': {'track': self.random.randint(1, 500)}}
+        if draw < options['limit_ratio'] + options['delete_ratio']:
+            deleted = self.next_id - self.random.randint(1, 10 ** 9)
+            user_id = self.random.randint(0, options['users'] - 1)
+            return {'delete': {'status': {'id': deleted, 'id_str': str(deleted),
+                'user_id': user_id, 'user_id_str': str(user_id)}}}
+        user_id = self.random.randint(0, options['users'] - 1)
+        if self.random.random() < options['retweet_ratio']:
+            return self.retweet(user_id)
+        return self.make_tweet(user_id)
+
+    def lines(self, tweets):
+        for i in xrange(tweets):
+            yield json.dumps(self.message())
+
+# Writes a raw tweets file the way the collector does (one JSON message per line)
+def write_raw_file(path, tweets, **options):
+    generator = TweetGenerator(**options)
+    with open(path, 'w') as f:
+        for line in generator.lines(tweets):
+            f.write(line)
+            f.write('\n')
+    return generator
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2:
+        print "To run: python -m benchmarks.synthetic <out file> [tweets] [seed]"
+        sys.exit()
+
+    tweets = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    seed = int(sys.argv[3]) if len(sys.argv) > 3 else DEFAULT_OPTIONS['seed']
+    start = time.time()
+    write_raw_file(sys.argv[1], tweets, seed=seed)
+    print 'Wrote %d messages to %s in %.1fs' % (tweets, sys.argv[1], time.time() - start)
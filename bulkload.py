@@ -0,0 +1,103 @@
+#-------------------------------------------------------------------------------
+# Name:        Bulk load mode for backfills.
+# Purpose:     Loads processed tweet files into mongo without maintaining the
+#              secondary indexes during the load, then rebuilds them in one pass.
+#
+#   python bulkload.py load <processed file> [<processed file> ...]
+#       drops the secondary indexes of collection_name and its partitions,
+#       inserts the files the way mongoBatchInsert.py does and rebuilds the
+#       indexes. The files are left in place, so the *_processed.json files of
+#       tweet_archive_dir can be loaded; their checkpoints are kept in
+#       [inserter] bulk_load_checkpoint_dir and a rerun resumes each file
+#   python bulkload.py drop-indexes
+#   python bulkload.py rebuild-indexes
+#       the two halves of load, for when the files go through the normal
+#       inserter; set [inserter] bulk_load so it does not create indexes on
+#       new partitions in between
+#-------------------------------------------------------------------------------
+
+import os
+import sys
+import time
+import logging
+import ConfigParser
+
+import partitions
+import mongoclient
+import quarantine
+import mongoBatchInsert
+import storage
+import platformconfig
+
+PLATFORM_CONFIG_FILE = 'platform.ini'
+CHECKPOINT_DIR = './bulkload/'
+
+
+# collection_name and whichever of its partitions exist
+def existing_collections(database, base_name):
+    names = database.collection_names()
+    return [database[name] for name in partitions.partition_collections(database, base_name) if name in names]
+
+def drop_indexes(database, base_name, logger):
+    for collection in existing_collections(database, base_name):
+        partitions.drop_secondary_indexes(collection, logger)
+
+def rebuild_indexes(database, base_name, logger):
+    for collection in existing_collections(database, base_name):
+        start = time.time()
+        partitions.rebuild_indexes(collection, logger)
+        print 'Rebuilt indexes on %s in %.1fs' % (collection.name, time.time() - start)
+
+def load_files(Config, files, tweet_storage, logger):
+    if not Config.has_section('inserter'):
+        Config.add_section('inserter')
+    Config.set('inserter', 'bulk_load', '1')
+
+    checkpoint_dir = platformconfig.get_option(Config, 'inserter', 'bulk_load_checkpoint_dir', CHECKPOINT_DIR)
+    if not os.path.exists(checkpoint_dir):
+        os.makedirs(checkpoint_dir)
+
+    tweet_quarantine = quarantine.quarantine_from_config(Config, 'insert', logger)
+    total_lines = 0
+    total_inserted = 0
+    total_lost = 0
+    start = time.time()
+    for processedTweetsFile in files:
+        lines, inserted, lost = mongoBatchInsert.insert_processed_file(Config, processedTweetsFile, tweet_storage, tweet_quarantine, logger,
+            keep_input=True, checkpoint_dir=checkpoint_dir)
+        total_lines += lines
+        total_inserted += inserted
+        total_lost += lost
+    tweet_quarantine.close()
+
+    seconds = time.time() - start
+    print 'Loaded %d files: %d lines, %d inserted, %d lost in %.1fs (%.0f lines/sec)' % (len(files), total_lines, total_inserted, total_lost, seconds, total_lines / seconds if seconds else 0.0)
+
+
+if __name__ == '__main__':
+
+    commands = ['load', 'drop-indexes', 'rebuild-indexes']
+    if len(sys.argv) < 2 or sys.argv[1] not in commands or (sys.argv[1] == 'load' and len(sys.argv) < 3):
+        print "To run: python bulkload.py load <processed file> [<processed file> ...]"
+        print "        python bulkload.py drop-indexes | rebuild-indexes"
+        sys.exit()
+
+    Config = ConfigParser.ConfigParser()
+    Config.read(PLATFORM_CONFIG_FILE)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s', datefmt='%m-%d %H:%M')
+    logger = logging.getLogger('bulkload')
+
+    dbName = Config.get('collection', 'db_name', 0)
+    dbCollectionName = Config.get('collection', 'collection_name', 0)
+
+    connection = mongoclient.get_client(Config)
+    data_db = connection[dbName]
+
+    command = sys.argv[1]
+    if command in ('load', 'drop-indexes'):
+        drop_indexes(data_db, dbCollectionName, logger)
+    if command == 'load':
+        load_files(Config, sys.argv[2:], storage.MongoStorage(connection, dbName), logger)
+    if command in ('load', 'rebuild-indexes'):
+        rebuild_indexes(data_db, dbCollectionName, logger)
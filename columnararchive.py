@@ -0,0 +1,245 @@
+"""
+	Columnar export of processed tweets.
+	Writes one file per hour of created_ts for every raw tweet file, so simple
+	counts can be run without parsing the JSON archive. Files are Parquet or
+	Arrow IPC when pyarrow is installed, otherwise NumPy .npz.
+
+"""
+
+import os.path
+import calendar
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+FORMAT_EXTENSIONS = {
+    'parquet': '.parquet',
+    'arrow': '.arrow',
+    'npz': '.npz'
+    }
+
+# scalar columns and the numpy dtype they are stored with
+SCALAR_COLUMNS = [
+    ('id', 'int64'),
+    ('created_ts', 'int64'),
+    ('user_id', 'int64'),
+    ('is_retweet', 'bool'),
+    ('count_urls', 'int32'),
+    ('count_hashtags', 'int32'),
+    ('count_user_mentions', 'int32'),
+    ('count_coded_urls', 'int32')
+    ]
+
+# list columns, stored as offsets + dictionary codes + dictionary
+LIST_COLUMNS = ['hashtags', 'mentions', 'track_kw']
+
+
+# array has no 8 byte type code before Python 3.3 and 'l' is only 8 bytes on
+# 64-bit Unix builds; elsewhere the int64 columns are buffered in lists
+INT64_ARRAYS = array('l').itemsize == 8
+
+def int64_column():
+    return array('l') if INT64_ARRAYS else []
+
+# A buffered column as a numpy array, read with the item size it was written with
+def column_array(column):
+    if isinstance(column, array):
+        return numpy.frombuffer(column, dtype='int%d' % (8 * column.itemsize))
+    return numpy.array(column, dtype='int64')
+
+# Picks the output format. 'auto' prefers parquet and falls back to npz,
+# None means there is nothing available to write columnar files with.
+def resolve_format(columnar_format):
+    if columnar_format == 'auto':
+        if pyarrow is not None:
+            columnar_format = 'parquet'
+        else:
+            columnar_format = 'npz'
+    if columnar_format not in FORMAT_EXTENSIONS:
+        raise ValueError('Unknown columnar format: %s' % columnar_format)
+    if numpy is None:
+        return None
+    if columnar_format in ['parquet', 'arrow'] and pyarrow is None:
+        return None
+    return columnar_format
+
+# created_ts is 'YYYY-MM-DD HH:MM:SS'; slicing beats strptime by a wide margin
+def created_ts_to_epoch(created_ts):
+    return calendar.timegm((int(created_ts[0:4]), int(created_ts[5:7]), int(created_ts[8:10]),
+        int(created_ts[11:13]), int(created_ts[14:16]), int(created_ts[17:19]), 0, 0, 0))
+
+def partition_key(created_ts):
+    return created_ts[0:4] + created_ts[5:7] + created_ts[8:10] + '/' + created_ts[11:13]
+
+
+class ListColumn(object):
+    """ A column of string lists kept as offsets into a flat array of
+    dictionary codes.
+    """
+    def __init__(self):
+        self.offsets = array('l', [0])
+        self.codes = array('l')
+        self.dictionary = {}
+
+    def append(self, values):
+        for value in values:
+            code = self.dictionary.get(value)
+            if code is None:
+                code = len(self.dictionary)
+                self.dictionary[value] = code
+            self.codes.append(code)
+        self.offsets.append(len(self.codes))
+
+    def dictionary_values(self):
+        values = [None] * len(self.dictionary)
+        for value, code in self.dictionary.iteritems():
+            values[code] = value
+        return values
+
+
+class HourPartition(object):
+    """ Buffered rows for one hour of created_ts. """
+    def __init__(self):
+        self.rows = 0
+        self.scalars = dict((name, int64_column() if dtype == 'int64' else array('l')) for name, dtype in SCALAR_COLUMNS)
+        self.lists = dict((name, ListColumn()) for name in LIST_COLUMNS)
+
+    def append(self, tweet):
+        counts = tweet['counts']
+        scalars = self.scalars
+        scalars['id'].append(tweet['id'])
+        scalars['created_ts'].append(created_ts_to_epoch(tweet['created_ts']))
+        scalars['user_id'].append(tweet['user']['id'])
+        scalars['is_retweet'].append(1 if 'retweeted_status' in tweet else 0)
+        scalars['count_urls'].append(counts['urls'])
+        scalars['count_hashtags'].append(counts['hashtags'])
+        scalars['count_user_mentions'].append(counts['user_mentions'])
+        scalars['count_coded_urls'].append(counts['coded_urls'])
+
+        self.lists['hashtags'].append(tweet['hashtags'])
+        self.lists['mentions'].append(tweet['mentions'])
+        track_kw = set()
+        for matches in tweet['track_kw'].itervalues():
+            track_kw.update(matches)
+        self.lists['track_kw'].append(sorted(track_kw))
+        self.rows += 1
+
+    def to_numpy(self):
+        columns = {}
+        for name, dtype in SCALAR_COLUMNS:
+            columns[name] = column_array(self.scalars[name]).astype(dtype)
+        for name in LIST_COLUMNS:
+            column = self.lists[name]
+            columns[name + '_offsets'] = column_array(column.offsets).astype('int32')
+            columns[name + '_codes'] = column_array(column.codes).astype('int32')
+            columns[name + '_dictionary'] = numpy.array(column.dictionary_values(), dtype=numpy.unicode_)
+        return columns
+
+    def to_arrow(self):
+        columns = self.to_numpy()
+        names = []
+        arrays = []
+        for name, dtype in SCALAR_COLUMNS:
+            names.append(name)
+            arrays.append(pyarrow.array(columns[name]))
+        for name in LIST_COLUMNS:
+            dictionary = pyarrow.array(self.lists[name].dictionary_values(), type=pyarrow.string())
+            values = pyarrow.DictionaryArray.from_arrays(pyarrow.array(columns[name + '_codes']), dictionary)
+            names.append(name)
+            arrays.append(pyarrow.ListArray.from_arrays(pyarrow.array(columns[name + '_offsets']), values))
+        return pyarrow.Table.from_arrays(arrays, names)
+
+
+class ColumnarArchiveWriter(object):
+    """ Collects processed tweets from one raw file and writes them out as
+    <columnar_dir>/<YYYYMMDD>/<HH>/<raw file name>.<ext> on close().
+    Messages without created_ts (deletes, limits) are skipped.
+    """
+    def __init__(self, columnar_dir, columnar_format, rawTweetsFile, logger):
+        self.columnar_dir = columnar_dir
+        self.columnar_format = columnar_format
+        self.logger = logger
+        self.file_name = os.path.splitext(os.path.basename(rawTweetsFile))[0] + FORMAT_EXTENSIONS[columnar_format]
+        self.partitions = {}
+        self.skipped = 0
+
+    def add(self, tweet, offset=None):
+        if 'created_ts' not in tweet:
+            self.skipped += 1
+            return
+        key = partition_key(tweet['created_ts'])
+        partition = self.partitions.get(key)
+        if partition is None:
+            partition = self.partitions[key] = HourPartition()
+        partition.append(tweet)
+
+    def close(self):
+        rows = 0
+        for key in sorted(self.partitions):
+            partition = self.partitions[key]
+            partition_dir = os.path.join(self.columnar_dir, key)
+            if not os.path.exists(partition_dir):
+                os.makedirs(partition_dir)
+            out_file = os.path.join(partition_dir, self.file_name)
+            write_partition(partition, out_file, self.columnar_format)
+            rows += partition.rows
+
+        self.logger.info('Columnar archive: wrote %d rows in %d hour partitions for %s (%d skipped)' % (rows, len(self.partitions), self.file_name, self.skipped))
+        self.partitions = {}
+
+def write_partition(partition, out_file, columnar_format):
+    # write to a temp name first so readers never see a half written file
+    tmp_file = out_file + '.tmp'
+    if columnar_format == 'npz':
+        with open(tmp_file, 'wb') as f:
+            numpy.savez(f, **partition.to_numpy())
+    elif columnar_format == 'parquet':
+        pyarrow.parquet.write_table(partition.to_arrow(), tmp_file)
+    else:
+        table = partition.to_arrow()
+        with open(tmp_file, 'wb') as f:
+            writer = pyarrow.RecordBatchFileWriter(f, table.schema)
+            writer.write_table(table)
+            writer.close()
+    os.rename(tmp_file, out_file)
+
+# Loads a partition file written by any of the formats as a dict of numpy
+# arrays. List columns come back as <name>_offsets, <name>_codes and
+# <name>_dictionary, the same layout the npz files use.
+def load_columns(in_file):
+    if in_file.endswith('.npz'):
+        with numpy.load(in_file) as data:
+            return dict((name, data[name]) for name in data.files)
+
+    if in_file.endswith('.parquet'):
+        table = pyarrow.parquet.read_table(in_file)
+    else:
+        with open(in_file, 'rb') as f:
+            table = pyarrow.RecordBatchFileReader(f).read_all()
+
+    columns = {}
+    for name, dtype in SCALAR_COLUMNS:
+        chunks = [chunk.to_numpy(zero_copy_only=False) for chunk in table.column(name).chunks]
+        columns[name] = numpy.concatenate(chunks).astype(dtype) if chunks else numpy.array([], dtype=dtype)
+    for name in LIST_COLUMNS:
+        values = []
+        offsets = [0]
+        for row in table.column(name).to_pylist():
+            values.extend(row)
+            offsets.append(len(values))
+        dictionary = {}
+        codes = [dictionary.setdefault(value, len(dictionary)) for value in values]
+        columns[name + '_offsets'] = numpy.array(offsets, dtype='int32')
+        columns[name + '_codes'] = numpy.array(codes, dtype='int32')
+        columns[name + '_dictionary'] = numpy.array(sorted(dictionary, key=dictionary.get), dtype=numpy.unicode_)
+    return columns
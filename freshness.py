@@ -0,0 +1,263 @@
+"""
+	End-to-end freshness of the collected data.
+	Each stage measures, for a sample of the tweets it handles, how long after
+	the tweet's created_at it handled it: the collector when it writes the tweet
+	to a raw file, the processor when the processed file is written and the
+	inserter when the batch holding the tweet is committed. Every file gives one
+	record (stage, file, lag percentiles and a histogram) appended to log_file
+	as a JSON line, and a FRESHNESS line in the stage's log; when the
+	alert_percentile lag of a file is over alert_seconds a warning is logged.
+	The histograms merge, so percentiles over any number of files and hours are
+	read back with:
+
+	python freshness.py report [hours] [stage]
+	python freshness.py files [hours] [stage]
+	python freshness.py check [hours]   exits 1 when a stage is over the alert threshold
+
+	Lags are sampled every sample_every-th tweet; created_at comes from
+	timestamp_ms when the message has it.
+
+"""
+
+import os
+import sys
+import time
+import bisect
+import threading
+import ConfigParser
+from email.utils import parsedate_tz, mktime_tz
+
+import simplejson
+import platformconfig
+
+PLATFORM_CONFIG_FILE = 'platform.ini'
+STAGES = ['collector', 'processor', 'inserter']
+SAMPLE_EVERY = 10
+LOG_FILE = './logs/freshness.json'
+ALERT_PERCENTILE = 90
+PERCENTILES = [50, 90, 99]
+# upper bounds in seconds of the histogram buckets; the last bucket is open
+BUCKETS = [1, 2, 5, 10, 15, 30, 45, 60, 90, 120, 180, 240, 300, 450, 600, 900, 1200, 1800, 2700,
+    3600, 5400, 7200, 10800, 14400, 21600, 43200, 86400, 172800, 604800]
+
+
+# Seconds since the epoch the tweet was created, or None for other messages
+def created_time(tweet):
+    if not isinstance(tweet, dict):
+        return None
+    if 'timestamp_ms' in tweet:
+        try:
+            return int(tweet['timestamp_ms']) / 1000.0
+        except (TypeError, ValueError):
+            pass
+    if 'created_at' in tweet:
+        time_tuple = parsedate_tz(tweet['created_at'])
+        if time_tuple:
+            return mktime_tz(time_tuple)
+    return None
+
+def percentile(sorted_values, percent):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * percent / 100.0))]
+
+def new_histogram():
+    return [0] * (len(BUCKETS) + 1)
+
+# The upper bound of the bucket holding the percent-th lag, at most max_lag; the
+# open bucket reports its lower bound
+def histogram_percentile(histogram, percent, max_lag=None):
+    total = sum(histogram)
+    if not total:
+        return None
+    rank = min(total - 1, int(total * percent / 100.0))
+    seen = 0
+    for bucket, count in enumerate(histogram):
+        seen += count
+        if seen > rank:
+            bound = BUCKETS[min(bucket, len(BUCKETS) - 1)]
+            return bound if max_lag is None or bucket == len(BUCKETS) else min(bound, max_lag)
+
+
+class FreshnessTracker(object):
+    """ Usage, in the collector (the tweet is handled as it is written):
+            tracker.record(tweet)
+        in the processor (handled once the file is written):
+            tracker.add(tweet) for every tweet, tracker.handled() at the end
+        in the inserter, as the insert engine's on_written hook:
+            tracker(collection_name, docs, skipped_indexes)
+        and at the end of every file:
+            tracker.file_done(file_name)
+        The hook is called from the engine's writer threads.
+    """
+    def __init__(self, stage, logger, sample_every=SAMPLE_EVERY, log_file=LOG_FILE, alert_seconds=0, alert_percentile=ALERT_PERCENTILE):
+        self.stage = stage
+        self.logger = logger
+        self.sample_every = max(sample_every, 1)
+        self.log_file = log_file
+        self.alert_seconds = alert_seconds
+        self.alert_percentile = alert_percentile
+        self.lock = threading.Lock()
+        self.items = 0
+        self.pending = []
+        self.lags = []
+
+    def sampled(self):
+        self.items += 1
+        return self.items % self.sample_every == 0
+
+    def record(self, tweet):
+        if self.sampled():
+            created = created_time(tweet)
+            if created is not None:
+                self.lags.append(time.time() - created)
+
+    def add(self, tweet):
+        if self.sampled():
+            created = created_time(tweet)
+            if created is not None:
+                self.pending.append(created)
+
+    def handled(self):
+        now = time.time()
+        self.lags.extend(now - created for created in self.pending)
+        self.pending = []
+
+    def __call__(self, collection_name, docs, skipped_indexes):
+        now = time.time()
+        with self.lock:
+            for index, doc in enumerate(docs):
+                if index not in skipped_indexes and self.sampled():
+                    created = created_time(doc)
+                    if created is not None:
+                        self.lags.append(now - created)
+
+    # Publishes the lags of the file and starts over. Returns the record.
+    def file_done(self, file_name):
+        with self.lock:
+            lags = sorted(self.lags)
+            self.lags = []
+            self.pending = []
+            self.items = 0
+        if not lags:
+            return None
+        histogram = new_histogram()
+        for lag in lags:
+            histogram[bisect.bisect_left(BUCKETS, lag)] += 1
+        entry = {
+            'stage': self.stage,
+            'file': os.path.basename(file_name),
+            'time': time.time(),
+            'sampled': len(lags),
+            'min': lags[0],
+            'max': lags[-1],
+            'histogram': histogram
+            }
+        for percent in PERCENTILES:
+            entry['p%d' % percent] = percentile(lags, percent)
+
+        self.logger.info('FRESHNESS %s %s: %d sampled tweets, lag p50 %s, p90 %s, p99 %s, max %s' % (self.stage, entry['file'], len(lags),
+            format_seconds(entry['p50']), format_seconds(entry['p90']), format_seconds(entry['p99']), format_seconds(entry['max'])))
+        alert_lag = percentile(lags, self.alert_percentile)
+        if self.alert_seconds and alert_lag > self.alert_seconds:
+            entry['alert'] = True
+            self.logger.warning('FRESHNESS ALERT %s %s: p%d lag %s is over %s' % (self.stage, entry['file'], self.alert_percentile,
+                format_seconds(alert_lag), format_seconds(self.alert_seconds)))
+        try:
+            log_dir = os.path.dirname(self.log_file)
+            if log_dir and not os.path.exists(log_dir):
+                os.makedirs(log_dir)
+            with open(self.log_file, 'a') as f:
+                f.write(simplejson.dumps(entry) + '\n')
+        except (IOError, OSError), e:
+            self.logger.warning('Could not write freshness of %s to %s: %s' % (entry['file'], self.log_file, e))
+        return entry
+
+def tracker_from_config(Config, stage, logger):
+    if not platformconfig.get_boolean_option(Config, 'freshness', 'enabled', False):
+        return None
+    return FreshnessTracker(stage, logger,
+        sample_every=platformconfig.get_int_option(Config, 'freshness', 'sample_every', SAMPLE_EVERY),
+        log_file=platformconfig.get_option(Config, 'freshness', 'log_file', LOG_FILE),
+        alert_seconds=platformconfig.get_int_option(Config, 'freshness', 'alert_seconds', 0),
+        alert_percentile=platformconfig.get_int_option(Config, 'freshness', 'alert_percentile', ALERT_PERCENTILE))
+
+def format_seconds(seconds):
+    if seconds is None:
+        return '-'
+    if abs(seconds) < 120:
+        return '%.1fs' % seconds
+    if abs(seconds) < 7200:
+        return '%.1fm' % (seconds / 60.0)
+    return '%.1fh' % (seconds / 3600.0)
+
+# The records of log_file published in the last hours, oldest first
+def read_entries(log_file, hours=None, stage=None):
+    entries = []
+    since = time.time() - hours * 3600 if hours else 0
+    if not os.path.exists(log_file):
+        return entries
+    with open(log_file) as f:
+        for line in f:
+            try:
+                entry = simplejson.loads(line)
+            except ValueError:
+                continue
+            if entry['time'] >= since and (stage is None or entry['stage'] == stage):
+                entries.append(entry)
+    return entries
+
+# {stage: (files, sampled tweets, merged histogram, max lag)}
+def merge_entries(entries):
+    stages = {}
+    for entry in entries:
+        files, sampled, histogram, max_lag = stages.get(entry['stage'], (0, 0, new_histogram(), None))
+        histogram = [total + count for total, count in zip(histogram, entry['histogram'])]
+        stages[entry['stage']] = (files + 1, sampled + entry['sampled'], histogram, max(max_lag, entry['max']))
+    return stages
+
+
+if __name__ == '__main__':
+
+    commands = ['report', 'files', 'check']
+    if len(sys.argv) < 2 or sys.argv[1] not in commands:
+        print "To run: python freshness.py report [hours] [stage]"
+        print "        python freshness.py files [hours] [stage]"
+        print "        python freshness.py check [hours]"
+        sys.exit()
+
+    Config = ConfigParser.ConfigParser()
+    Config.read(PLATFORM_CONFIG_FILE)
+
+    log_file = platformconfig.get_option(Config, 'freshness', 'log_file', LOG_FILE)
+    alert_seconds = platformconfig.get_int_option(Config, 'freshness', 'alert_seconds', 0)
+    alert_percentile = platformconfig.get_int_option(Config, 'freshness', 'alert_percentile', ALERT_PERCENTILE)
+
+    command = sys.argv[1]
+    hours = float(sys.argv[2]) if len(sys.argv) > 2 else 24
+    stage = sys.argv[3] if len(sys.argv) > 3 else None
+    entries = read_entries(log_file, hours, stage)
+
+    if command == 'files':
+        for entry in entries:
+            print '%s %-10s %-50s %7d  p50 %7s  p90 %7s  p99 %7s  max %7s%s' % (time.strftime('%m-%d %H:%M', time.localtime(entry['time'])),
+                entry['stage'], entry['file'], entry['sampled'], format_seconds(entry['p50']), format_seconds(entry['p90']),
+                format_seconds(entry['p99']), format_seconds(entry['max']), '  ALERT' if entry.get('alert') else '')
+        sys.exit()
+
+    stages = merge_entries(entries)
+    over = []
+    print 'Lag from created_at over the last %g hours (histogram bucket upper bounds):' % hours
+    for name in STAGES + sorted(set(stages) - set(STAGES)):
+        if name not in stages:
+            continue
+        files, sampled, histogram, max_lag = stages[name]
+        print '%-10s %5d files %9d sampled  p50 %7s  p90 %7s  p99 %7s  max %7s' % (name, files, sampled,
+            format_seconds(histogram_percentile(histogram, 50, max_lag)), format_seconds(histogram_percentile(histogram, 90, max_lag)),
+            format_seconds(histogram_percentile(histogram, 99, max_lag)), format_seconds(max_lag))
+        if alert_seconds and histogram_percentile(histogram, alert_percentile, max_lag) > alert_seconds:
+            over.append(name)
+
+    if command == 'check' and over:
+        print 'ALERT: p%d lag over %s for %s' % (alert_percentile, format_seconds(alert_seconds), ', '.join(over))
+        sys.exit(1)
@@ -0,0 +1,292 @@
+"""
+	Bulk insert engine for the inserter.
+	Documents are grouped into batches by their encoded size (the length of the
+	processed JSON line is used as the estimate; the BSON can be larger, mostly
+	for arrays of short values, so with Mongo a batch is capped at a quarter of
+	the server's maximum message size) and written with unordered bulk inserts
+	by a small pool of writer threads, so parsing the next batch overlaps with the
+	database writing the previous ones. Writes go through a storage backend
+	(storage.py), Mongo or SQLite. Every batch reports its latency and the index,
+	code and message of each document that failed.
+	Documents keyed on the tweet id make inserts idempotent: duplicate key
+	errors are counted as already present, not as failures. The line up to
+	which every batch has been written is passed to an optional checkpoint
+	function so an interrupted file can be resumed.
+	Documents can be routed to other collections than the engine's own (for
+	time partitioned collections); each collection gets its own batches.
+	An optional on_written(collection_name, docs, skipped_indexes) hook sees every
+	written batch, with the indexes of the documents that were not inserted
+	(failed or already present); the rollups and the freshness tracker use it.
+	Backpressure: add() blocks while the batches queued or being written hold
+	more than max_in_flight_bytes (or number more than max_in_flight), so the
+	reader runs just far enough ahead to keep every writer busy.
+
+"""
+
+import time
+import threading
+import Queue
+
+import platformconfig
+from storage import StorageError
+
+BATCH_BYTES = 8 * 1024 * 1024
+BATCH_DOCS = 10000
+WRITERS = 2
+MAX_IN_FLIGHT = 4
+MAX_IN_FLIGHT_BYTES = 64 * 1024 * 1024
+# failures kept for the end of file report; the rest are only counted
+MAX_FAILURES_KEPT = 1000
+# E11000 and the codes older servers and mongos use for the same thing
+DUPLICATE_KEY_CODES = (11000, 11001, 12582)
+
+
+class PendingBatch(object):
+    def __init__(self, collection_name):
+        self.collection_name = collection_name
+        self.docs = []
+        self.lines = []
+        self.bytes = 0
+
+    def add(self, doc, size, line_number):
+        self.docs.append(doc)
+        self.lines.append(line_number)
+        self.bytes += size
+
+class BulkInsertEngine(object):
+    """ Usage:
+            engine = BulkInsertEngine(tweet_storage, collection_name, logger)
+            for each document: engine.add(doc, len(line), line_number)
+                               or engine.add(doc, len(line), line_number, other_collection_name)
+            stats = engine.close()
+        add() blocks once max_in_flight batches, or max_in_flight_bytes, are
+        queued or being written.
+        checkpoint(line_number) is called, from a writer thread, each time every
+        batch up to line_number has been written.
+    """
+    def __init__(self, tweet_storage, collection_name, logger, batch_bytes=BATCH_BYTES, batch_docs=BATCH_DOCS,
+            writers=WRITERS, max_in_flight=MAX_IN_FLIGHT, max_in_flight_bytes=MAX_IN_FLIGHT_BYTES,
+            label=None, checkpoint=None, on_written=None):
+        self.storage = tweet_storage
+        self.collection_name = collection_name
+        self.logger = logger
+        self.label = label or collection_name
+        self.batch_docs = batch_docs
+        self.batch_bytes = batch_bytes
+        max_batch_bytes = tweet_storage.max_batch_bytes()
+        if max_batch_bytes:
+            self.batch_bytes = min(self.batch_bytes, max_batch_bytes)
+
+        # collection name -> PendingBatch
+        self.pending = {}
+        self.last_line = None
+        self.batch_number = 0
+
+        self.checkpoint = checkpoint
+        self.on_written = on_written
+        self.lock = threading.Lock()
+        # batch number -> (written, through line) for batches finished out of order
+        self.finished = {}
+        self.next_commit = 1
+        self.committed_line = None
+        self.inserted = 0
+        self.duplicates = 0
+        self.failed = 0
+        self.unwritten = 0
+        self.batches = 0
+        self.write_seconds = 0.0
+        self.max_latency = 0.0
+        self.failures = []
+
+        self.max_in_flight_bytes = max_in_flight_bytes
+        self.in_flight_bytes = 0
+        self.in_flight_changed = threading.Condition(threading.Lock())
+        self.wait_seconds = 0.0
+
+        self.queue = Queue.Queue(maxsize=max_in_flight)
+        self.threads = []
+        for i in range(max(writers, 1)):
+            thread = threading.Thread(target=self.writer, name='%s-writer-%d' % (self.label, i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def add(self, doc, size, line_number=None, collection_name=None):
+        if collection_name is None:
+            collection_name = self.collection_name
+        pending = self.pending.get(collection_name)
+        if pending and (pending.bytes + size > self.batch_bytes or len(pending.docs) >= self.batch_docs):
+            self.flush()
+            pending = None
+        if pending is None:
+            pending = self.pending[collection_name] = PendingBatch(collection_name)
+        pending.add(doc, size, line_number)
+        self.last_line = line_number
+
+    # Sends the pending batch of every collection. Only the last batch of the round
+    # carries the line read so far: the checkpoint must not pass it until all of the
+    # round's batches are written.
+    def flush(self):
+        if not self.pending:
+            return
+        names = sorted(self.pending)
+        for name in names:
+            pending = self.pending[name]
+            self.batch_number += 1
+            through_line = self.last_line if name == names[-1] else None
+            start = time.time()
+            with self.in_flight_changed:
+                # a batch bigger than the limit still goes when nothing else is in flight
+                while self.in_flight_bytes and self.in_flight_bytes + pending.bytes > self.max_in_flight_bytes:
+                    self.in_flight_changed.wait()
+                self.in_flight_bytes += pending.bytes
+            self.queue.put((self.batch_number, pending.collection_name, pending.docs, pending.lines, pending.bytes, through_line))
+            self.wait_seconds += time.time() - start
+        self.pending = {}
+
+    # Flushes, waits for every batch to be written and stops the writers.
+    def close(self):
+        self.flush()
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        return self.stats()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'inserted': self.inserted,
+                'duplicates': self.duplicates,
+                'failed': self.failed,
+                'unwritten': self.unwritten,
+                'committed_line': self.committed_line,
+                'batches': self.batches,
+                'write_seconds': self.write_seconds,
+                'wait_seconds': self.wait_seconds,
+                'max_latency': self.max_latency,
+                'failures': list(self.failures)
+                }
+
+    def writer(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                return
+            try:
+                self.write_batch(*batch)
+            except Exception, e:
+                # never let a writer die with batches still queued
+                self.logger.exception('Unexpected error writing batch to %s: %s' % (self.label, e))
+                with self.lock:
+                    if batch[0] >= self.next_commit and batch[0] not in self.finished:
+                        self.unwritten += len(batch[2])
+                        self.advance_checkpoint(batch[0], False, batch[5])
+            with self.in_flight_changed:
+                self.in_flight_bytes -= batch[4]
+                self.in_flight_changed.notify_all()
+
+    def write_batch(self, batch_number, collection_name, docs, line_numbers, batch_bytes, through_line):
+        start = time.time()
+        write_errors = []
+        inserted = 0
+        written = True
+        try:
+            inserted, write_errors = self.storage.insert(collection_name, docs)
+        except StorageError, e:
+            # nothing is known to have been written; the batch holds back the
+            # checkpoint so it is sent again when the file is retried
+            written = False
+            self.logger.warning('Batch %d of %s to %s (%d docs) was not written: %s' % (batch_number, self.label, collection_name, len(docs), e))
+        latency = time.time() - start
+
+        if written and self.on_written:
+            try:
+                self.on_written(collection_name, docs, set(error.get('index') for error in write_errors))
+            except Exception, e:
+                # the batch itself is in; a broken hook must not hold back the checkpoint
+                self.logger.exception('on_written hook failed for batch %d of %s: %s' % (batch_number, self.label, e))
+
+        failures = []
+        duplicates = 0
+        for error in write_errors:
+            if error.get('code') in DUPLICATE_KEY_CODES:
+                duplicates += 1
+                continue
+            index = error.get('index')
+            doc = docs[index] if index is not None and index < len(docs) else {}
+            failures.append({
+                'line': line_numbers[index] if index is not None and index < len(line_numbers) else None,
+                'id_str': doc.get('id_str'),
+                'code': error.get('code'),
+                'errmsg': error.get('errmsg')
+                })
+
+        with self.lock:
+            self.batches += 1
+            self.inserted += inserted
+            self.duplicates += duplicates
+            self.failed += len(failures)
+            if not written:
+                self.unwritten += len(docs)
+            self.write_seconds += latency
+            self.max_latency = max(self.max_latency, latency)
+            self.failures.extend(failures[:max(MAX_FAILURES_KEPT - len(self.failures), 0)])
+            self.advance_checkpoint(batch_number, written, through_line)
+
+        self.logger.info('Batch %d of %s to %s: %d docs, %d bytes, %d inserted, %d already present, %d failed in %.3fs' % (batch_number, self.label, collection_name, len(docs), batch_bytes, inserted, duplicates, len(failures), latency))
+
+    # Called with the lock held. Batches can finish out of order, so the checkpoint
+    # only moves over a run of consecutive written batches.
+    def advance_checkpoint(self, batch_number, written, through_line):
+        self.finished[batch_number] = (written, through_line)
+        committed_line = self.committed_line
+        while self.next_commit in self.finished and self.finished[self.next_commit][0]:
+            through_line = self.finished.pop(self.next_commit)[1]
+            if through_line is not None:
+                committed_line = through_line
+            self.next_commit += 1
+        if committed_line != self.committed_line:
+            self.committed_line = committed_line
+            if self.checkpoint and committed_line is not None:
+                try:
+                    self.checkpoint(committed_line)
+                except (IOError, OSError), e:
+                    self.logger.warning('Could not checkpoint %s at line %d: %s' % (self.label, committed_line, e))
+
+def engine_from_config(Config, tweet_storage, collection_name, logger, label=None, checkpoint=None, on_written=None):
+    return BulkInsertEngine(tweet_storage, collection_name, logger,
+        batch_bytes=platformconfig.get_int_option(Config, 'inserter', 'batch_bytes', BATCH_BYTES),
+        batch_docs=platformconfig.get_int_option(Config, 'inserter', 'batch_docs', BATCH_DOCS),
+        writers=platformconfig.get_int_option(Config, 'inserter', 'writers', WRITERS),
+        max_in_flight=platformconfig.get_int_option(Config, 'inserter', 'max_in_flight', MAX_IN_FLIGHT),
+        max_in_flight_bytes=platformconfig.get_int_option(Config, 'inserter', 'max_in_flight_bytes', MAX_IN_FLIGHT_BYTES),
+        label=label,
+        checkpoint=checkpoint,
+        on_written=on_written)
+
+# One on_written hook calling each of hooks that is not None, or None. A hook that
+# raises is logged under its own name and does not keep the others from the batch.
+def chain_hooks(logger, *hooks):
+    hooks = [hook for hook in hooks if hook]
+    if len(hooks) < 2:
+        return hooks[0] if hooks else None
+    def on_written(collection_name, docs, skipped_indexes):
+        for hook in hooks:
+            try:
+                hook(collection_name, docs, skipped_indexes)
+            except Exception, e:
+                hook_name = getattr(hook, '__name__', hook.__class__.__name__)
+                logger.exception('on_written hook %s failed for %d docs to %s: %s' % (hook_name, len(docs), collection_name, e))
+    return on_written
+
+# Logs the end of file summary and the per-document failures kept by the engine
+def log_engine_stats(stats, label, logger, max_logged=20):
+    average = stats['write_seconds'] / stats['batches'] if stats['batches'] else 0.0
+    logger.info('%s: %d batches, %d inserted, %d already present, %d failed, avg batch latency %.3fs, max %.3fs, %.1fs waiting for writers' % (label, stats['batches'], stats['inserted'], stats['duplicates'], stats['failed'], average, stats['max_latency'], stats['wait_seconds']))
+    if stats['unwritten']:
+        logger.warning('%s: %d documents in batches that could not be written' % (label, stats['unwritten']))
+    for failure in stats['failures'][:max_logged]:
+        logger.warning('%s: insert failed for line %s (id_str %s): code %s, %s' % (label, failure['line'], failure['id_str'], failure['code'], failure['errmsg']))
+    if stats['failed'] > max_logged:
+        logger.warning('%s: %d more failed inserts not logged' % (label, stats['failed'] - max_logged))
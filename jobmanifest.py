@@ -0,0 +1,291 @@
+#-------------------------------------------------------------------------------
+# Name:        Job manifest for the raw and insert queues.
+# Purpose:     Keeps the state of every queued file in a small SQLite table so
+#              the processor and the inserter take the oldest waiting file with
+#              one indexed lookup instead of globbing their directory each loop.
+#
+# A raw file is sealed once the collector has rolled over to the next file,
+# processing while a processor works on it and processed when its output is
+# in the insert queue. That output is queued, inserting while an inserter
+# works on it and done once it is stored (or queued again if some batches
+# could not be written). Each row also has the file's size and when it
+# entered its queue and its current state.
+#
+# The collector records files as it seals them. The directories are still
+# listed every rescan_seconds to pick up files that arrived some other way
+# (quarantine replays, files released by a failed insert, a collector on
+# another box); the workqueue rename remains the claim, so workers on other
+# boxes and the supervisor can share the directories. Done and processed rows
+# are pruned after keep_days.
+#
+# [manifest] enabled turns it on; path names the database (./jobs.sqlite).
+#
+#   python jobmanifest.py status            files, bytes and oldest per state
+#   python jobmanifest.py list <state> [n]  the next n files in a state
+#   python jobmanifest.py sync              record the files in the queues now
+#   python jobmanifest.py prune             drop old done and processed rows
+#-------------------------------------------------------------------------------
+
+import os
+import sys
+import time
+import sqlite3
+import threading
+import ConfigParser
+
+import platformconfig
+import workqueue
+
+PLATFORM_CONFIG_FILE = 'platform.ini'
+MANIFEST_PATH = './jobs.sqlite'
+RESCAN_SECONDS = 300
+KEEP_DAYS = 7
+STATES = ['sealed', 'processing', 'processed', 'queued', 'inserting', 'done']
+# a file that shows up again after reaching one of these is a new job
+FINISHED_STATES = ('processed', 'done')
+# a file listed in its queue under a taken state is only handed out again after
+# this long, so a rescan racing the claim rename does not undo a fresh take
+TAKE_GRACE_SECONDS = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    path TEXT PRIMARY KEY,
+    queue TEXT NOT NULL,
+    state TEXT NOT NULL,
+    size INTEGER,
+    source TEXT,
+    worker TEXT,
+    queued_ts REAL NOT NULL,
+    updated_ts REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_state_queued ON jobs (state, queued_ts, path);
+"""
+
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return None
+
+
+class JobManifest(object):
+    """ The jobs table. Every method is one transaction; each thread gets its own
+        connection and the database runs in WAL mode, so the collector, processors
+        and inserters on one box can share it.
+    """
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.local = threading.local()
+        connection = self.connection()
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.executescript(SCHEMA)
+
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = self.local.connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    def transaction(self):
+        connection = self.connection()
+        connection.execute('BEGIN IMMEDIATE')
+        return connection
+
+    # Records a file unless it is already waiting or taken. Returns True if it was new.
+    def add(self, queue, path, state, queued_ts=None, source=None):
+        connection = self.transaction()
+        try:
+            added = self.record(connection, queue, path, state, queued_ts or time.time(), source)
+            connection.execute('COMMIT')
+        except:
+            connection.execute('ROLLBACK')
+            raise
+        return added
+
+    def record(self, connection, queue, path, state, queued_ts, source=None):
+        now = time.time()
+        size = file_size(path)
+        cursor = connection.execute(
+            'INSERT OR IGNORE INTO jobs (path, queue, state, size, source, queued_ts, updated_ts) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (path, queue, state, size, source, queued_ts, now))
+        if cursor.rowcount:
+            return True
+        cursor = connection.execute('UPDATE jobs SET state = ?, size = ?, source = COALESCE(?, source), worker = NULL, queued_ts = ?, updated_ts = ? WHERE path = ? AND state IN (?, ?)',
+            (state, size, source, queued_ts, now, path) + FINISHED_STATES)
+        return cursor.rowcount > 0
+
+    # Records the files listed in a queue directory that are not known yet, oldest
+    # first by mtime, and hands back the ones a dead worker left in a taken state.
+    # Returns the number of files added.
+    def sync(self, queue, paths, state, taken_state):
+        now = time.time()
+        connection = self.transaction()
+        try:
+            added = 0
+            for path in paths:
+                try:
+                    mtime = os.path.getmtime(path)
+                except OSError:
+                    continue
+                if self.record(connection, queue, path, state, mtime):
+                    added += 1
+                else:
+                    # listed under its queue name, so nobody holds a claim on it
+                    connection.execute('UPDATE jobs SET state = ?, worker = NULL, updated_ts = ? WHERE path = ? AND state = ? AND updated_ts < ?',
+                        (state, now, path, taken_state, now - TAKE_GRACE_SECONDS))
+            connection.execute('COMMIT')
+        except:
+            connection.execute('ROLLBACK')
+            raise
+        return added
+
+    # Moves the oldest file in state to next_state for worker and returns its path,
+    # or None when nothing is waiting.
+    def take(self, state, next_state, worker):
+        connection = self.transaction()
+        try:
+            row = connection.execute('SELECT path FROM jobs WHERE state = ? ORDER BY queued_ts, path LIMIT 1', (state,)).fetchone()
+            if row:
+                connection.execute('UPDATE jobs SET state = ?, worker = ?, updated_ts = ? WHERE path = ?', (next_state, worker, time.time(), row[0]))
+            connection.execute('COMMIT')
+        except:
+            connection.execute('ROLLBACK')
+            raise
+        return row[0] if row else None
+
+    def set_state(self, path, state):
+        self.connection().execute('UPDATE jobs SET state = ?, worker = NULL, size = COALESCE(?, size), updated_ts = ? WHERE path = ?',
+            (state, file_size(path), time.time(), path))
+
+    def forget(self, path):
+        self.connection().execute('DELETE FROM jobs WHERE path = ?', (path,))
+
+    # state -> (files, bytes, oldest queued_ts)
+    def status(self):
+        rows = self.connection().execute('SELECT state, COUNT(*), SUM(size), MIN(queued_ts) FROM jobs GROUP BY state')
+        return dict((state, (files, total or 0, oldest)) for state, files, total, oldest in rows)
+
+    def backlog(self, state, limit=20):
+        return self.connection().execute('SELECT path, size, queued_ts, worker FROM jobs WHERE state = ? ORDER BY queued_ts, path LIMIT ?',
+            (state, limit)).fetchall()
+
+    def prune(self, keep_days):
+        cursor = self.connection().execute("DELETE FROM jobs WHERE state IN ('done', 'processed') AND updated_ts < ?",
+            (time.time() - keep_days * 86400,))
+        return cursor.rowcount
+
+    def close(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
+
+def manifest_from_config(Config, logger=None):
+    if not platformconfig.get_boolean_option(Config, 'manifest', 'enabled', False):
+        return None
+    path = platformconfig.get_option(Config, 'manifest', 'path', MANIFEST_PATH)
+    if logger:
+        logger.info('Using the job manifest in %s' % path)
+    return JobManifest(path)
+
+
+class QueueReader(object):
+    """ Hands out the files of one queue oldest first, through the manifest:
+            reader = QueueReader(manifest, 'raw', directory, lister, 'sealed', 'processing', ...)
+            claimed_name = reader.next_file(worker)
+        lister() lists the queue directory; it is only called every rescan_seconds,
+        after stale claims in the directory are put back (workqueue.reclaim_stale).
+        The file handed out is claimed with workqueue.claim_file as before; a file
+        that is gone (claimed or removed elsewhere) is dropped from the manifest.
+    """
+    def __init__(self, manifest, queue, directory, lister, state, taken_state, lease_seconds, rescan_seconds, keep_days, logger):
+        self.manifest = manifest
+        self.queue = queue
+        self.directory = directory
+        self.lister = lister
+        self.lease_seconds = lease_seconds
+        self.state = state
+        self.taken_state = taken_state
+        self.rescan_seconds = rescan_seconds
+        self.keep_days = keep_days
+        self.logger = logger
+        self.last_scan = None
+
+    def rescan(self):
+        workqueue.reclaim_stale(self.directory, self.lease_seconds, self.logger)
+        added = self.manifest.sync(self.queue, self.lister(), self.state, self.taken_state)
+        pruned = self.manifest.prune(self.keep_days)
+        self.last_scan = time.time()
+        if added or pruned:
+            self.logger.info('Job manifest: %d new %s files, %d old rows pruned' % (added, self.queue, pruned))
+
+    # The oldest waiting file, moved to the taken state for worker but not claimed,
+    # or None. The supervisor hands these to its workers, which claim them.
+    def take_file(self, worker):
+        if self.last_scan is None or time.time() - self.last_scan >= self.rescan_seconds:
+            self.rescan()
+        return self.manifest.take(self.state, self.taken_state, worker)
+
+    def next_file(self, worker):
+        while True:
+            path = self.take_file(worker)
+            if path is None:
+                return None
+            claimed_name = workqueue.claim_file(path, worker)
+            if claimed_name:
+                return claimed_name
+            self.manifest.forget(path)
+
+def queue_reader_from_config(Config, manifest, queue, directory, lister, state, taken_state, logger):
+    return QueueReader(manifest, queue, directory, lister, state, taken_state,
+        workqueue.lease_seconds_from_config(Config),
+        platformconfig.get_int_option(Config, 'manifest', 'rescan_seconds', RESCAN_SECONDS),
+        platformconfig.get_int_option(Config, 'manifest', 'keep_days', KEEP_DAYS),
+        logger)
+
+def format_age(queued_ts, now):
+    if queued_ts is None:
+        return '-'
+    minutes = (now - queued_ts) / 60.0
+    if minutes < 120:
+        return '%.0fm' % minutes
+    return '%.1fh' % (minutes / 60.0)
+
+
+if __name__ == '__main__':
+
+    commands = ['status', 'list', 'sync', 'prune']
+    if len(sys.argv) < 2 or sys.argv[1] not in commands or (sys.argv[1] == 'list' and len(sys.argv) < 3):
+        print "To run: python jobmanifest.py status | sync | prune"
+        print "        python jobmanifest.py list <%s> [n]" % ' | '.join(STATES)
+        sys.exit()
+
+    Config = ConfigParser.ConfigParser()
+    Config.read(PLATFORM_CONFIG_FILE)
+
+    manifest = JobManifest(platformconfig.get_option(Config, 'manifest', 'path', MANIFEST_PATH))
+    command = sys.argv[1]
+    now = time.time()
+
+    if command == 'status':
+        status = manifest.status()
+        print '%-12s %8s %12s %8s' % ('state', 'files', 'MB', 'oldest')
+        for state in STATES:
+            files, total, oldest = status.get(state, (0, 0, None))
+            print '%-12s %8d %12.1f %8s' % (state, files, total / 1048576.0, format_age(oldest, now))
+    elif command == 'list':
+        limit = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+        for path, size, queued_ts, worker in manifest.backlog(sys.argv[2], limit):
+            print '%8s %12s  %s  %s' % (format_age(queued_ts, now), size, path, worker or '')
+    elif command == 'sync':
+        import preprocess
+        import mongoBatchInsert
+        print 'raw: %d new files' % manifest.sync('raw', preprocess.get_tweet_file_queue(Config), 'sealed', 'processing')
+        print 'insert: %d new files' % manifest.sync('insert', mongoBatchInsert.get_processed_tweet_file_queue(Config), 'queued', 'inserting')
+    elif command == 'prune':
+        print 'Pruned %d rows' % manifest.prune(platformconfig.get_int_option(Config, 'manifest', 'keep_days', KEEP_DAYS))
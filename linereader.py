@@ -0,0 +1,101 @@
+#-------------------------------------------------------------------------------
+# Name:        Line reader for raw and processed files.
+# Purpose:     One way to walk the lines of a tweets file by byte offset, for
+#              the processor, the inserter, checkpoints and chunked parallel
+#              work.
+#
+# iter_lines(path, start, end) yields (offset, line) for the lines starting in
+# [start, end), with the line ending left on: simplejson skips the trailing
+# whitespace, so the line goes to the parser as read, without the copy strip()
+# makes. Only lines that go to the quarantine need stripping.
+#
+# iter_mapped(path, start, end) yields (offset, buffer) views of the lines in
+# a memory map of the file, without their line ending and without copying. On
+# Python 2 an mmap has no memoryview, only buffer(), and simplejson wants a str,
+# so this is for consumers that take buffers (hashlib, zlib, file writes,
+# re). Looping in Python over the map is slower per line than the C line
+# iterator of a file object, so iter_lines stays the path for parsing; see
+# python -m benchmarks.bench_linereader.
+#
+# split_chunks(path, chunks) cuts a file into byte ranges that start on line
+# boundaries, for handing parts of one large file to a pool of workers, and
+# LineOffsets keeps the offset after every line read so a checkpoint can record
+# where to resume reading instead of only a line number.
+#-------------------------------------------------------------------------------
+
+import os
+import mmap
+from array import array
+
+
+# The offset of the first line starting at or after offset
+def line_start(f, offset):
+    if offset <= 0:
+        return 0
+    f.seek(offset - 1)
+    f.readline()
+    return f.tell()
+
+def iter_lines(path, start=0, end=None):
+    with open(path, 'rb') as f:
+        offset = line_start(f, start)
+        f.seek(offset)
+        for line in f:
+            if end is not None and offset >= end:
+                break
+            yield offset, line
+            offset += len(line)
+
+def iter_mapped(path, start=0, end=None):
+    size = os.path.getsize(path)
+    if end is None or end > size:
+        end = size
+    if size == 0 or start >= end:
+        return
+    with open(path, 'rb') as f:
+        offset = line_start(f, start)
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        find = mapped.find
+        while offset < end:
+            line_end = find('\n', offset)
+            if line_end < 0:
+                line_end = size
+            length = line_end - offset
+            if length and mapped[line_end - 1] == '\r':
+                length -= 1
+            yield offset, buffer(mapped, offset, length)
+            offset = line_end + 1
+    finally:
+        mapped.close()
+
+# [(start, end), ...] covering the file in up to chunks ranges of about the same size
+def split_chunks(path, chunks):
+    size = os.path.getsize(path)
+    starts = [0]
+    with open(path, 'rb') as f:
+        for i in range(1, chunks):
+            start = line_start(f, size * i / chunks)
+            if starts[-1] < start < size:
+                starts.append(start)
+    return zip(starts, starts[1:] + [size])
+
+
+class LineOffsets(object):
+    """ The offset after each line read, from first_line on:
+            offsets = LineOffsets(resume_line, resume_offset)
+            for offset, line in iter_lines(path, resume_offset):
+                offsets.add(offset + len(line))
+            offsets.offset_after(line_number)
+        Eight bytes a line. add() and offset_after() can be called from
+        different threads.
+    """
+    def __init__(self, first_line=0, first_offset=0):
+        self.first_line = first_line
+        self.ends = array('l', [first_offset])
+
+    def add(self, end_offset):
+        self.ends.append(end_offset)
+
+    def offset_after(self, line_number):
+        return self.ends[line_number - self.first_line]
@@ -21,20 +21,36 @@ import logging.config
 import time
 import glob
 import simplejson
-from pymongo import Connection
 from email.utils import parsedate_tz
 from collections import defaultdict
 import sys
 import traceback
 import string
+import stageprofiler
+from stageprofiler import timer
+import quarantine
+import insertengine
+import platformconfig
+import partitions
+import workqueue
+import rollups
+import storage
+import jobmanifest
+import freshness
+import linereader
 
 
 PLATFORM_CONFIG_FILE = 'platform.ini'
-BATCH_INSERT_SIZE = 1000
+# what happens to stored tweets named by delete notices: remove, tombstone or none
+DELETE_MODES = ['remove', 'tombstone', 'none']
+DELETE_MODE = 'tombstone'
+DELETE_BATCH = 1000
+UPDATE_BATCH = 1000
+# field updates written by backfill.py are queued as *-update-<tweets_file>_processed
+UPDATE_MARK = '-update-'
+CHECKPOINT_EXTENSION = '.progress'
 
-connection = Connection()
-db = connection.config
-mongo_config = db.config
+logger = logging.getLogger('mongo_insert')
 
 # function goes out and gets a list of raw tweet data files
 def get_processed_tweet_file_queue(Config):
@@ -56,28 +72,340 @@ def get_processed_tweet_file_queue(Config):
     return final_insert_queue_file_list
 
 
-# function goes out and gets a list of raw tweet data files
-def insert_tweet_list(mongoCollection, tweets_list, line_number, processedTweetsFile):
+# The checkpoint of a queued file holds the line up to which every batch has been
+# written to mongo, and the byte offset after it, so a restarted inserter can seek
+# straight past them. Checkpoints with only a line number are still read. With a
+# checkpoint_dir the checkpoint is kept there instead of next to the file.
+def checkpoint_file_name(processedTweetsFile, checkpoint_dir=None):
+    # kept under the queue name so it survives the file being reclaimed
+    queuedFile = workqueue.unclaimed_name(processedTweetsFile)
+    if checkpoint_dir:
+        return os.path.join(checkpoint_dir, os.path.basename(queuedFile) + CHECKPOINT_EXTENSION)
+    return queuedFile + CHECKPOINT_EXTENSION
 
-    inserted_ids_list = []
-    # mongo_error_code = -1
+# Returns (line, offset after it); the offset is None for a line only checkpoint
+def read_checkpoint(processedTweetsFile, checkpoint_dir=None):
     try:
-        # this call returns a list of ids
-        inserted_ids_list = mongoCollection.insert(tweets_list, continue_on_error=True)
-        #mongo_error_code = mongoCollection.error()
-        mongo_error_code = data_db.error()
-
-        if mongo_error_code is not None:
-            logger.warning("Error %d on mongo insert for (%s)" % (mongo_error_code, processedTweetsFile))
-
-    except ValueError, e:
-        print "Exception during mongo insert"
-        logger.warning("Exception during mongo insert at or before file line number %d (%s)" % (line_number, processedTweetsFile))
-        logging.exception(e)
-        print traceback.format_exc()
-        pass
-
-    return inserted_ids_list
+        with open(checkpoint_file_name(processedTweetsFile, checkpoint_dir)) as f:
+            fields = [int(field) for field in f.read().split()]
+    except (IOError, ValueError):
+        return 0, None
+    if not fields:
+        return 0, None
+    return fields[0], fields[1] if len(fields) > 1 else None
+
+# line_offsets is the linereader.LineOffsets of the lines being read, if any
+def checkpoint_writer(processedTweetsFile, line_offsets=None, checkpoint_dir=None):
+    checkpoint_file = checkpoint_file_name(processedTweetsFile, checkpoint_dir)
+    def write_checkpoint(line_number):
+        with open(checkpoint_file + '.tmp', 'w') as f:
+            if line_offsets:
+                f.write('%d %d\n' % (line_number, line_offsets.offset_after(line_number)))
+            else:
+                f.write('%d\n' % line_number)
+        os.rename(checkpoint_file + '.tmp', checkpoint_file)
+    return write_checkpoint
+
+# Removes the queue file and its checkpoint once everything in it is in mongo; a file
+# with batches that could not be written goes back in the queue and is resumed next time.
+# keep_input leaves the file itself in place (bulkload.py loads archived files).
+def finish_queued_file(processedTweetsFile, stats, logger, keep_input=False, checkpoint_dir=None):
+    if stats['unwritten']:
+        logger.warning('%d documents of %s were not written, leaving it queued to resume after line %s' % (stats['unwritten'], processedTweetsFile, stats['committed_line'] or 0))
+        if workqueue.is_claimed(processedTweetsFile):
+            workqueue.release_file(processedTweetsFile)
+        return False
+    if not keep_input:
+        os.remove(processedTweetsFile)
+    checkpoint_file = checkpoint_file_name(processedTweetsFile, checkpoint_dir)
+    if os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
+    return True
+
+# Applies a batch of deleted status ids to the stored tweets, either removing the
+# tweets or marking them deleted, in whichever collection (or partition) the router
+# puts each id. Returns the number of stored tweets matched.
+def apply_deletions(router, status_ids, delete_mode, logger):
+
+    if not status_ids or delete_mode == 'none':
+        return 0
+
+    ids_by_collection = defaultdict(list)
+    for status_id in status_ids:
+        ids_by_collection[router.collection_for_id(status_id)].append(status_id)
+
+    matched = 0
+    for name, collection_ids in ids_by_collection.items():
+        try:
+            matched += router.storage.delete(name, collection_ids, delete_mode)
+        except storage.StorageError, e:
+            logger.warning('Could not apply %d deletions to %s: %s' % (len(collection_ids), name, e))
+
+    return matched
+
+# Inserts one processed delete status file: the notices are bulk inserted into the
+# storage's DELETES collection and the tweets they refer to are removed from, or
+# tombstoned in, collection_name, or its partitions, in batches of delete_batch ids
+# ([inserter] delete_mode).
+# Returns (lines read, notices inserted, notices lost, stored tweets matched).
+def insert_delete_file(Config, processedTweetsFile, tweet_storage, tweet_quarantine, logger, profiler=None, keep_input=False, checkpoint_dir=None):
+
+    # the file's name in the queue, if a worker has claimed it
+    queuedFile = workqueue.unclaimed_name(processedTweetsFile)
+
+    delete_mode = platformconfig.get_option(Config, 'inserter', 'delete_mode', DELETE_MODE)
+    if delete_mode not in DELETE_MODES:
+        logger.warning('Unknown delete_mode %s, using %s' % (delete_mode, DELETE_MODE))
+        delete_mode = DELETE_MODE
+    delete_batch = platformconfig.get_int_option(Config, 'inserter', 'delete_batch', DELETE_BATCH)
+
+    collection_name = Config.get('collection', 'collection_name', 0)
+    router = partitions.router_from_config(Config, tweet_storage, collection_name, logger)
+    if delete_mode != 'none' and router.mode == 'none' and router.create_indexes:
+        # a no-op once the index exists; partitions get theirs from the router
+        tweet_storage.ensure_indexes(collection_name, ['id_str'])
+
+    # every line is read again for its status id, so only the line number is used
+    resume_after = read_checkpoint(queuedFile, checkpoint_dir)[0]
+    if resume_after:
+        logger.info('Resuming %s after line %d' % (queuedFile, resume_after))
+    engine = insertengine.engine_from_config(Config, tweet_storage, storage.DELETES, logger, label=os.path.basename(queuedFile),
+        checkpoint=checkpoint_writer(queuedFile, checkpoint_dir=checkpoint_dir))
+
+    lost_notices = 0
+    line_number = 0
+    matched = 0
+    status_ids = []
+
+    for offset, line in linereader.iter_lines(processedTweetsFile):
+        try:
+            line_number += 1
+            notice = simplejson.loads(line)
+            status = notice['delete']['status']
+            # deletions are cheap to apply twice, so they are not checkpointed
+            status_ids.append(status['id_str'])
+            if line_number > resume_after:
+                # keyed on the deleted status so a resent notice is not stored twice
+                notice['_id'] = status['id']
+                engine.add(notice, len(line), line_number)
+        except (ValueError, TypeError, KeyError), e:
+            lost_notices += 1
+            tweet_quarantine.add(queuedFile, line_number, e, line.strip())
+
+        if len(status_ids) >= delete_batch:
+            if profiler: stage_t = timer()
+            matched += apply_deletions(router, status_ids, delete_mode, logger)
+            if profiler: profiler.add_batch('apply_deletions', stage_t)
+            status_ids = []
+
+    if profiler: stage_t = timer()
+    matched += apply_deletions(router, status_ids, delete_mode, logger)
+    if profiler: profiler.add_batch('apply_deletions', stage_t)
+
+    if profiler: stage_t = timer()
+    stats = engine.close()
+    if profiler: profiler.add_batch('insert_drain', stage_t)
+    insertengine.log_engine_stats(stats, queuedFile, logger)
+    lost_notices += stats['failed']
+
+    finish_queued_file(processedTweetsFile, stats, logger, keep_input, checkpoint_dir)
+
+    tweet_quarantine.file_summary(queuedFile)
+    print 'Inserted %d delete statuses for file %s, %d stored tweets matched.' % (stats['inserted'], queuedFile, matched)
+    logger.info('Inserted %d delete statuses (%d lost) for file %s; delete_mode %s matched %d stored tweets' % (stats['inserted'], lost_notices, queuedFile, delete_mode, matched))
+
+    return line_number, stats['inserted'], lost_notices, matched
+
+# Sets the fields of a batch of stored tweets, grouped by collection (or partition).
+# Returns (stored tweets matched, updates that could not be written).
+def apply_updates(tweet_storage, updates_by_collection, logger):
+    matched = 0
+    unwritten = 0
+    for name, updates in updates_by_collection.items():
+        try:
+            matched += tweet_storage.update(name, updates)
+        except storage.StorageError, e:
+            logger.warning('Could not apply %d updates to %s: %s' % (len(updates), name, e))
+            unwritten += len(updates)
+    return matched, unwritten
+
+# Applies one field update file written by backfill.py. Each line is
+#   {"update": {"id": ..., "id_str": "...", "created_ts": "2014-08-27 13:00:05", "set": {field: value}}}
+# and the fields are set on the stored tweet with that id_str, in the collection (or
+# partition) its created_ts routes to, update_batch tweets at a time. Setting a field twice is
+# harmless, so there is no checkpoint: a file with updates that could not be written
+# stays queued and is applied again.
+# Returns (lines read, stored tweets matched, lines lost).
+def insert_update_file(Config, processedTweetsFile, tweet_storage, tweet_quarantine, logger, profiler=None, keep_input=False):
+
+    # the file's name in the queue, if a worker has claimed it
+    queuedFile = workqueue.unclaimed_name(processedTweetsFile)
+
+    update_batch = platformconfig.get_int_option(Config, 'inserter', 'update_batch', UPDATE_BATCH)
+    collection_name = Config.get('collection', 'collection_name', 0)
+    router = partitions.router_from_config(Config, tweet_storage, collection_name, logger)
+    if router.mode == 'none' and router.create_indexes:
+        # a no-op once the index exists; partitions get theirs from the router
+        tweet_storage.ensure_indexes(collection_name, ['id_str'])
+
+    lost_lines = 0
+    line_number = 0
+    matched = 0
+    unwritten = 0
+    pending = 0
+    updates_by_collection = defaultdict(list)
+
+    for offset, line in linereader.iter_lines(processedTweetsFile):
+        try:
+            line_number += 1
+            update = simplejson.loads(line)['update']
+            created_ts = datetime.strptime(update['created_ts'], '%Y-%m-%d %H:%M:%S')
+            updates_by_collection[router.collection_for(created_ts)].append((update['id_str'], update['set']))
+            pending += 1
+        except (ValueError, TypeError, KeyError), e:
+            lost_lines += 1
+            tweet_quarantine.add(queuedFile, line_number, e, line.strip())
+
+        if pending >= update_batch:
+            if profiler: stage_t = timer()
+            batch_matched, batch_unwritten = apply_updates(tweet_storage, updates_by_collection, logger)
+            if profiler: profiler.add_batch('apply_updates', stage_t)
+            matched += batch_matched
+            unwritten += batch_unwritten
+            updates_by_collection = defaultdict(list)
+            pending = 0
+
+    if profiler: stage_t = timer()
+    batch_matched, batch_unwritten = apply_updates(tweet_storage, updates_by_collection, logger)
+    if profiler: profiler.add_batch('apply_updates', stage_t)
+    matched += batch_matched
+    unwritten += batch_unwritten
+
+    finish_queued_file(processedTweetsFile, {'unwritten': unwritten, 'committed_line': None}, logger, keep_input)
+
+    tweet_quarantine.file_summary(queuedFile)
+    logger.info('Applied %d field updates (%d lost, %d not written) for file %s, %d stored tweets matched' % (line_number - lost_lines, lost_lines, unwritten, queuedFile, matched))
+
+    return line_number, matched, lost_lines
+
+# Inserts one processed tweets file into the storage backend (collection_name, or its
+# partitions) through the bulk insert engine; update files from backfill.py go to
+# insert_update_file, delete
+# status files are handed to insert_delete_file and lines that cannot be parsed go to
+# the quarantine. Tweets are keyed on their id, so resending a tweet is harmless, and
+# the file is checkpointed as batches are written: a file interrupted part way is
+# resumed after its last fully written batch, and the file is only removed once all
+# of it is stored. With keep_input the file is left in place and the checkpoint is
+# kept in checkpoint_dir.
+# Returns (lines read, tweets inserted, tweets lost).
+def insert_processed_file(Config, processedTweetsFile, tweet_storage, tweet_quarantine, logger, profiler=None, keep_input=False, checkpoint_dir=None):
+
+    # the file's name in the queue, if a worker has claimed it
+    queuedFile = workqueue.unclaimed_name(processedTweetsFile)
+
+    if UPDATE_MARK in os.path.basename(queuedFile):
+        line_number, matched, lost_lines = insert_update_file(Config, processedTweetsFile, tweet_storage, tweet_quarantine, logger, profiler=profiler,
+            keep_input=keep_input)
+        if profiler:
+            profiler.report(logger, queuedFile)
+        return line_number, matched, lost_lines
+
+    if 'delete' in queuedFile:
+        cprofile = stageprofiler.start_cprofile(Config, queuedFile)
+        line_number, tweet_total, lost_tweets, matched = insert_delete_file(Config, processedTweetsFile, tweet_storage, tweet_quarantine, logger, profiler=profiler,
+            keep_input=keep_input, checkpoint_dir=checkpoint_dir)
+        if cprofile:
+            stageprofiler.stop_cprofile(cprofile, Config, queuedFile, logger)
+        if profiler:
+            profiler.report(logger, queuedFile)
+        return line_number, tweet_total, lost_tweets
+
+    tweet_total = 0
+    lost_tweets = 0
+    line_number = 0
+
+    cprofile = stageprofiler.start_cprofile(Config, queuedFile)
+
+    resume_after, resume_offset = read_checkpoint(queuedFile, checkpoint_dir)
+    if resume_after:
+        logger.info('Resuming %s after line %d' % (queuedFile, resume_after))
+    if resume_offset is not None:
+        # seek straight to the first unwritten line
+        line_number = resume_after
+    else:
+        resume_offset = 0
+    line_offsets = linereader.LineOffsets(line_number, resume_offset)
+    # [rollups] enabled keeps the hourly rollups up to date with every written batch, and
+    # [freshness] enabled measures the lag from created_at to the commit of the batch
+    collection_name = Config.get('collection', 'collection_name', 0)
+    tracker = freshness.tracker_from_config(Config, 'inserter', logger)
+    engine = insertengine.engine_from_config(Config, tweet_storage, collection_name, logger, label=os.path.basename(queuedFile),
+        checkpoint=checkpoint_writer(queuedFile, line_offsets, checkpoint_dir),
+        on_written=insertengine.chain_hooks(logger, rollups.rollup_writer_from_config(Config, tweet_storage, logger), tracker))
+    # with collection_partition set, tweets go to the collection of their day or month
+    router = partitions.router_from_config(Config, tweet_storage, collection_name, logger)
+
+    for offset, line in linereader.iter_lines(processedTweetsFile, resume_offset):
+        try:
+            line_number += 1
+            line_offsets.add(offset + len(line))
+            if line_number <= resume_after:
+                continue
+
+            # print line_number
+
+            prof = profiler.sample() if profiler else None
+            if prof: stage_t = timer()
+
+            tweet = simplejson.loads(line)
+
+            if prof: stage_t = prof.add('loads', stage_t)
+
+            # now, when we did the process tweet step we already worked with
+            # these dates. If they failed before, they shouldn't file now, but
+            # if they do we are going to skip this tweet and go on to the next one
+            t = to_datetime(tweet['created_at'])
+            tweet['created_ts'] = t
+
+            t = to_datetime(tweet['user']['created_at'])
+            tweet['user']['created_ts'] = t
+
+            tweet['_id'] = tweet['id']
+
+            if prof: stage_t = prof.add('to_datetime', stage_t)
+
+            # the line length stands in for the encoded size of the document
+            engine.add(tweet, len(line), line_number, router.collection_for(tweet['created_ts']))
+
+            if prof: prof.add('enqueue', stage_t)
+
+        except (ValueError, TypeError, KeyError), e:
+            lost_tweets += 1
+            tweet_quarantine.add(queuedFile, line_number, e, line.strip())
+
+    # wait for the batches still queued or being written
+    if profiler: stage_t = timer()
+    stats = engine.close()
+    if profiler: profiler.add_batch('insert_drain', stage_t)
+
+    insertengine.log_engine_stats(stats, queuedFile, logger)
+    lost_tweets += stats['failed']
+    tweet_total += stats['inserted']
+
+    # make sure we clean up after ourselves
+    finish_queued_file(processedTweetsFile, stats, logger, keep_input, checkpoint_dir)
+
+    tweet_quarantine.file_summary(queuedFile)
+    logger.info('Read %d lines, inserted %d tweets, lost %d tweets for file %s' % (line_number, tweet_total, lost_tweets, queuedFile))
+    if tracker:
+        tracker.file_done(queuedFile)
+
+    if cprofile:
+        stageprofiler.stop_cprofile(cprofile, Config, queuedFile, logger)
+    if profiler:
+        profiler.report(logger, queuedFile)
+
+    return line_number, tweet_total, lost_tweets
 
 # Parse Twitter created_at datestring and turn it into
 def to_datetime(datestring):
@@ -116,143 +444,66 @@ if __name__ == '__main__':
 
     logger.info('Starting process to insert processed tweets in mongo')
 
-    error_tweet = open("error_inserted_tweet.txt", "a")
+    # mongo, or sqlite for a single node ([storage] backend)
+    tweet_storage = storage.storage_from_config(Config, logger)
 
-    collectionName = Config.get('collection', 'name', 0)
-    dbName = Config.get('collection', 'db_name', 0)
-    dbCollectionName = Config.get('collection', 'collection_name', 0)
+    tweet_quarantine = quarantine.quarantine_from_config(Config, 'insert', logger)
 
-    # this is the mongo db we will store data in
-    data_db = connection[dbName]
-    mongoCollection = data_db[dbCollectionName]
+    mongoConfigs = tweet_storage.get_flags('inserter')
+    runMongoInsert = mongoConfigs['run']
 
-    delete_db = connection[dbName + '-delete']
-    deleteCollection = delete_db['tweets']
+    profiler = stageprofiler.profiler_from_config(Config, 'mongo_insert')
 
-    mongoConfigs = mongo_config.find_one({"module" : "inserter"})
-    runMongoInsert = mongoConfigs['run']
+    # any number of inserters can share the queue; each claims the file it works on
+    worker = workqueue.worker_id()
+    lease_seconds = workqueue.lease_seconds_from_config(Config)
+    insert_queue_path = Config.get('files', 'tweet_insert_queue', 0)
+    logger.info('Inserter worker %s' % worker)
+
+    # [manifest] enabled: take the oldest queued file from the job manifest instead
+    # of listing the insert queue every loop
+    manifest = jobmanifest.manifest_from_config(Config, logger)
+    if manifest:
+        insert_reader = jobmanifest.queue_reader_from_config(Config, manifest, 'insert', insert_queue_path,
+            lambda: get_processed_tweet_file_queue(Config), 'queued', 'inserting', logger)
 
     while runMongoInsert:
-        queued_tweets_file_list = get_processed_tweet_file_queue(Config)
-        num_files_in_queue = len(queued_tweets_file_list)
-        #logger.info('Queue length %d' % num_files_in_queue)
+        if manifest:
+            claimedFile = insert_reader.next_file(worker)
+        else:
+            # files claimed by workers that died go back in the queue
+            workqueue.reclaim_stale(insert_queue_path, lease_seconds, logger)
+
+            queued_tweets_file_list = sorted(get_processed_tweet_file_queue(Config))
+            num_files_in_queue = len(queued_tweets_file_list)
+            #logger.info('Queue length %d' % num_files_in_queue)
+
+            claimedFile = workqueue.claim_first(queued_tweets_file_list, worker)
 
         # TODO - end on zero?
-        if (num_files_in_queue == 0):
+        if claimedFile is None:
             time.sleep( 180 )
         else:
-            processedTweetsFile = queued_tweets_file_list[0]
-            logger.info('Mongo insert file found: %s' % processedTweetsFile)
-
-            tweets_list = []
-            tweet_total = 0
-            lost_tweets = 0
-            line_number = 0
-            deleted_tweets = 0
-            deleted_tweets_list = []
-
-            # lame workaround, but for now we assume it will take less than a minute to
-            # copy a file so this next sleep is here to wait for a copy to finish on the
-            # off chance that we happy to see it just as it is being copied to the directory
-            time.sleep( 60 )
-
-            with open(processedTweetsFile) as f:
-                for line in f:
-                    if 'delete' not in processedTweetsFile:
-                        try:
-                            line_number += 1
-                            line = line.strip()
-
-                            # print line_number
-
-                            tweet = simplejson.loads(line)
-
-                            # now, when we did the process tweet step we already worked with
-                            # these dates. If they failed before, they shouldn't file now, but
-                            # if they do we are going to skip this tweet and go on to the next one
-                            t = to_datetime(tweet['created_at'])
-                            tweet['created_ts'] = t
-
-                            t = to_datetime(tweet['user']['created_at'])
-                            tweet['user']['created_ts'] = t
-
-                            tweets_list.append(tweet)
-
-                        except ValueError, e:
-                            lost_tweets += 1
-                            print "ValueError while converting date. tweet not processed: %d (%s)" % (line_number, processedTweetsFile)
-                            logger.warning("ValueError while converting date. tweet not processed: %d (%s)" % (line_number, processedTweetsFile))
-                            logging.exception(e)
-                            error_tweet.write(line+"\n")
-                            print traceback.format_exc()
-                            pass
-                        except TypeError, e:
-                            lost_tweets += 1
-                            print "TypeError while converting date. tweet not processed: %d (%s)" % (line_number, processedTweetsFile)
-                            logger.warning("TypeError while converting date. tweet not processed: %d (%s)" % (line_number, processedTweetsFile))
-                            logging.exception(e)
-                            error_tweet.write(line+"\n")
-                            print traceback.format_exc()
-                            pass
-                        except KeyError, e:
-                            lost_tweets += 1
-                            print "KeyError while converting date. tweet not processed: %d (%s)" % (line_number, processedTweetsFile)
-                            logger.warning("KeyError while converting date. tweet not processed: %d (%s)" % (line_number, processedTweetsFile))
-                            logging.exception(e)
-                            error_tweet.write(line+"\n")
-                            print traceback.format_exc()
-                            pass
-
-                        if len(tweets_list) == BATCH_INSERT_SIZE:
-
-                            print 'Inserting batch at file line %d' % line_number
-                            inserted_ids_list = insert_tweet_list(mongoCollection, tweets_list, line_number, processedTweetsFile)
-
-                            failed_insert_count = BATCH_INSERT_SIZE - len(inserted_ids_list)
-                            logger.info('Batch of size %d had %d failed tweet inserts' % (BATCH_INSERT_SIZE, failed_insert_count))
-                            tweets_list = []
-
-                            lost_tweets = lost_tweets + failed_insert_count
-                            tweet_total += len(inserted_ids_list)
-                            #print "inserting 5k tweets - %i total" % tweet_total
-                    else:
-                        deleted_tweets += 1
-
-                        line = line.strip()
-                        tweet = simplejson.loads(line)
-                        deleted_tweets_list.append(tweet)
-
-                        inserted_ids_list = insert_tweet_list(deleteCollection, deleted_tweets_list, line_number, processedTweetsFile)
-                        deleted_tweets_list = []
-
-            if 'delete' in processedTweetsFile:
-                print 'Inserted %d delete statuses for file %s.' % (deleted_tweets, processedTweetsFile)
-                logger.info('Inserted %d delete statuses for file %s.' % (deleted_tweets, processedTweetsFile))
-
-
-            # make sure we clean up after ourselves
-            f.close()
-            os.remove(processedTweetsFile)
-
-            if len(tweets_list) > 0:
-
-                print 'Inserting last set of %d tweets at file line %d' % (len(tweets_list), line_number)
-                inserted_ids_list = insert_tweet_list(mongoCollection, tweets_list, line_number, processedTweetsFile)
-
-                failed_insert_count = len(tweets_list) - len(inserted_ids_list)
-                logger.info('Insert set of size %d had %d failed tweet inserts' % (len(tweets_list), failed_insert_count) )
-                tweets_list = []
-
-                lost_tweets = lost_tweets + failed_insert_count
-                tweet_total += len(inserted_ids_list)
-
-            logger.info('Read %d lines, inserted %d tweets, lost %d tweets for file %s' % (line_number, tweet_total, lost_tweets, processedTweetsFile))
-
-
-        mongoConfigs = mongo_config.find_one({"module" : "inserter"})
+            logger.info('Mongo insert file claimed: %s' % claimedFile)
+
+            with workqueue.Lease(claimedFile, lease_seconds, logger):
+                # lame workaround, but for now we assume it will take less than a minute to
+                # copy a file so this next sleep is here to wait for a copy to finish on the
+                # off chance that we happy to see it just as it is being copied to the directory
+                time.sleep( 60 )
+
+                insert_processed_file(Config, claimedFile, tweet_storage, tweet_quarantine, logger, profiler=profiler)
+
+            if manifest:
+                # still in the queue when some batches could not be written
+                queuedFile = workqueue.unclaimed_name(claimedFile)
+                manifest.set_state(queuedFile, 'queued' if os.path.exists(queuedFile) else 'done')
+
+
+        mongoConfigs = tweet_storage.get_flags('inserter')
         runMongoInsert = mongoConfigs['run']
         # end run loop
 
-    error_tweet.close()
+    tweet_quarantine.close()
     logger.info('Exiting MongoBatchInsert Program...')
     print 'Exiting MongoBatchInsert Program...'
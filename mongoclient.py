@@ -0,0 +1,98 @@
+"""
+	The Mongo client shared by the collector, processor and inserter.
+	Nothing connects at import time: the client is created on first use, with
+	the host, pool size, timeouts and write concern from the optional [mongo]
+	section of platform.ini, so the processing code can be imported, tested
+	and benchmarked without a mongod.
+
+	Entry points call configure(Config) once the config is read and then use
+	get_client(), or the lazy stand-ins client and config_collection for
+	module level names that used to hold a connection.
+
+"""
+
+import threading
+
+import pymongo
+
+import platformconfig
+
+HOST = 'localhost'
+PORT = 27017
+
+_config = None
+_client = None
+_lock = threading.Lock()
+
+
+def configure(Config):
+    global _config
+    _config = Config
+
+# (host, port, keyword arguments for MongoClient) from the [mongo] section
+def client_options(Config):
+    if Config is None:
+        return HOST, PORT, {}
+    host = platformconfig.get_option(Config, 'mongo', 'host', HOST)
+    port = platformconfig.get_int_option(Config, 'mongo', 'port', PORT)
+    options = {}
+    for option, keyword in [('max_pool_size', 'max_pool_size'),
+                            ('connect_timeout_ms', 'connectTimeoutMS'),
+                            ('socket_timeout_ms', 'socketTimeoutMS'),
+                            ('wait_queue_timeout_ms', 'waitQueueTimeoutMS'),
+                            ('w', 'w')]:
+        if Config.has_option('mongo', option):
+            options[keyword] = Config.getint('mongo', option)
+    if Config.has_option('mongo', 'journal'):
+        options['j'] = Config.getboolean('mongo', 'journal')
+    return host, port, options
+
+# The shared client, connecting on the first call. Config, if given, is used in
+# place of the one passed to configure().
+def get_client(Config=None):
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                host, port, options = client_options(Config or _config)
+                _client = pymongo.MongoClient(host, port, **options)
+    return _client
+
+def close_client():
+    global _client
+    with _lock:
+        if _client is not None:
+            _client.close()
+            _client = None
+
+# For a forked child: drops the parent's client without closing the sockets the
+# parent still uses. The child connects again on first use.
+def forget_client():
+    global _client, _lock
+    _client = None
+    _lock = threading.Lock()
+
+class LazyClient(object):
+    """ Behaves like the shared client, which is only created when first used. """
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(get_client(), name)
+
+    def __getitem__(self, name):
+        return get_client()[name]
+
+class LazyCollection(object):
+    """ Behaves like get_client()[db_name][collection_name]. """
+    def __init__(self, db_name, collection_name):
+        self.db_name = db_name
+        self.collection_name = collection_name
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(get_client()[self.db_name][self.collection_name], name)
+
+client = LazyClient()
+# the module flags (run, collect, update) all scripts poll
+config_collection = LazyCollection('config', 'config')
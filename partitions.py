@@ -0,0 +1,187 @@
+#-------------------------------------------------------------------------------
+# Name:        Time partitioned tweet collections.
+# Purpose:     Routes tweets by created_ts into per-day or per-month collections
+#              named <collection_name>_YYYYMMDD or <collection_name>_YYYYMM, and
+#              reads back across them.
+#
+# With [collection] collection_partition set to day or month the inserter
+# writes each tweet to the partition of its created_ts. Partitions get the
+# secondary indexes (SECONDARY_INDEXES) when the inserter first writes to
+# them, unless [inserter] bulk_load is set; see bulkload.py.
+#
+# Delete notices only carry the tweet id. Ids issued since November 2010
+# encode their creation time, which is used to find the partition among the
+# existing ones; deletes of other tweets go to the base collection.
+#
+# Reading, e.g. all tweets with a hashtag in August 2014:
+#   for tweet in partitions.find_across(db, 'tweets', {'hashtags': 'syr'},
+#                                       datetime(2014, 8, 1), datetime(2014, 9, 1)):
+#-------------------------------------------------------------------------------
+
+import re
+from datetime import datetime, timedelta
+
+import pymongo
+from pymongo.errors import OperationFailure
+
+import platformconfig
+
+PARTITION_MODES = ['none', 'day', 'month']
+PARTITION_FORMATS = {'day': '%Y%m%d', 'month': '%Y%m'}
+SECONDARY_INDEXES = ['created_ts', 'hashtags', 'mentions', 'track_kw.text', 'track_kw.hashtags', 'track_kw.mentions', 'id_str']
+
+# ms since the unix epoch of the first snowflake id; ids below FIRST_SNOWFLAKE_ID
+# were issued sequentially and carry no time
+TWITTER_EPOCH_MS = 1288834974657
+FIRST_SNOWFLAKE_ID = 29700859247
+
+
+def partition_mode_from_config(Config, logger=None):
+    mode = platformconfig.get_option(Config, 'collection', 'collection_partition', 'none')
+    if mode not in PARTITION_MODES:
+        if logger:
+            logger.warning('Unknown collection_partition %s, not partitioning' % mode)
+        mode = 'none'
+    return mode
+
+def partition_name(base_name, created_ts, mode):
+    if mode == 'none' or created_ts is None:
+        return base_name
+    return '%s_%s' % (base_name, created_ts.strftime(PARTITION_FORMATS[mode]))
+
+def snowflake_datetime(tweet_id):
+    tweet_id = int(tweet_id)
+    if tweet_id < FIRST_SNOWFLAKE_ID:
+        return None
+    ms = (tweet_id >> 22) + TWITTER_EPOCH_MS
+    return datetime.utcfromtimestamp(ms / 1000.0)
+
+# Start and end (exclusive) of the period a partition name covers, or None for
+# names that are not partitions of base_name.
+def partition_period(base_name, name):
+    match = re.match('^%s_(\d{8}|\d{6})$' % re.escape(base_name), name)
+    if not match:
+        return None
+    suffix = match.group(1)
+    if len(suffix) == 8:
+        start = datetime.strptime(suffix, PARTITION_FORMATS['day'])
+        return start, start + timedelta(days=1)
+    start = datetime.strptime(suffix, PARTITION_FORMATS['month'])
+    if start.month == 12:
+        return start, start.replace(year=start.year + 1, month=1)
+    return start, start.replace(month=start.month + 1)
+
+
+class CollectionRouter(object):
+    """ Picks the collection name each document goes to in a storage backend
+        (storage.py), ensuring the secondary indexes of a partition the first
+        time it is used.
+    """
+    def __init__(self, tweet_storage, collection_name, mode, logger, create_indexes=True):
+        self.storage = tweet_storage
+        self.collection_name = collection_name
+        self.mode = mode
+        self.logger = logger
+        self.create_indexes = create_indexes
+        self.collections = set([collection_name])
+        self.existing = None
+
+    def collection_for(self, created_ts):
+        name = partition_name(self.collection_name, created_ts, self.mode)
+        if name not in self.collections:
+            self.collections.add(name)
+            if self.create_indexes:
+                self.storage.ensure_indexes(name, SECONDARY_INDEXES)
+                self.logger.info('Ensured indexes on %s' % name)
+        return name
+
+    # For delete notices: the existing partition the tweet with this id was written
+    # to, or the base collection. Never creates a partition; the partitions are
+    # listed once per router.
+    def collection_for_id(self, tweet_id):
+        if self.mode == 'none':
+            return self.collection_name
+        created_ts = snowflake_datetime(tweet_id)
+        if created_ts is None:
+            return self.collection_name
+        if self.existing is None:
+            self.existing = partition_collections(self.storage, self.collection_name)[1:]
+        name = partition_name(self.collection_name, created_ts, self.mode)
+        if name in self.existing:
+            return name
+        # partitions written under another collection_partition mode
+        for name in self.existing:
+            start, end = partition_period(self.collection_name, name)
+            if start <= created_ts < end:
+                return name
+        return self.collection_name
+
+def router_from_config(Config, tweet_storage, collection_name, logger):
+    bulk_load = platformconfig.get_boolean_option(Config, 'inserter', 'bulk_load', False)
+    return CollectionRouter(tweet_storage, collection_name, partition_mode_from_config(Config, logger), logger, create_indexes=not bulk_load)
+
+def ensure_indexes(collection, logger):
+    for field in SECONDARY_INDEXES:
+        collection.ensure_index(field)
+    logger.info('Ensured indexes on %s' % collection.name)
+
+# Drops the SECONDARY_INDEXES of a collection, leaving _id and any other index.
+def drop_secondary_indexes(collection, logger):
+    index_information = collection.index_information()
+    dropped = 0
+    for name, info in index_information.items():
+        if len(info['key']) == 1 and info['key'][0][0] in SECONDARY_INDEXES:
+            collection.drop_index(name)
+            dropped += 1
+    logger.info('Dropped %d secondary indexes on %s' % (dropped, collection.name))
+    return dropped
+
+# Builds all SECONDARY_INDEXES with a single createIndexes command, which newer
+# servers build in one pass over the collection; older servers get one
+# ensure_index per field.
+def rebuild_indexes(collection, logger):
+    indexes = [{'key': {field: pymongo.ASCENDING}, 'name': '%s_1' % field} for field in SECONDARY_INDEXES]
+    try:
+        collection.database.command('createIndexes', collection.name, indexes=indexes)
+    except OperationFailure, e:
+        logger.info('createIndexes not available on %s (%s), building indexes one at a time' % (collection.name, e))
+        ensure_indexes(collection, logger)
+    logger.info('Rebuilt indexes on %s' % collection.name)
+
+# Names of the base collection and its partitions that may hold tweets created in
+# [start, end), oldest first. The base collection, which holds whatever was written
+# before partitioning was turned on, is always included. database is a pymongo
+# database or a storage backend (storage.py).
+def partition_collections(database, base_name, start=None, end=None):
+    partitions = []
+    for name in database.collection_names():
+        period = partition_period(base_name, name)
+        if period is None:
+            continue
+        if (start is not None and period[1] <= start) or (end is not None and period[0] >= end):
+            continue
+        partitions.append((period[0], name))
+    return [base_name] + [name for period_start, name in sorted(partitions)]
+
+def time_spec(spec, start, end):
+    spec = dict(spec or {})
+    created_ts = {}
+    if start is not None:
+        created_ts['$gte'] = start
+    if end is not None:
+        created_ts['$lt'] = end
+    if created_ts:
+        spec['created_ts'] = created_ts
+    return spec
+
+# Runs the same find on every collection of the time range, yielding documents
+# collection by collection. Extra keyword arguments go to find().
+def find_across(database, base_name, spec=None, start=None, end=None, **kwargs):
+    spec = time_spec(spec, start, end)
+    for name in partition_collections(database, base_name, start, end):
+        for doc in database[name].find(spec, **kwargs):
+            yield doc
+
+def count_across(database, base_name, spec=None, start=None, end=None):
+    spec = time_spec(spec, start, end)
+    return sum(database[name].find(spec).count() for name in partition_collections(database, base_name, start, end))
@@ -0,0 +1,27 @@
+"""
+	Helpers for reading optional items from the platform config file.
+	Newer settings are optional so that existing platform.ini files keep working;
+	these return the given default when the section or option is missing.
+
+"""
+
+
+def get_option(Config, section, option, default=None):
+    if Config.has_option(section, option):
+        return Config.get(section, option, 0)
+    return default
+
+def get_int_option(Config, section, option, default=0):
+    if Config.has_option(section, option):
+        return Config.getint(section, option)
+    return default
+
+def get_float_option(Config, section, option, default=0.0):
+    if Config.has_option(section, option):
+        return Config.getfloat(section, option)
+    return default
+
+def get_boolean_option(Config, section, option, default=False):
+    if Config.has_option(section, option):
+        return Config.getboolean(section, option)
+    return default
@@ -11,7 +11,6 @@
 
 import os.path
 import ConfigParser
-from pymongo import Connection
 import datetime
 import logging
 import logging.config
@@ -27,14 +26,24 @@ import re
 import traceback
 import shutil
 import tweetprocessing
+import platformconfig
+import columnararchive
+import tweetindex
+import tweetnetwork
+import sketches
+import stageprofiler
+import storage
+from stageprofiler import timer
+import quarantine
+import workqueue
+import jobmanifest
+import freshness
+import linereader
 
 PLATFORM_CONFIG_FILE = 'platform.ini'
 EXPAND_URLS = False
 
-#connect to mongo
-connection = Connection()
-db = connection.config
-mongo_config = db.config
+logger = logging.getLogger('preprocess')
 
 # function goes out and gets a list of raw tweet data files
 def get_tweet_file_queue(Config):
@@ -65,8 +74,8 @@ def get_tweet_file_queue(Config):
     currentTweetFileList = [s.replace('\\', '/') for s in currentTweetFileList]
 
     # this line removes the current live file from the list
-    for item in currentTweetFileList:
-        if item in tweetsFileList: tweetsFileList.remove(item)
+    currentTweetFiles = set(currentTweetFileList)
+    tweetsFileList = [item for item in tweetsFileList if item not in currentTweetFiles]
 
     return tweetsFileList
 
@@ -92,11 +101,137 @@ def queue_up_processed_tweets (Config, processed_tweets_file, logger):
 
     queued_up_tweets_file = processed_tweets_file.replace(tweet_archive_dir, tweet_insert_queue_path)
 
-    shutil.copyfile(processed_tweets_file, queued_up_tweets_file)
+    # copy under a name the inserters do not look for, then rename into the queue, so
+    # an inserter never claims a half copied file
+    shutil.copyfile(processed_tweets_file, queued_up_tweets_file + '.copying')
+    os.rename(queued_up_tweets_file + '.copying', queued_up_tweets_file)
 
     #os.symlink(processed_tweets_file, queued_up_tweets_file)
 
     logger.info('Queued up %s to %s' % (processed_tweets_file, queued_up_tweets_file))
+    return queued_up_tweets_file
+
+# Builds the list of extra outputs fed with every processed tweet of a raw file.
+# Each sink has add(tweet, offset), offset being where the tweet's line starts in
+# processed_tweets_file, and close(), which is called once the file is done.
+def open_tweet_sinks (Config, rawTweetsFile, processed_tweets_file, logger):
+
+    sinks = []
+
+    columnar_dir = platformconfig.get_option(Config, 'files', 'columnar_archive_dir')
+    if columnar_dir:
+        requested_format = platformconfig.get_option(Config, 'files', 'columnar_format', 'auto')
+        columnar_format = columnararchive.resolve_format(requested_format)
+        if columnar_format is None:
+            logger.warning('Columnar archive disabled: no library available for format %s' % requested_format)
+        else:
+            sinks.append(columnararchive.ColumnarArchiveWriter(columnar_dir, columnar_format, rawTweetsFile, logger))
+
+    index_writer = tweetindex.index_writer_from_config(Config, processed_tweets_file, logger)
+    if index_writer:
+        sinks.append(index_writer)
+
+    network_writer = tweetnetwork.network_writer_from_config(Config, processed_tweets_file, logger)
+    if network_writer:
+        sinks.append(network_writer)
+
+    sketch_writer = sketches.sketch_writer_from_config(Config, processed_tweets_file, logger)
+    if sketch_writer:
+        sinks.append(sketch_writer)
+
+    return sinks
+
+# Runs every line of a raw tweets file through process_tweet, writing the results to
+# processed_tweets_file and to any configured tweet sinks. Lines that fail go to the
+# quarantine. Returns (processed, lost).
+def process_raw_file (Config, rawTweetsFile, processed_tweets_file, track_list, tweet_quarantine, logger, rt_cache=None, profiler=None):
+
+    # the file's name in the raw directory, if a worker has claimed it
+    sourceFile = workqueue.unclaimed_name(rawTweetsFile)
+
+    f_out = open(processed_tweets_file,'w')
+
+    tweet_sinks = open_tweet_sinks(Config, sourceFile, processed_tweets_file, logger)
+
+    # [freshness] enabled: the lag of the tweets from created_at to the processed file
+    tracker = freshness.tracker_from_config(Config, 'processor', logger)
+
+    cprofile = stageprofiler.start_cprofile(Config, sourceFile)
+
+    # [processing] splice_output: splice the derived fields into the raw line
+    # instead of encoding every tweet again
+    splice_output = platformconfig.get_boolean_option(Config, 'processing', 'splice_output', False)
+
+    tweet_total = 0
+    lost_tweets = 0
+    line_number = 0
+    out_offset = 0
+    # {sink class name: tweets it failed on}
+    sink_errors = {}
+
+    for offset, line in linereader.iter_lines(rawTweetsFile):
+
+        try:
+            line_number += 1
+
+            prof = profiler.sample() if profiler else None
+            if prof: stage_t = timer()
+
+            if splice_output:
+                tweet, tweet_out_string = tweetprocessing.process_line(line, track_list, expand_url=EXPAND_URLS, rt_cache=rt_cache, profiler=prof)
+                if prof: stage_t = timer()
+            else:
+                tweet = simplejson.loads(line)
+                if prof: prof.add('loads', stage_t)
+                tweet = tweetprocessing.enrich_tweet(tweet, track_list, expand_url=EXPAND_URLS, rt_cache=rt_cache, profiler=prof)
+                if prof: stage_t = timer()
+                tweet_out_string = tweetprocessing.tweet_to_string(tweet)
+                if prof: stage_t = prof.add('dumps', stage_t)
+            f_out.write(tweet_out_string)
+            tweet_offset = out_offset
+            out_offset += len(tweet_out_string)
+            if prof: stage_t = prof.add('write', stage_t)
+            # the tweet is written: a failing sink only loses its own output
+            for sink in tweet_sinks:
+                try:
+                    sink.add(tweet, tweet_offset)
+                except Exception, e:
+                    sink_name = sink.__class__.__name__
+                    if sink_name not in sink_errors:
+                        logger.warning('%s failed at line %d of %s: %s' % (sink_name, line_number, sourceFile, e), exc_info=True)
+                    sink_errors[sink_name] = sink_errors.get(sink_name, 0) + 1
+            if tracker: tracker.add(tweet)
+            if prof and tweet_sinks: prof.add('sinks', stage_t)
+            tweet_total += 1
+            # print tweet_out_string
+
+        except (ValueError, TypeError, KeyError), e:
+            lost_tweets += 1
+            tweet_quarantine.add(sourceFile, line_number, e, line.strip())
+
+    f_out.close()
+
+    for sink in tweet_sinks:
+        sink.close()
+    for sink_name in sorted(sink_errors):
+        logger.warning('%s failed on %d tweets of %s' % (sink_name, sink_errors[sink_name], sourceFile))
+
+    if tracker:
+        tracker.handled()
+        tracker.file_done(sourceFile)
+
+    if cprofile:
+        stageprofiler.stop_cprofile(cprofile, Config, sourceFile, logger)
+
+    tweet_quarantine.file_summary(sourceFile)
+    logger.info('Tweets processed: %d, lost: %d' % (tweet_total, lost_tweets))
+    if profiler:
+        profiler.report(logger, sourceFile)
+    if rt_cache is not None:
+        logger.info('%s for %s' % (rt_cache.stats_string(), sourceFile))
+        rt_cache.reset_stats()
+
+    return tweet_total, lost_tweets
 
 def archive_processed_file (Config, rawTweetsFile, logger):
 
@@ -105,7 +240,7 @@ def archive_processed_file (Config, rawTweetsFile, logger):
     if not os.path.exists(tweet_archive_dir):
         os.makedirs(tweet_archive_dir)
 
-    archive_raw_tweets_file = rawTweetsFile.replace(tweetsOutFilePath, tweet_archive_dir)
+    archive_raw_tweets_file = workqueue.unclaimed_name(rawTweetsFile).replace(tweetsOutFilePath, tweet_archive_dir)
 
     shutil.move(rawTweetsFile, archive_raw_tweets_file)
 
@@ -144,13 +279,38 @@ if __name__ == '__main__':
 
     logger.info('Starting preprocess system')
 
-    error_tweet = open("error_tweet.txt", "a")
+    # the run flag lives in the storage backend, mongo unless [storage] says sqlite
+    tweet_storage = storage.storage_from_config(Config, logger)
+
+    tweet_quarantine = quarantine.quarantine_from_config(Config, 'preprocess', logger)
     # collectionName = Config.get('collection', 'name', 0)
 
-    mongoConfigs = mongo_config.find_one({"module" : "processor"})
+    mongoConfigs = tweet_storage.get_flags('processor')
     runPreProcessor = mongoConfigs['run']
     #runPreProcessor = True
 
+    # Lives across files so retweets of the same original in consecutive files also hit
+    retweet_cache_size = platformconfig.get_int_option(Config, 'processing', 'retweet_cache_size', tweetprocessing.RETWEET_CACHE_SIZE)
+    if retweet_cache_size > 0:
+        rt_cache = tweetprocessing.RetweetCache(retweet_cache_size)
+    else:
+        rt_cache = None
+
+    profiler = stageprofiler.profiler_from_config(Config, 'preprocess')
+
+    # any number of processors can share the raw directory; each claims the file it works on
+    worker = workqueue.worker_id()
+    lease_seconds = workqueue.lease_seconds_from_config(Config)
+    raw_tweets_file_path = Config.get('files', 'raw_tweets_file_path', 0)
+    logger.info('Preprocess worker %s' % worker)
+
+    # [manifest] enabled: take the oldest sealed file from the job manifest instead
+    # of listing the raw directory every loop
+    manifest = jobmanifest.manifest_from_config(Config, logger)
+    if manifest:
+        raw_reader = jobmanifest.queue_reader_from_config(Config, manifest, 'raw', raw_tweets_file_path,
+            lambda: get_tweet_file_queue(Config), 'sealed', 'processing', logger)
+
     if runPreProcessor:
         print 'Starting runPreProcessor'
         logger.info('Preprocess start signal')
@@ -163,81 +323,47 @@ if __name__ == '__main__':
             track_list = f.read().splitlines()
 
 
-        tweetsFileList = get_tweet_file_queue(Config)
-        files_in_queue = len(tweetsFileList)
+        if manifest:
+            rawTweetsFile = raw_reader.next_file(worker)
+            files_in_queue = manifest.status().get('sealed', (0,))[0]
+        else:
+            # files claimed by workers that died go back in the queue
+            workqueue.reclaim_stale(raw_tweets_file_path, lease_seconds, logger)
+
+            tweetsFileList = sorted(get_tweet_file_queue(Config))
+            files_in_queue = len(tweetsFileList)
+
+            rawTweetsFile = workqueue.claim_first(tweetsFileList, worker)
 
         # TODO - Confirm loop time for checking files
         # --Base off of hour format in log?
-        if files_in_queue < 1:
+        if rawTweetsFile is None:
             time.sleep( 180 )
         else:
             logger.info('Queue length is %d' % files_in_queue)
-            rawTweetsFile = tweetsFileList[0]
             logger.info('Preprocess raw file: %s' % rawTweetsFile)
 
-            processed_tweets_file = get_processed_tweets_file_name (Config, rawTweetsFile)
-
-            # TODO - Dynamic copy time
-            # lame workaround, but for now we assume it will take less than a minute to
-            # copy a file so this next sleep is here to wait for a copy to finish on the
-            # off chance that we happy to see it just as it is being copied to the directory
-            time.sleep( 60 )
-
-            f_out = open(processed_tweets_file,'w')
-
-            tweets_list = []
-            tweet_total = 0
-            lost_tweets = 0
-            line_number = 0
-
-            with open(rawTweetsFile) as f:
-                for line in f:
-
-                    try:
-                        line_number += 1
-                        line = line.strip()
-
-                        tweet_out_string = tweetprocessing.process_tweet(line, track_list, expand_url=EXPAND_URLS)
-                        f_out.write(tweet_out_string)
-                        tweet_total += 1
-                        # print tweet_out_string
-
-                    except ValueError, e:
-                        lost_tweets += 1
-                        print "ValueError. tweet not processed: %d (%s)" % (line_number, rawTweetsFile)
-                        logger.warning("tweet not processed: %d (%s)" % (line_number, rawTweetsFile))
-                        logging.exception(e)
-                        error_tweet.write(line+"\n")
-                        print traceback.format_exc()
-                        pass
-                    except TypeError, e:
-                        lost_tweets += 1
-                        print "TypeError. tweet not processed: %d (%s)" % (line_number, rawTweetsFile)
-                        logger.warning("tweet not processed: %d (%s)" % (line_number, rawTweetsFile))
-                        logging.exception(e)
-                        error_tweet.write(line+"\n")
-                        print traceback.format_exc()
-                        pass
-                    except KeyError, e:
-                        lost_tweets += 1
-                        print "KeyError. tweet not processed: %d (%s)" % (line_number, rawTweetsFile)
-                        logger.warning("tweet not processed: %d (%s)" % (line_number, rawTweetsFile))
-                        logging.exception(e)
-                        error_tweet.write(line+"\n")
-                        print traceback.format_exc()
-                        pass
-
-            f_out.close()
-            f.close()
-
-            logger.info('Tweets processed: %d, lost: %d' % (tweet_total, lost_tweets))
-
-            archive_processed_file (Config, rawTweetsFile, logger)
-            queue_up_processed_tweets (Config, processed_tweets_file, logger)
+            processed_tweets_file = get_processed_tweets_file_name (Config, workqueue.unclaimed_name(rawTweetsFile))
+
+            with workqueue.Lease(rawTweetsFile, lease_seconds, logger):
+                # TODO - Dynamic copy time
+                # lame workaround, but for now we assume it will take less than a minute to
+                # copy a file so this next sleep is here to wait for a copy to finish on the
+                # off chance that we happy to see it just as it is being copied to the directory
+                time.sleep( 60 )
+
+                process_raw_file(Config, rawTweetsFile, processed_tweets_file, track_list, tweet_quarantine, logger, rt_cache=rt_cache, profiler=profiler)
+
+                queued_tweets_file = queue_up_processed_tweets (Config, processed_tweets_file, logger)
+                archive_processed_file (Config, rawTweetsFile, logger)
+
+            if manifest:
+                manifest.set_state(workqueue.unclaimed_name(rawTweetsFile), 'processed')
+                manifest.add('insert', queued_tweets_file, 'queued', source=workqueue.unclaimed_name(rawTweetsFile))
 
         exception = None
         try:
-            mongoConfigs = mongo_config.find_one({"module" : "processor"})
+            mongoConfigs = tweet_storage.get_flags('processor')
             runPreProcessor = mongoConfigs['run']
         # If mongo is unavailable, decrement processing loop by 2 sec.
         # increments until connection is re-established.
@@ -248,7 +374,7 @@ if __name__ == '__main__':
             runLoopSleep += 2
             time.sleep(runLoopSleep)
 
-    error_tweet.close()
+    tweet_quarantine.close()
     logger.info('Exiting preprocessor Program...')
     print 'Exiting preprocessor Program...'
 
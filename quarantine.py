@@ -0,0 +1,221 @@
+#-------------------------------------------------------------------------------
+# Name:        Quarantine for malformed tweets.
+# Purpose:     Keeps the lines the processor or inserter could not handle in
+#              per-file sidecars, with rate limited logging, and replays them
+#              in bulk once the cause is fixed.
+#
+# Each source file gets its own sidecar, <quarantine_dir>/<file name>.quarantine,
+# holding one JSON record per bad line:
+#   {"stage": "preprocess", "file": ..., "line": 12, "error": "KeyError",
+#    "message": "'user'", "raw": "<the original line>"}
+# Lines that are not valid UTF-8 are kept byte for byte in "raw_base64" instead.
+#
+# Logging is aggregated per source file: the first few bad lines are logged
+# (with a traceback for the first of each error class), the rest are only
+# counted, and a single summary line is written when the file is done.
+#
+# To replay quarantined lines:
+#   python quarantine.py replay <sidecar> [<sidecar> ...]
+# Lines that now go through are written to the insert queue as
+# replay-<YYYYmmddHHMMSS>-<original name>_processed.json; lines that still
+# fail stay in the sidecar. backfill.py keeps its sidecars in
+# <quarantine_dir>/backfill/ and its lines are replayed like the processor's.
+#-------------------------------------------------------------------------------
+
+import os.path
+import sys
+import time
+import base64
+import logging
+import ConfigParser
+import simplejson
+
+import platformconfig
+
+PLATFORM_CONFIG_FILE = 'platform.ini'
+QUARANTINE_DIR = './quarantine/'
+MAX_LOGGED_PER_FILE = 5
+SIDECAR_EXTENSION = '.quarantine'
+# stages that quarantine raw lines
+PROCESSING_STAGES = ['preprocess', 'backfill']
+
+
+class Quarantine(object):
+    def __init__(self, quarantine_dir, stage, logger, max_logged_per_file=MAX_LOGGED_PER_FILE):
+        self.quarantine_dir = quarantine_dir
+        self.stage = stage
+        self.logger = logger
+        self.max_logged_per_file = max_logged_per_file
+        self.sidecars = {}
+        self.error_counts = {}
+
+    def sidecar_name(self, source_file):
+        return os.path.join(self.quarantine_dir, os.path.basename(source_file) + SIDECAR_EXTENSION)
+
+    # Call from inside the except block so the traceback is available
+    def add(self, source_file, line_number, error, line):
+        exc_info = sys.exc_info()
+        sidecar = self.sidecars.get(source_file)
+        if sidecar is None:
+            if not os.path.exists(self.quarantine_dir):
+                os.makedirs(self.quarantine_dir)
+            sidecar = self.sidecars[source_file] = open(self.sidecar_name(source_file), 'a')
+        record = {
+            'stage': self.stage,
+            'file': source_file,
+            'line': line_number,
+            'error': error.__class__.__name__,
+            'message': error_message(error)
+            }
+        try:
+            record['raw'] = line.decode('utf-8')
+        except UnicodeDecodeError:
+            record['raw_base64'] = base64.b64encode(line)
+        sidecar.write(simplejson.dumps(record) + '\n')
+
+        counts = self.error_counts.setdefault(source_file, {})
+        error_class = error.__class__.__name__
+        first_of_class = error_class not in counts
+        counts[error_class] = counts.get(error_class, 0) + 1
+        if sum(counts.itervalues()) <= self.max_logged_per_file:
+            self.logger.warning('%s at line %d of %s, quarantined: %s' % (error_class, line_number, source_file, error_message(error)),
+                exc_info=exc_info if first_of_class else None)
+
+    # Logs one summary line for the file and closes its sidecar. Returns the number of bad lines.
+    def file_summary(self, source_file):
+        sidecar = self.sidecars.pop(source_file, None)
+        if sidecar is not None:
+            sidecar.close()
+        counts = self.error_counts.pop(source_file, {})
+        bad_lines = sum(counts.itervalues())
+        if bad_lines:
+            by_class = ', '.join('%s x%d' % (error_class, counts[error_class]) for error_class in sorted(counts))
+            suppressed = max(bad_lines - self.max_logged_per_file, 0)
+            self.logger.warning('%d lines of %s quarantined to %s (%s; %d not logged individually)' % (bad_lines, source_file, self.sidecar_name(source_file), by_class, suppressed))
+        return bad_lines
+
+    def close(self):
+        for source_file in self.sidecars.keys():
+            self.file_summary(source_file)
+
+def error_message(error):
+    try:
+        return unicode(error)
+    except UnicodeError:
+        return repr(error)
+
+def record_line(record):
+    if 'raw_base64' in record:
+        return base64.b64decode(record['raw_base64'])
+    return record['raw'].encode('utf-8')
+
+# Stages other than the processor and inserter keep their sidecars in a
+# subdirectory named after the stage, since they read the same source files
+def quarantine_from_config(Config, stage, logger):
+    quarantine_dir = platformconfig.get_option(Config, 'files', 'quarantine_dir', QUARANTINE_DIR)
+    if stage not in ('preprocess', 'insert'):
+        quarantine_dir = os.path.join(quarantine_dir, stage)
+    max_logged = platformconfig.get_int_option(Config, 'processing', 'max_logged_errors_per_file', MAX_LOGGED_PER_FILE)
+    return Quarantine(quarantine_dir, stage, logger, max_logged)
+
+def read_sidecar(sidecar_file):
+    with open(sidecar_file) as f:
+        return [simplejson.loads(line) for line in f if line.strip()]
+
+# A new name on every replay, so a replay never overwrites the file of an
+# earlier one that is still queued
+def replay_output_name(Config, source_file):
+    insert_queue_path = Config.get('files', 'tweet_insert_queue', 0)
+    file_name = os.path.basename(source_file)
+    if '_processed' not in file_name:
+        file_extension = os.path.splitext(file_name)[1]
+        file_name = file_name.replace(file_extension, '_processed' + file_extension)
+    stamp = time.strftime('%Y%m%d%H%M%S')
+    counter = 0
+    while True:
+        prefix = 'replay%s-%s-' % ('-%d' % counter if counter else '', stamp)
+        out_name = os.path.join(insert_queue_path, prefix + file_name)
+        if not os.path.exists(out_name) and not os.path.exists(out_name + '.replaying'):
+            return out_name
+        counter += 1
+
+# Re-runs every record of a sidecar through its stage. Records from the processor
+# or the backfill (raw lines) go through process_tweet again, records from the
+# inserter are re-checked the way the inserter parses them.
+# Returns (replayed, still failing).
+def replay_sidecar(Config, sidecar_file, track_list, logger):
+    import tweetprocessing
+
+    records = read_sidecar(sidecar_file)
+    if not records:
+        return 0, 0
+    source_file = records[0]['file']
+    out_name = replay_output_name(Config, source_file)
+    tmp_name = out_name + '.replaying'
+
+    replayed = 0
+    failing = []
+    with open(tmp_name, 'w') as f_out:
+        for record in records:
+            line = record_line(record)
+            try:
+                if record['stage'] in PROCESSING_STAGES:
+                    f_out.write(tweetprocessing.process_tweet(line, track_list))
+                else:
+                    tweet = simplejson.loads(line)
+                    if 'delete' not in source_file:
+                        tweetprocessing.to_datetime(tweet['created_at'])
+                        tweetprocessing.to_datetime(tweet['user']['created_at'])
+                    f_out.write(line + '\n')
+                replayed += 1
+            except (ValueError, TypeError, KeyError), e:
+                record['error'] = e.__class__.__name__
+                record['message'] = error_message(e)
+                failing.append(record)
+
+    # the queue globs for *_processed.json, so only show the file once complete
+    if replayed:
+        os.rename(tmp_name, out_name)
+    else:
+        os.remove(tmp_name)
+
+    if failing:
+        with open(sidecar_file + '.tmp', 'w') as f:
+            for record in failing:
+                f.write(simplejson.dumps(record) + '\n')
+        os.rename(sidecar_file + '.tmp', sidecar_file)
+    else:
+        os.remove(sidecar_file)
+
+    logger.info('Replayed %d lines of %s to %s, %d still failing' % (replayed, sidecar_file, out_name, len(failing)))
+    return replayed, len(failing)
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 3 or sys.argv[1] != 'replay':
+        print "To run: python quarantine.py replay <sidecar> [<sidecar> ...]"
+        sys.exit()
+
+    Config = ConfigParser.ConfigParser()
+    Config.read(PLATFORM_CONFIG_FILE)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s', datefmt='%m-%d %H:%M')
+    logger = logging.getLogger('quarantine')
+
+    termsListFile = Config.get('files', 'terms_file', 0)
+    with open(termsListFile) as f:
+        track_list = f.read().splitlines()
+
+    insert_queue_path = Config.get('files', 'tweet_insert_queue', 0)
+    if not os.path.exists(insert_queue_path):
+        os.makedirs(insert_queue_path)
+
+    total_replayed = 0
+    total_failing = 0
+    for sidecar_file in sys.argv[2:]:
+        replayed, failing = replay_sidecar(Config, sidecar_file, track_list, logger)
+        total_replayed += replayed
+        total_failing += failing
+
+    print 'Replayed %d lines, %d still failing' % (total_replayed, total_failing)
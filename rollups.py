@@ -0,0 +1,201 @@
+#-------------------------------------------------------------------------------
+# Name:        Hourly rollups.
+# Purpose:     Pre-aggregated counts for the dashboards, maintained by the
+#              inserter so they do not have to scan the tweets collection.
+#
+# One document per hour, kind and key in the rollup collection (by default
+# <collection_name>_rollups_hourly in db_name):
+#   {"_id": "2014082713|hashtag|syracuse", "hour": ISODate("2014-08-27T13:00:00"),
+#    "kind": "hashtag", "key": "syracuse", "count": 42}
+# Kinds are track_kw (tweets matching a track keyword anywhere), hashtag,
+# mention and total. The total document of an hour (key "") also sums
+# retweets and the tweets' counts fields (urls, hashtags, user_mentions,
+# coded_urls).
+#
+# The inserter merges the counters of every written batch in memory and
+# applies them with one bulk of $inc upserts through the storage backend
+# (storage.py); top() and hourly() read the Mongo collection. Only tweets that were actually
+# inserted are counted, so resending a file does not count it twice. Deleted
+# tweets are not taken off.
+#
+# To regenerate the rollups from the processed files in tweet_archive_dir and
+# the processed segments archivecompactor.py made of them:
+#   python rollups.py rebuild
+#-------------------------------------------------------------------------------
+
+import os
+import sys
+import glob
+import time
+import logging
+import ConfigParser
+from datetime import datetime
+from collections import defaultdict
+
+import simplejson
+import platformconfig
+import storage
+import archivecompactor
+
+PLATFORM_CONFIG_FILE = 'platform.ini'
+ROLLUP_SUFFIX = '_rollups_hourly'
+
+
+def rollups_enabled(Config):
+    return platformconfig.get_boolean_option(Config, 'rollups', 'enabled', False)
+
+def rollup_collection_name(Config):
+    default_name = Config.get('collection', 'collection_name', 0) + ROLLUP_SUFFIX
+    return platformconfig.get_option(Config, 'rollups', 'collection', default_name)
+
+def rollup_collection(Config, database):
+    return database[rollup_collection_name(Config)]
+
+# created_ts is a datetime in the inserter and a '%Y-%m-%d %H:%M:%S' string in
+# the processed files
+def tweet_hour(created_ts):
+    if isinstance(created_ts, basestring):
+        return datetime.strptime(created_ts[:13], '%Y-%m-%d %H')
+    return created_ts.replace(minute=0, second=0, microsecond=0)
+
+def rollup_id(hour, kind, key):
+    return u'%s|%s|%s' % (hour.strftime('%Y%m%d%H'), kind, key)
+
+
+class RollupCounters(object):
+    """ Counters merged in memory: (hour, kind, key) -> {field: increment}. """
+    def __init__(self):
+        self.counters = defaultdict(lambda: defaultdict(int))
+
+    def __len__(self):
+        return len(self.counters)
+
+    def add(self, tweet):
+        hour = tweet_hour(tweet['created_ts'])
+
+        total = self.counters[(hour, 'total', u'')]
+        total['count'] += 1
+        if 'retweeted_status' in tweet:
+            total['retweets'] += 1
+        for field, value in tweet.get('counts', {}).iteritems():
+            total['counts.' + field] += value
+
+        for hashtag in tweet.get('hashtags', []):
+            self.counters[(hour, 'hashtag', hashtag)]['count'] += 1
+        for mention in tweet.get('mentions', []):
+            self.counters[(hour, 'mention', mention)]['count'] += 1
+
+        keywords = set()
+        for matched in tweet.get('track_kw', {}).itervalues():
+            keywords.update(matched)
+        for keyword in keywords:
+            self.counters[(hour, 'track_kw', keyword)]['count'] += 1
+
+    # Applies the counters to the named collection with one bulk of $inc upserts.
+    # Returns the number of rollup documents touched.
+    def write(self, tweet_storage, name):
+        if not self.counters:
+            return 0
+        tweet_storage.increment(name, [(rollup_id(hour, kind, key), dict(increments), {'hour': hour, 'kind': kind, 'key': key})
+            for (hour, kind, key), increments in self.counters.iteritems()])
+        written = len(self.counters)
+        self.counters.clear()
+        return written
+
+
+class RollupWriter(object):
+    """ Hooked into the insert engine as on_written: counts the tweets of each
+        written batch that were inserted, skipping the ones that failed or were
+        already there. Called from the engine's writer threads.
+    """
+    def __init__(self, tweet_storage, name, logger):
+        self.storage = tweet_storage
+        self.name = name
+        self.logger = logger
+
+    def __call__(self, collection_name, docs, skipped_indexes):
+        counters = RollupCounters()
+        for index, doc in enumerate(docs):
+            if index not in skipped_indexes:
+                counters.add(doc)
+        try:
+            counters.write(self.storage, self.name)
+        except storage.StorageError, e:
+            self.logger.warning('Could not update rollups in %s for a batch of %d tweets: %s' % (self.name, len(docs), e))
+
+def rollup_writer_from_config(Config, tweet_storage, logger):
+    if not rollups_enabled(Config):
+        return None
+    name = rollup_collection_name(Config)
+    tweet_storage.ensure_indexes(name, [[('kind', 1), ('hour', 1)]])
+    return RollupWriter(tweet_storage, name, logger)
+
+def aggregate_rows(result):
+    # pymongo 2.x returns the server reply, newer drivers a cursor
+    if isinstance(result, dict):
+        return result['result']
+    return list(result)
+
+# The n keys of a kind with the highest count in [start, end), as (key, count).
+def top(collection, kind, start, end, n=10):
+    result = collection.aggregate([
+        {'$match': {'kind': kind, 'hour': {'$gte': start, '$lt': end}}},
+        {'$group': {'_id': '$key', 'count': {'$sum': '$count'}}},
+        {'$sort': {'count': -1}},
+        {'$limit': n}
+        ])
+    return [(row['_id'], row['count']) for row in aggregate_rows(result)]
+
+# Hourly counts of one key (e.g. a track keyword) in [start, end), as (hour, count).
+def hourly(collection, kind, key, start, end):
+    cursor = collection.find({'kind': kind, 'hour': {'$gte': start, '$lt': end}, 'key': key}).sort('hour', 1)
+    return [(doc['hour'], doc['count']) for doc in cursor]
+
+# Drops the rollups and recounts every processed file in the archive, compacted or not.
+def rebuild(Config, tweet_storage, logger):
+    name = rollup_collection_name(Config)
+    tweet_storage.drop(name)
+    tweet_storage.ensure_indexes(name, [[('kind', 1), ('hour', 1)]])
+
+    tweet_archive_dir = Config.get('files', 'tweet_archive_dir', 0)
+    archive_files = sorted(glob.glob(os.path.join(tweet_archive_dir, '*_processed.json')))
+    archive_files = [f for f in archive_files if 'delete' not in os.path.basename(f)]
+    segments = archivecompactor.list_segments(archivecompactor.ArchiveSettings(Config), 'processed')
+    tweets = 0
+    start = time.time()
+    for archive_file in archive_files + segments:
+        counters = RollupCounters()
+        if archive_file in segments:
+            lines = archivecompactor.Segment(archive_file).lines()
+        else:
+            lines = open(archive_file)
+        for line in lines:
+            try:
+                message = simplejson.loads(line)
+                if 'delete' not in message:
+                    counters.add(message)
+                    tweets += 1
+            except (ValueError, TypeError, KeyError):
+                # the quarantine already has the lines that never made it in
+                pass
+        if archive_file not in segments:
+            lines.close()
+        written = counters.write(tweet_storage, name)
+        logger.info('Rolled up %s into %d documents' % (archive_file, written))
+
+    print 'Rebuilt %s from %d tweets in %d files and %d segments in %.1fs' % (name, tweets, len(archive_files), len(segments), time.time() - start)
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) != 2 or sys.argv[1] != 'rebuild':
+        print "To run: python rollups.py rebuild"
+        sys.exit()
+
+    Config = ConfigParser.ConfigParser()
+    Config.read(PLATFORM_CONFIG_FILE)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s', datefmt='%m-%d %H:%M')
+    logger = logging.getLogger('rollups')
+
+    rebuild(Config, storage.storage_from_config(Config, logger), logger)
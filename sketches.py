@@ -0,0 +1,644 @@
+#-------------------------------------------------------------------------------
+# Name:        Trending and distinct count sketches.
+# Purpose:     Top-K and frequency queries on hashtags, mentions, matched track
+#              keywords and hashtag pairs, and distinct user and tweet counts,
+#              per time window, in memory bounded by the sketch sizes instead
+#              of by the number of distinct keys.
+#
+# For each kind (tag, at, kw and pair, the sorted pairs of hashtags that occur
+# in the same tweet) a TrendSketch keeps:
+#   SpaceSaving   the top_k most frequent keys with counts that are high by at
+#                 most their error (the count of the key it replaced)
+#   CountMin      an estimate of any key's count, high by at most
+#                 e / cm_width of the total with probability 1 - e^-cm_depth
+# and DistinctCounts keeps a HyperLogLog of the user.id_str and one of the
+# id_str values of all tweets, of the tweets matching each track keyword and
+# of each collection type (track or follow, from the file name).
+# All of them merge, so sketches of hours, files and processors add up to the
+# sketch of a window.
+#
+# The processor feeds every processed file through a SketchWriter (a tweet
+# sink, see preprocess.open_tweet_sinks), which writes one snapshot of each
+# per hour of created_at, as zlib compressed JSON, to
+#   sketch_dir/<YYYYMMDD>/<HH>-<processed file>.sketch and .hll
+#
+#   python sketches.py top <tag | at | kw | pair> [n] [hours | <start YYYYmmddHH> <end YYYYmmddHH>]
+#       the n top keys of the last hours (1) or of [start, end), in UTC
+#   python sketches.py count <tag | at | kw | pair> <key> [hours | <start YYYYmmddHH> <end YYYYmmddHH>]
+#       the estimated count of one key
+#   python sketches.py distinct <all | kw:<keyword> | type:<track | follow> | keys> [hours | <start YYYYmmddHH> <end YYYYmmddHH>] [--hourly]
+#       distinct users and tweets of the window, or of each of its hours; keys
+#       lists every key with its counts. unique_counts() and
+#       hourly_unique_counts() answer the same from code
+#   python sketches.py merge [YYYYMMDD ...]
+#       merges the snapshots of each hour of the given days, or of every day
+#       before today, into one
+#
+# [sketches] enabled turns the trending sketches on and distinct the distinct
+# counts (hll_precision sets their size); sketch_dir names the directory
+# (./sketches/).
+#-------------------------------------------------------------------------------
+
+import os
+import sys
+import glob
+import time
+import math
+import zlib
+import heapq
+import base64
+import struct
+import hashlib
+import logging
+import itertools
+import ConfigParser
+from array import array
+from datetime import datetime, timedelta
+
+import simplejson
+import platformconfig
+
+PLATFORM_CONFIG_FILE = 'platform.ini'
+SKETCH_DIR = './sketches/'
+KINDS = ['tag', 'at', 'kw', 'pair']
+TOP_K = 1000
+CM_WIDTH = 2048
+CM_DEPTH = 4
+# tweets whose keys are counted exactly before they go to the sketches
+FLUSH_TWEETS = 10000
+HLL_PRECISION = 12
+# hashtags of one tweet used for pairs, so a tweet adds at most 45 pairs
+MAX_PAIR_TAGS = 10
+
+logger = logging.getLogger('sketches')
+
+
+def sketches_enabled(Config):
+    return platformconfig.get_boolean_option(Config, 'sketches', 'enabled', False)
+
+def sketch_dir_from_config(Config):
+    return platformconfig.get_option(Config, 'sketches', 'sketch_dir', SKETCH_DIR)
+
+def sketch_sizes_from_config(Config):
+    return (platformconfig.get_int_option(Config, 'sketches', 'top_k', TOP_K),
+        platformconfig.get_int_option(Config, 'sketches', 'cm_width', CM_WIDTH),
+        platformconfig.get_int_option(Config, 'sketches', 'cm_depth', CM_DEPTH))
+
+def utf8(key):
+    return key.encode('utf-8') if isinstance(key, unicode) else key
+
+
+class SpaceSaving(object):
+    """ The capacity most frequent keys (Metwally et al.). A new key takes the
+        place of the one with the smallest count, inheriting that count as its
+        error. The heap holds one entry per key with the count it had when the
+        entry was pushed; counts only grow, so an entry found out of date at
+        the top is pushed again with its count until the top is current.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self.heap = []
+
+    def add(self, key, count=1):
+        counts = self.counts
+        if key in counts:
+            counts[key] += count
+            return
+        if len(counts) < self.capacity:
+            counts[key] = count
+            self.errors[key] = 0
+        else:
+            minimum, victim = self.pop_minimum()
+            del counts[victim]
+            del self.errors[victim]
+            counts[key] = minimum + count
+            self.errors[key] = minimum
+        heapq.heappush(self.heap, (counts[key], key))
+
+    def pop_minimum(self):
+        heap = self.heap
+        counts = self.counts
+        while True:
+            value, key = heapq.heappop(heap)
+            if counts[key] == value:
+                return value, key
+            heapq.heappush(heap, (counts[key], key))
+
+    # The count any key that is not kept may have
+    def minimum(self):
+        if len(self.counts) < self.capacity:
+            return 0
+        value, key = self.pop_minimum()
+        heapq.heappush(self.heap, (value, key))
+        return value
+
+    # [(key, count, error)] of the n highest counts
+    def top(self, n):
+        return [(key, value, self.errors[key]) for key, value in heapq.nlargest(n, self.counts.iteritems(), key=lambda item: item[1])]
+
+    # Adds the keys of other (Agarwal et al., mergeable summaries): a key missing
+    # from one side counts that side's minimum
+    def merge(self, other):
+        own_minimum = self.minimum()
+        other_minimum = other.minimum()
+        counts = {}
+        errors = {}
+        for key in set(self.counts) | set(other.counts):
+            counts[key] = self.counts.get(key, own_minimum) + other.counts.get(key, other_minimum)
+            errors[key] = self.errors.get(key, own_minimum) + other.errors.get(key, other_minimum)
+        kept = heapq.nlargest(self.capacity, counts.iteritems(), key=lambda item: item[1])
+        self.counts = dict(kept)
+        self.errors = dict((key, errors[key]) for key, value in kept)
+        self.heap = [(value, key) for key, value in kept]
+        heapq.heapify(self.heap)
+
+    def to_dict(self):
+        return {'capacity': self.capacity, 'keys': [[key, value, self.errors[key]] for key, value in self.counts.iteritems()]}
+
+    @classmethod
+    def from_dict(cls, data):
+        summary = cls(data['capacity'])
+        for key, value, error in data['keys']:
+            summary.counts[key] = value
+            summary.errors[key] = error
+        summary.heap = [(value, key) for key, value in summary.counts.iteritems()]
+        heapq.heapify(summary.heap)
+        return summary
+
+
+class CountMin(object):
+    """ Count-Min sketch (Cormode and Muthukrishnan): depth rows of width counters;
+        a key adds to one counter a row and its estimate is the smallest of them.
+        Rows are indexed by double hashing crc32 and adler32, which are the same
+        in every process, so sketches written by different processors merge.
+    """
+    def __init__(self, width, depth):
+        self.width = width
+        self.depth = depth
+        self.table = array('l', [0]) * (width * depth)
+        self.total = 0
+
+    def indexes(self, key):
+        key = utf8(key)
+        first = zlib.crc32(key) & 0xffffffff
+        second = (zlib.adler32(key) & 0xffffffff) | 1
+        width = self.width
+        return [row * width + (first + row * second) % width for row in range(self.depth)]
+
+    def add(self, key, count=1):
+        key = utf8(key)
+        first = zlib.crc32(key) & 0xffffffff
+        second = (zlib.adler32(key) & 0xffffffff) | 1
+        table = self.table
+        width = self.width
+        for row in xrange(self.depth):
+            table[row * width + (first + row * second) % width] += count
+        self.total += count
+
+    def estimate(self, key):
+        table = self.table
+        return min(table[index] for index in self.indexes(key))
+
+    def merge(self, other):
+        if (other.width, other.depth) != (self.width, self.depth):
+            raise ValueError('Count-Min sketches of %dx%d and %dx%d do not merge' % (self.width, self.depth, other.width, other.depth))
+        self.table = array('l', itertools.imap(sum, itertools.izip(self.table, other.table)))
+        self.total += other.total
+
+    # The table is stored as little-endian 8 byte counters whatever the size of
+    # 'l' is where it was written
+    def to_dict(self):
+        table = struct.pack('<%dq' % len(self.table), *self.table)
+        return {'width': self.width, 'depth': self.depth, 'total': self.total, 'table': base64.b64encode(table)}
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data['width'], data['depth'])
+        table = base64.b64decode(data['table'])
+        sketch.table = array('l', struct.unpack('<%dq' % (len(table) / 8), table))
+        sketch.total = data['total']
+        return sketch
+
+
+# {kind: [keys]} of a processed tweet
+def tweet_keys(tweet):
+    keywords = set()
+    for matched in tweet.get('track_kw', {}).itervalues():
+        keywords.update(matched)
+    hashtags = sorted(set(tweet.get('hashtags', [])))
+    return {
+        'tag': hashtags,
+        'at': set(tweet.get('mentions', [])),
+        'kw': keywords,
+        'pair': ['%s %s' % pair for pair in itertools.combinations(hashtags[:MAX_PAIR_TAGS], 2)]
+        }
+
+class TrendSketch(object):
+    """ A SpaceSaving summary and a Count-Min sketch for each kind, plus the
+        number of tweets added. Keys are counted exactly over FLUSH_TWEETS
+        tweets at a time and go to the sketches once per batch with their
+        counts, which bounds the memory just as well and updates the sketches
+        once per key instead of once per occurrence.
+    """
+    def __init__(self, top_k=TOP_K, cm_width=CM_WIDTH, cm_depth=CM_DEPTH):
+        self.tweets = 0
+        self.summaries = dict((kind, SpaceSaving(top_k)) for kind in KINDS)
+        self.counters = dict((kind, CountMin(cm_width, cm_depth)) for kind in KINDS)
+        self.pending = dict((kind, {}) for kind in KINDS)
+        self.pending_tweets = 0
+
+    def add(self, tweet):
+        self.tweets += 1
+        for kind, keys in tweet_keys(tweet).iteritems():
+            pending = self.pending[kind]
+            for key in keys:
+                pending[key] = pending.get(key, 0) + 1
+        self.pending_tweets += 1
+        if self.pending_tweets >= FLUSH_TWEETS:
+            self.flush()
+
+    def flush(self):
+        for kind, pending in self.pending.iteritems():
+            summary = self.summaries[kind]
+            counter = self.counters[kind]
+            # the largest counts first, so the batch's own tail does not push them out
+            for key, count in sorted(pending.iteritems(), key=lambda item: item[1], reverse=True):
+                summary.add(key, count)
+                counter.add(key, count)
+            pending.clear()
+        self.pending_tweets = 0
+
+    def merge(self, other):
+        self.flush()
+        other.flush()
+        self.tweets += other.tweets
+        for kind in KINDS:
+            self.summaries[kind].merge(other.summaries[kind])
+            self.counters[kind].merge(other.counters[kind])
+
+    def top(self, kind, n):
+        self.flush()
+        return self.summaries[kind].top(n)
+
+    # The smaller of the two estimates; both are never below the true count
+    def count(self, kind, key):
+        self.flush()
+        estimate = self.counters[kind].estimate(key)
+        if key in self.summaries[kind].counts:
+            estimate = min(estimate, self.summaries[kind].counts[key])
+        return estimate
+
+    def to_dict(self):
+        self.flush()
+        return {'tweets': self.tweets,
+            'summaries': dict((kind, summary.to_dict()) for kind, summary in self.summaries.iteritems()),
+            'counters': dict((kind, counter.to_dict()) for kind, counter in self.counters.iteritems())}
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls.__new__(cls)
+        sketch.tweets = data['tweets']
+        sketch.summaries = dict((kind, SpaceSaving.from_dict(summary)) for kind, summary in data['summaries'].iteritems())
+        sketch.counters = dict((kind, CountMin.from_dict(counter)) for kind, counter in data['counters'].iteritems())
+        sketch.pending = dict((kind, {}) for kind in KINDS)
+        sketch.pending_tweets = 0
+        return sketch
+
+class HyperLogLog(object):
+    """ Distinct count estimate from 2^precision one byte registers (Flajolet
+        et al.), within about 1.04 / sqrt(2^precision): 1.6% for the default
+        precision of 12, in 4 KB. count() uses Ertl's improved estimator, which
+        is unbiased from a handful of ids up without thresholds or bias tables.
+        Takes 64 bit hashes (see id_hash); merging keeps the larger register.
+    """
+    def __init__(self, precision=HLL_PRECISION):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add_hash(self, value):
+        index, rank = register_of(value, self.precision)
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    # Ertl, New cardinality estimation algorithms for HyperLogLog sketches (2017)
+    def count(self):
+        m = len(self.registers)
+        q = 64 - self.precision
+        histogram = [0] * (q + 2)
+        for register in self.registers:
+            histogram[register] += 1
+        z = m * hll_tau(1 - float(histogram[q + 1]) / m)
+        for rank in range(q, 0, -1):
+            z = 0.5 * (z + histogram[rank])
+        z += m * hll_sigma(float(histogram[0]) / m)
+        if z == float('inf'):
+            return 0
+        return int(round(m * m / (2 * math.log(2) * z)))
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError('HyperLogLogs of precision %d and %d do not merge' % (self.precision, other.precision))
+        self.registers = bytearray(itertools.imap(max, self.registers, other.registers))
+
+    def to_dict(self):
+        return {'precision': self.precision, 'registers': base64.b64encode(str(self.registers))}
+
+    @classmethod
+    def from_dict(cls, data):
+        counter = cls(data['precision'])
+        counter.registers = bytearray(base64.b64decode(data['registers']))
+        return counter
+
+# The series Ertl's estimator corrects the empty and the saturated registers with
+def hll_sigma(x):
+    if x == 1:
+        return float('inf')
+    y = 1.0
+    z = x
+    while True:
+        x *= x
+        previous = z
+        z += x * y
+        y += y
+        if z == previous:
+            return z
+
+def hll_tau(x):
+    if x == 0 or x == 1:
+        return 0.0
+    y = 1.0
+    z = 1 - x
+    while True:
+        x = math.sqrt(x)
+        previous = z
+        y *= 0.5
+        z -= (1 - x) ** 2 * y
+        if z == previous:
+            return z / 3
+
+# The 64 bit hash HyperLogLogs take, the same in every process
+def id_hash(id_str):
+    return struct.unpack('<Q', hashlib.md5(id_str).digest()[:8])[0]
+
+# (register, rank) a hash sets: the first precision bits pick the register and
+# the rank is the position of the first 1 bit after them
+def register_of(value, precision):
+    shift = 64 - precision
+    return value >> shift, shift - (value & ((1 << shift) - 1)).bit_length() + 1
+
+# 'track' or 'follow' from a collector file name, 'other' for anything else
+def collection_type(file_name):
+    for part in os.path.basename(file_name).split('-'):
+        if part in ('track', 'follow'):
+            return part
+    return 'other'
+
+class DistinctCounts(object):
+    """ Distinct users (user.id_str) and tweets (id_str) for the keys 'all',
+        'kw:<track keyword>' and 'type:<collection type>', as a pair of
+        HyperLogLogs per key. Each id is hashed once for all its keys.
+    """
+    def __init__(self, precision=HLL_PRECISION):
+        self.precision = precision
+        self.counters = {}
+
+    def pair(self, key):
+        pair = self.counters.get(key)
+        if pair is None:
+            pair = self.counters[key] = (HyperLogLog(self.precision), HyperLogLog(self.precision))
+        return pair
+
+    def add(self, tweet, type_key):
+        user_index, user_rank = register_of(id_hash(str(tweet['user'].get('id_str') or tweet['user']['id'])), self.precision)
+        tweet_index, tweet_rank = register_of(id_hash(str(tweet.get('id_str') or tweet['id'])), self.precision)
+        keys = set(['all', type_key])
+        for matched in tweet.get('track_kw', {}).itervalues():
+            keys.update('kw:' + keyword for keyword in matched)
+        for key in keys:
+            users, tweets = self.pair(key)
+            registers = users.registers
+            if user_rank > registers[user_index]:
+                registers[user_index] = user_rank
+            registers = tweets.registers
+            if tweet_rank > registers[tweet_index]:
+                registers[tweet_index] = tweet_rank
+
+    def merge(self, other):
+        for key, (users, tweets) in other.counters.iteritems():
+            own_users, own_tweets = self.pair(key)
+            own_users.merge(users)
+            own_tweets.merge(tweets)
+
+    # (distinct users, distinct tweets) of a key, (0, 0) if it was never seen
+    def unique(self, key='all'):
+        if key not in self.counters:
+            return 0, 0
+        users, tweets = self.counters[key]
+        return users.count(), tweets.count()
+
+    def keys(self):
+        return sorted(self.counters)
+
+    def to_dict(self):
+        return {'precision': self.precision,
+            'counters': dict((key, [users.to_dict(), tweets.to_dict()]) for key, (users, tweets) in self.counters.iteritems())}
+
+    @classmethod
+    def from_dict(cls, data):
+        counts = cls(data['precision'])
+        counts.counters = dict((key, (HyperLogLog.from_dict(users), HyperLogLog.from_dict(tweets)))
+            for key, (users, tweets) in data['counters'].iteritems())
+        return counts
+
+# snapshot file extension: the class it holds
+SNAPSHOT_TYPES = {'.sketch': TrendSketch, '.hll': DistinctCounts}
+
+def write_snapshot(path, sketch):
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(zlib.compress(simplejson.dumps(sketch.to_dict())))
+    os.rename(path + '.tmp', path)
+
+def read_snapshot(path):
+    with open(path, 'rb') as f:
+        return SNAPSHOT_TYPES[os.path.splitext(path)[1]].from_dict(simplejson.loads(zlib.decompress(f.read())))
+
+
+class SketchWriter(object):
+    """ A tweet sink: adds the tweets of one processed file to a TrendSketch
+        (if sizes are given) and to DistinctCounts (if precision is) per hour of
+        created_at, and writes them as snapshots on close().
+    """
+    def __init__(self, sketch_dir, processed_tweets_file, logger, sizes=None, precision=None):
+        self.sketch_dir = sketch_dir
+        self.sizes = sizes
+        self.precision = precision
+        self.name = os.path.splitext(os.path.basename(processed_tweets_file))[0]
+        self.type_key = 'type:' + collection_type(processed_tweets_file)
+        self.logger = logger
+        self.hours = {}
+
+    def add(self, tweet, offset=None):
+        if 'created_ts' not in tweet or 'user' not in tweet:
+            return
+        hour = tweet['created_ts'][:13]
+        sketches = self.hours.get(hour)
+        if sketches is None:
+            sketches = self.hours[hour] = (TrendSketch(*self.sizes) if self.sizes else None,
+                DistinctCounts(self.precision) if self.precision else None)
+        trends, distinct = sketches
+        if trends:
+            trends.add(tweet)
+        if distinct:
+            distinct.add(tweet, self.type_key)
+
+    def close(self):
+        for hour, sketches in sorted(self.hours.items()):
+            for extension, sketch in zip(['.sketch', '.hll'], sketches):
+                if sketch:
+                    write_snapshot(snapshot_path(self.sketch_dir, hour, self.name, extension), sketch)
+        if self.hours:
+            self.logger.info('Wrote sketches of %s for %d hours' % (self.name, len(self.hours)))
+        self.hours = {}
+
+def sketch_writer_from_config(Config, processed_tweets_file, logger):
+    sizes = sketch_sizes_from_config(Config) if sketches_enabled(Config) else None
+    precision = None
+    if platformconfig.get_boolean_option(Config, 'sketches', 'distinct', False):
+        precision = platformconfig.get_int_option(Config, 'sketches', 'hll_precision', HLL_PRECISION)
+    if not sizes and not precision:
+        return None
+    return SketchWriter(sketch_dir_from_config(Config), processed_tweets_file, logger, sizes, precision)
+
+# hour as in created_ts, 'YYYY-mm-dd HH'
+def snapshot_path(sketch_dir, hour, name, extension='.sketch'):
+    return os.path.join(sketch_dir, hour[:10].replace('-', ''), '%s-%s%s' % (hour[11:13], name, extension))
+
+# {datetime of the hour: [snapshot files]} of the hours in [start, end)
+def window_snapshots(sketch_dir, start, end, extension='.sketch'):
+    hours = {}
+    for day_dir in sorted(glob.glob(os.path.join(sketch_dir, '[0-9]' * 8))):
+        for path in sorted(glob.glob(os.path.join(day_dir, '*' + extension))):
+            hour = datetime.strptime(os.path.basename(day_dir) + os.path.basename(path)[:2], '%Y%m%d%H')
+            if start <= hour < end:
+                hours.setdefault(hour, []).append(path)
+    return hours
+
+# The merged sketch of the hours in [start, end), or None if there are none
+def window_sketch(sketch_dir, start, end, extension='.sketch'):
+    merged = None
+    for hour, paths in sorted(window_snapshots(sketch_dir, start, end, extension).items()):
+        for path in paths:
+            sketch = read_snapshot(path)
+            if merged is None:
+                merged = sketch
+            else:
+                merged.merge(sketch)
+    return merged
+
+# (distinct users, distinct tweets) of key in [start, end): key is 'all',
+# 'kw:<track keyword>' or 'type:<track | follow>'
+def unique_counts(sketch_dir, start, end, key='all'):
+    distinct = window_sketch(sketch_dir, start, end, '.hll')
+    return distinct.unique(key) if distinct else (0, 0)
+
+# [(hour, distinct users, distinct tweets)] of key for each hour in [start, end)
+def hourly_unique_counts(sketch_dir, start, end, key='all'):
+    hours = []
+    for hour in sorted(window_snapshots(sketch_dir, start, end, '.hll')):
+        hours.append((hour,) + unique_counts(sketch_dir, hour, hour + timedelta(hours=1), key))
+    return hours
+
+# Merges the snapshots of each hour of a day into one. Returns the number merged.
+def merge_day(sketch_dir, day, logger):
+    start = datetime.strptime(day, '%Y%m%d')
+    merged_files = 0
+    for extension in sorted(SNAPSHOT_TYPES):
+        for hour, paths in sorted(window_snapshots(sketch_dir, start, start + timedelta(days=1), extension).items()):
+            if len(paths) < 2:
+                continue
+            sketch = window_sketch(sketch_dir, hour, hour + timedelta(hours=1), extension)
+            write_snapshot(snapshot_path(sketch_dir, hour.strftime('%Y-%m-%d %H'), 'merged-%d' % int(time.time() * 1000), extension), sketch)
+            for path in paths:
+                os.remove(path)
+            merged_files += len(paths)
+            logger.info('Merged %d %s sketches of %s' % (len(paths), extension, hour.strftime('%Y-%m-%d %H:00')))
+    return merged_files
+
+# [start, end) from the command line: a number of hours up to now, or two hours
+def window_from_args(args):
+    if len(args) >= 2:
+        return datetime.strptime(args[0], '%Y%m%d%H'), datetime.strptime(args[1], '%Y%m%d%H')
+    end = datetime.utcnow().replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+    return end - timedelta(hours=int(args[0]) if args else 1), end
+
+
+if __name__ == '__main__':
+
+    commands = ['top', 'count', 'distinct', 'merge']
+    if len(sys.argv) < 2 or sys.argv[1] not in commands or (sys.argv[1] == 'top' and (len(sys.argv) < 3 or sys.argv[2] not in KINDS)) \
+            or (sys.argv[1] == 'count' and (len(sys.argv) < 4 or sys.argv[2] not in KINDS)) or (sys.argv[1] == 'distinct' and len(sys.argv) < 3):
+        print "To run: python sketches.py top <%s> [n] [hours | <start YYYYmmddHH> <end YYYYmmddHH>]" % ' | '.join(KINDS)
+        print "        python sketches.py count <%s> <key> [hours | <start YYYYmmddHH> <end YYYYmmddHH>]" % ' | '.join(KINDS)
+        print "        python sketches.py distinct <all | kw:<keyword> | type:<track | follow> | keys> [hours | <start YYYYmmddHH> <end YYYYmmddHH>] [--hourly]"
+        print "        python sketches.py merge [YYYYMMDD ...]"
+        sys.exit()
+
+    Config = ConfigParser.ConfigParser()
+    Config.read(PLATFORM_CONFIG_FILE)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s', datefmt='%m-%d %H:%M')
+    logger = logging.getLogger('sketches')
+
+    sketch_dir = sketch_dir_from_config(Config)
+    command = sys.argv[1]
+
+    if command == 'merge':
+        today = datetime.utcnow().strftime('%Y%m%d')
+        days = sys.argv[2:] or [os.path.basename(day_dir) for day_dir in sorted(glob.glob(os.path.join(sketch_dir, '[0-9]' * 8)))
+            if os.path.basename(day_dir) < today]
+        print 'Merged %d sketches' % sum(merge_day(sketch_dir, day, logger) for day in days)
+        sys.exit()
+
+    if command == 'distinct':
+        args = sys.argv[3:]
+        hourly = '--hourly' in args
+        if hourly:
+            args.remove('--hourly')
+        key = sys.argv[2].lower()
+        start, end = window_from_args(args)
+        if key == 'keys':
+            distinct = window_sketch(sketch_dir, start, end, '.hll')
+            for key in distinct.keys() if distinct else []:
+                users, tweets = distinct.unique(key)
+                print '%-40s %10d users %10d tweets' % (key.encode('utf-8'), users, tweets)
+        elif hourly:
+            for hour, users, tweets in hourly_unique_counts(sketch_dir, start, end, key.decode('utf-8')):
+                print '%s %10d users %10d tweets' % (hour.strftime('%Y-%m-%d %H:00'), users, tweets)
+        else:
+            users, tweets = unique_counts(sketch_dir, start, end, key.decode('utf-8'))
+            print '%s to %s: %s %d users %d tweets' % (start.strftime('%Y-%m-%d %H:00'), end.strftime('%Y-%m-%d %H:00'), key, users, tweets)
+        sys.exit()
+
+    kind = sys.argv[2]
+    if command == 'top':
+        n = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+        start, end = window_from_args(sys.argv[4:])
+    else:
+        # hashtags, mentions and keywords are matched lower case
+        key = sys.argv[3].lower().decode('utf-8')
+        start, end = window_from_args(sys.argv[4:])
+
+    sketch = window_sketch(sketch_dir, start, end)
+    print '%s to %s: %d tweets' % (start.strftime('%Y-%m-%d %H:00'), end.strftime('%Y-%m-%d %H:00'), sketch.tweets if sketch else 0)
+    if sketch is None:
+        sys.exit()
+    if command == 'top':
+        for rank, (key, count, error) in enumerate(sketch.top(kind, n)):
+            print '%3d %-40s %10d  (at most %d too high)' % (rank + 1, key.encode('utf-8'), count, error)
+    else:
+        print '%s %d' % (key.encode('utf-8'), sketch.count(kind, key))
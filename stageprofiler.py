@@ -0,0 +1,105 @@
+"""
+	Low overhead timing of pipeline stages.
+	A StageProfiler keeps cumulative wall clock time per named stage and logs
+	a per-file breakdown. Per-tweet stages can be sampled (every Nth tweet) so
+	the timer calls stay off the hot path; batch stages are always timed.
+	Optionally a whole file can be run under cProfile and dumped for pstats.
+
+"""
+
+import os.path
+import cProfile
+import pstats
+import fnmatch
+from StringIO import StringIO
+from timeit import default_timer as timer
+
+import platformconfig
+
+SAMPLE_EVERY = 100
+
+
+class StageProfiler(object):
+    """ Usage, per tweet:
+            prof = profiler.sample()
+            if prof: t = timer()
+            ... work ...
+            if prof: t = prof.add('loads', t)
+        and per batch:
+            t = timer(); insert(...); profiler.add_batch('insert', t)
+    """
+    def __init__(self, name, sample_every=SAMPLE_EVERY):
+        self.name = name
+        self.sample_every = max(sample_every, 1)
+        self.reset()
+
+    def reset(self):
+        self.totals = {}
+        self.calls = {}
+        self.batch_stages = set()
+        self.items = 0
+        self.sampled = 0
+
+    # Returns self when this item should be timed, otherwise None
+    def sample(self):
+        self.items += 1
+        if self.items % self.sample_every == 0:
+            self.sampled += 1
+            return self
+        return None
+
+    def add(self, stage, start):
+        now = timer()
+        self.totals[stage] = self.totals.get(stage, 0.0) + (now - start)
+        self.calls[stage] = self.calls.get(stage, 0) + 1
+        return now
+
+    def add_batch(self, stage, start):
+        self.batch_stages.add(stage)
+        return self.add(stage, start)
+
+    # Per stage: (stage, estimated seconds for all items, calls, microseconds per call)
+    def breakdown(self):
+        scale = float(self.items) / self.sampled if self.sampled else 0.0
+        rows = []
+        for stage, total in self.totals.iteritems():
+            estimated = total if stage in self.batch_stages else total * scale
+            rows.append((stage, estimated, self.calls[stage], 1e6 * total / self.calls[stage]))
+        rows.sort(key=lambda row: row[1], reverse=True)
+        return rows
+
+    def report(self, logger, label):
+        rows = self.breakdown()
+        overall = sum(row[1] for row in rows)
+        logger.info('PROFILE %s: %d items (%d timed) for %s, %.2fs in timed stages' % (self.name, self.items, self.sampled, label, overall))
+        for stage, estimated, calls, per_call in rows:
+            share = 100 * estimated / overall if overall else 0.0
+            logger.info('PROFILE %s:   %-12s %8.2fs %5.1f%% %10.1fus/call (%d calls)' % (self.name, stage, estimated, share, per_call, calls))
+        self.reset()
+
+def profiler_from_config(Config, name):
+    if not platformconfig.get_boolean_option(Config, 'profiling', 'enabled', False):
+        return None
+    sample_every = platformconfig.get_int_option(Config, 'profiling', 'sample_every', SAMPLE_EVERY)
+    return StageProfiler(name, sample_every)
+
+# Starts cProfile if the file name matches [profiling] cprofile_file, else None
+def start_cprofile(Config, filename):
+    pattern = platformconfig.get_option(Config, 'profiling', 'cprofile_file')
+    if not pattern or not fnmatch.fnmatch(os.path.basename(filename), pattern):
+        return None
+    profile = cProfile.Profile()
+    profile.enable()
+    return profile
+
+def stop_cprofile(profile, Config, filename, logger):
+    profile.disable()
+    cprofile_dir = platformconfig.get_option(Config, 'profiling', 'cprofile_dir', './logs/')
+    if not os.path.exists(cprofile_dir):
+        os.makedirs(cprofile_dir)
+    stats_file = os.path.join(cprofile_dir, os.path.basename(filename) + '.pstats')
+    profile.dump_stats(stats_file)
+
+    summary = StringIO()
+    pstats.Stats(profile, stream=summary).sort_stats('cumulative').print_stats(15)
+    logger.info('cProfile stats for %s written to %s\n%s' % (filename, stats_file, summary.getvalue()))
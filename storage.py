@@ -0,0 +1,367 @@
+#-------------------------------------------------------------------------------
+# Name:        Storage backends.
+# Purpose:     What the inserter, the rollups and the daemons' run flags need
+#              from a database, with the existing Mongo layout as one backend
+#              and an embedded SQLite database as the other, for single node
+#              deployments and for running the pipeline without a mongod.
+#
+# [storage] backend is mongo (the default) or sqlite; sqlite_path names the
+# SQLite database file. Collections are named the same in both backends;
+# DELETES is the collection of delete notices, which Mongo keeps in the
+# tweets collection of the <db_name>-delete database.
+#
+# Backends provide:
+#   insert(collection, docs) -> (inserted, write errors)    bulk insert keyed on _id
+#   delete(collection, status_ids, mode) -> matched         remove or tombstone by id_str
+#   update(collection, updates) -> matched                  $set top level fields by id_str
+#   increment(collection, increments)                       $inc upserts (rollups)
+#   ensure_indexes(collection, keys), drop(collection), count(collection)
+#   get_flags(module), set_flags(module, values)            the run/collect/update flags
+#   max_batch_bytes()                                       None when there is no limit
+# Write errors are {'index', 'code', 'errmsg'} dicts as in a Mongo bulk result;
+# a duplicate _id has code DUPLICATE_KEY. StorageError means nothing in the
+# request is known to have been written.
+#
+# The collector still reads its flags and follow lists from Mongo directly.
+#
+# To set a flag in a SQLite deployment:
+#   python storage.py set-flag inserter run 1
+#-------------------------------------------------------------------------------
+
+import os
+import sys
+import sqlite3
+import threading
+from contextlib import contextmanager
+import ConfigParser
+from datetime import datetime
+
+import simplejson
+from pymongo.errors import BulkWriteError, PyMongoError
+
+import platformconfig
+
+PLATFORM_CONFIG_FILE = 'platform.ini'
+BACKENDS = ['mongo', 'sqlite']
+SQLITE_PATH = './ssmc.sqlite'
+DELETES = 'deletes'
+DUPLICATE_KEY = 11000
+# SQLite's default limit on host parameters is 999
+SQLITE_IN_CHUNK = 500
+SQLITE_TIMESTAMP = '%Y-%m-%d %H:%M:%S'
+
+
+class StorageError(Exception):
+    pass
+
+
+class MongoStorage(object):
+    def __init__(self, client, db_name):
+        self.client = client
+        self.db_name = db_name
+        self.database = client[db_name]
+        self.delete_database = client[db_name + '-delete']
+
+    def collection(self, name):
+        if name == DELETES:
+            return self.delete_database['tweets']
+        return self.database[name]
+
+    def max_batch_bytes(self):
+        # batches are sized by their JSON lines, which can be smaller than the
+        # BSON, so stay well inside what the server accepts in one message
+        max_message_size = getattr(self.client, 'max_message_size', None)
+        if isinstance(max_message_size, (int, long)):
+            return max_message_size / 4
+        return None
+
+    def insert(self, name, docs):
+        collection = self.collection(name)
+        # failure details need acknowledged writes, whatever the client default is
+        write_concern = dict(getattr(collection, 'write_concern', None) or {})
+        if not write_concern.get('w'):
+            write_concern['w'] = 1
+        try:
+            bulk = collection.initialize_unordered_bulk_op()
+            for doc in docs:
+                bulk.insert(doc)
+            result = bulk.execute(write_concern)
+        except BulkWriteError, e:
+            result = e.details
+        except PyMongoError, e:
+            raise StorageError('%s: %s' % (e.__class__.__name__, e))
+        return result.get('nInserted', 0), result.get('writeErrors', [])
+
+    def delete(self, name, status_ids, mode):
+        collection = self.collection(name)
+        spec = {'id_str': {'$in': status_ids}}
+        try:
+            if mode == 'remove':
+                result = collection.remove(spec, w=1)
+            else:
+                result = collection.update(spec, {'$set': {'deleted': True, 'deleted_ts': datetime.utcnow()}}, multi=True, w=1)
+        except PyMongoError, e:
+            raise StorageError('%s: %s' % (e.__class__.__name__, e))
+        return result.get('n', 0) if result else 0
+
+    # updates is a list of (id_str, {field: new value})
+    def update(self, name, updates):
+        if not updates:
+            return 0
+        try:
+            bulk = self.collection(name).initialize_unordered_bulk_op()
+            for id_str, fields in updates:
+                bulk.find({'id_str': id_str}).update({'$set': fields})
+            result = bulk.execute({'w': 1})
+        except BulkWriteError, e:
+            result = e.details
+        except PyMongoError, e:
+            raise StorageError('%s: %s' % (e.__class__.__name__, e))
+        return result.get('nMatched', 0)
+
+    # increments is a list of (_id, {field: increment}, {field: value set on insert})
+    def increment(self, name, increments):
+        if not increments:
+            return
+        try:
+            bulk = self.collection(name).initialize_unordered_bulk_op()
+            for doc_id, inc, set_on_insert in increments:
+                bulk.find({'_id': doc_id}).upsert().update({'$inc': inc, '$setOnInsert': set_on_insert})
+            bulk.execute({'w': 1})
+        except PyMongoError, e:
+            raise StorageError('%s: %s' % (e.__class__.__name__, e))
+
+    # keys are field names or lists of (field, direction) for compound indexes
+    def ensure_indexes(self, name, keys):
+        collection = self.collection(name)
+        for key in keys:
+            collection.ensure_index(key)
+
+    def drop(self, name):
+        self.collection(name).drop()
+
+    def count(self, name):
+        return self.collection(name).count()
+
+    def collection_names(self):
+        return self.database.collection_names()
+
+    def get_flags(self, module):
+        return self.client.config.config.find_one({'module': module})
+
+    def set_flags(self, module, values):
+        self.client.config.config.update({'module': module}, {'$set': values}, upsert=True)
+
+    def close(self):
+        # the client is shared, see mongoclient.py
+        pass
+
+
+def json_default(value):
+    if isinstance(value, datetime):
+        return value.strftime(SQLITE_TIMESTAMP)
+    raise TypeError('%r is not JSON serializable' % (value,))
+
+def timestamp_text(value):
+    if isinstance(value, datetime):
+        return value.strftime(SQLITE_TIMESTAMP)
+    return value
+
+# Applies Mongo style increments, including dotted field names, to a decoded doc
+def apply_increments(doc, inc):
+    for field, value in inc.iteritems():
+        parts = field.split('.')
+        target = doc
+        for part in parts[:-1]:
+            target = target.setdefault(part, {})
+        target[parts[-1]] = target.get(parts[-1], 0) + value
+
+def quote_name(name):
+    return '"%s"' % name.replace('"', '""')
+
+
+class SQLiteStorage(object):
+    """ One table per collection. Document tables are keyed on the integer _id
+        (the tweet id), with id_str, created_ts and the tombstone in columns and
+        the document as JSON; counter tables (rollups) are keyed on a text _id.
+        The database runs in WAL mode, each thread has its own connection and
+        every call is one transaction, taking the write lock up front so
+        concurrent writers queue instead of failing on a lock upgrade.
+    """
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.tables = set()
+        connection = self.connection()
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('CREATE TABLE IF NOT EXISTS flags (module TEXT PRIMARY KEY, doc TEXT)')
+
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            # autocommit, transactions are started explicitly by transaction()
+            connection = self.local.connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    @contextmanager
+    def transaction(self):
+        connection = self.connection()
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield connection
+            except:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+        except sqlite3.Error, e:
+            raise StorageError('%s: %s' % (e.__class__.__name__, e))
+
+    def ensure_table(self, name, counters=False):
+        if name in self.tables:
+            return
+        with self.lock:
+            if counters:
+                schema = 'id TEXT PRIMARY KEY, doc TEXT'
+            else:
+                schema = 'id INTEGER PRIMARY KEY, id_str TEXT, created_ts TEXT, deleted INTEGER NOT NULL DEFAULT 0, deleted_ts TEXT, doc TEXT'
+            self.connection().execute('CREATE TABLE IF NOT EXISTS %s (%s)' % (quote_name(name), schema))
+            self.tables.add(name)
+
+    def max_batch_bytes(self):
+        return None
+
+    def insert(self, name, docs):
+        self.ensure_table(name)
+        sql = 'INSERT OR IGNORE INTO %s (id, id_str, created_ts, doc) VALUES (?, ?, ?, ?)' % quote_name(name)
+        inserted = 0
+        write_errors = []
+        with self.transaction() as connection:
+            for index, doc in enumerate(docs):
+                try:
+                    row = (doc.get('_id'), doc.get('id_str'), timestamp_text(doc.get('created_ts')), simplejson.dumps(doc, default=json_default))
+                except (TypeError, ValueError), e:
+                    write_errors.append({'index': index, 'code': None, 'errmsg': '%s: %s' % (e.__class__.__name__, e)})
+                    continue
+                if connection.execute(sql, row).rowcount:
+                    inserted += 1
+                else:
+                    write_errors.append({'index': index, 'code': DUPLICATE_KEY, 'errmsg': 'duplicate key %s' % doc.get('_id')})
+        return inserted, write_errors
+
+    def delete(self, name, status_ids, mode):
+        self.ensure_table(name)
+        matched = 0
+        with self.transaction() as connection:
+            for start in range(0, len(status_ids), SQLITE_IN_CHUNK):
+                chunk = [int(status_id) for status_id in status_ids[start:start + SQLITE_IN_CHUNK]]
+                placeholders = ','.join('?' * len(chunk))
+                if mode == 'remove':
+                    cursor = connection.execute('DELETE FROM %s WHERE id IN (%s)' % (quote_name(name), placeholders), chunk)
+                else:
+                    cursor = connection.execute('UPDATE %s SET deleted = 1, deleted_ts = ? WHERE id IN (%s)' % (quote_name(name), placeholders),
+                        [datetime.utcnow().strftime(SQLITE_TIMESTAMP)] + chunk)
+                matched += cursor.rowcount
+        return matched
+
+    def update(self, name, updates):
+        if not updates:
+            return 0
+        self.ensure_table(name)
+        select = 'SELECT id, doc FROM %s WHERE id_str = ?' % quote_name(name)
+        replace = 'UPDATE %s SET doc = ? WHERE id = ?' % quote_name(name)
+        matched = 0
+        with self.transaction() as connection:
+            for id_str, fields in updates:
+                row = connection.execute(select, (id_str,)).fetchone()
+                if not row:
+                    continue
+                doc = simplejson.loads(row[1])
+                doc.update(fields)
+                connection.execute(replace, (simplejson.dumps(doc, default=json_default), row[0]))
+                matched += 1
+        return matched
+
+    def increment(self, name, increments):
+        if not increments:
+            return
+        self.ensure_table(name, counters=True)
+        select = 'SELECT doc FROM %s WHERE id = ?' % quote_name(name)
+        replace = 'INSERT OR REPLACE INTO %s (id, doc) VALUES (?, ?)' % quote_name(name)
+        with self.transaction() as connection:
+            for doc_id, inc, set_on_insert in increments:
+                row = connection.execute(select, (doc_id,)).fetchone()
+                if row:
+                    doc = simplejson.loads(row[0])
+                else:
+                    doc = dict(set_on_insert, _id=doc_id)
+                apply_increments(doc, inc)
+                connection.execute(replace, (doc_id, simplejson.dumps(doc, default=json_default)))
+
+    # Only keys held in columns can be indexed; id is the primary key already
+    def ensure_indexes(self, name, keys):
+        column_keys = [key for key in keys if key in ('id_str', 'created_ts', 'deleted')]
+        if not column_keys:
+            return
+        self.ensure_table(name)
+        for key in column_keys:
+            self.connection().execute('CREATE INDEX IF NOT EXISTS %s ON %s (%s)' % (quote_name(name + '_' + key), quote_name(name), key))
+
+    def drop(self, name):
+        self.connection().execute('DROP TABLE IF EXISTS %s' % quote_name(name))
+        with self.lock:
+            self.tables.discard(name)
+
+    def count(self, name):
+        self.ensure_table(name)
+        return self.connection().execute('SELECT COUNT(*) FROM %s' % quote_name(name)).fetchone()[0]
+
+    def collection_names(self):
+        rows = self.connection().execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name != 'flags'").fetchall()
+        return [row[0] for row in rows]
+
+    def get_flags(self, module):
+        row = self.connection().execute('SELECT doc FROM flags WHERE module = ?', (module,)).fetchone()
+        return simplejson.loads(row[0]) if row else None
+
+    def set_flags(self, module, values):
+        with self.transaction() as connection:
+            flags = self.get_flags(module) or {'module': module}
+            flags.update(values)
+            connection.execute('INSERT OR REPLACE INTO flags (module, doc) VALUES (?, ?)', (module, simplejson.dumps(flags)))
+
+    def close(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
+
+
+def storage_from_config(Config, logger=None):
+    backend = platformconfig.get_option(Config, 'storage', 'backend', 'mongo')
+    if backend == 'sqlite':
+        return SQLiteStorage(platformconfig.get_option(Config, 'storage', 'sqlite_path', SQLITE_PATH))
+    if backend != 'mongo' and logger:
+        logger.warning('Unknown storage backend %s, using mongo' % backend)
+    import mongoclient
+    return MongoStorage(mongoclient.get_client(Config), Config.get('collection', 'db_name', 0))
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) != 5 or sys.argv[1] != 'set-flag':
+        print "To run: python storage.py set-flag <module> <flag> <integer value>"
+        sys.exit()
+
+    Config = ConfigParser.ConfigParser()
+    Config.read(PLATFORM_CONFIG_FILE)
+
+    module, flag, value = sys.argv[2], sys.argv[3], int(sys.argv[4])
+    tweet_storage = storage_from_config(Config)
+    tweet_storage.set_flags(module, {flag: value})
+    print '%s: %s' % (module, tweet_storage.get_flags(module))
@@ -0,0 +1,537 @@
+#-------------------------------------------------------------------------------
+# Name:        Pipeline supervisor.
+# Purpose:     Runs the collector, the processors and the inserters from one
+#              entry point, in place of the three screen sessions.
+#
+#   python supervisor.py
+#
+# The collector runs as a child process (ThreadedCollector.py, still started
+# and stopped by its collector-track flags). Processors and inserters are
+# child processes fed by bounded in-memory queues of file names: a scanner
+# thread hands a raw file to the processors as soon as the collector has
+# rolled over to the next one, and a processor hands its processed file
+# straight to the inserters, so no stage polls its directory or waits out the
+# copy delay. The files themselves stay on disk and are claimed as before
+# (workqueue.py), so names still queued at shutdown, or the file of a worker
+# that died, are picked up again by the scanner.
+#
+# With [manifest] enabled the scanner takes the oldest sealed raw file and the
+# oldest queued processed file from the job manifest (jobmanifest.py) instead
+# of listing the directories every scan, and the workers move the files they
+# finish along in it, as preprocess.py and mongoBatchInsert.py do.
+#
+# Every worker gets the same restart policy: it is started again
+# restart_seconds after it exits, doubling for each exit that follows a short
+# run, up to max_restart_seconds. SIGTERM, ctrl-c or the supervisor run flag
+# set to 0 stops the collector first, then lets each processor and then each
+# inserter finish the file it is on. Every status_seconds the supervisor
+# logs files, lines and CPU time per stage to ./logs/log-supervisor.out.
+#
+# [supervisor] options: collector (track, follow or none), processors,
+# inserters, queue_size, scan_seconds, restart_seconds, max_restart_seconds,
+# status_seconds.
+#-------------------------------------------------------------------------------
+
+import os
+import sys
+import time
+import signal
+import logging
+import logging.handlers
+import threading
+import sqlite3
+import subprocess
+import multiprocessing
+import Queue
+import ConfigParser
+
+import platformconfig
+import mongoclient
+import storage
+import workqueue
+import quarantine
+import stageprofiler
+import tweetprocessing
+import preprocess
+import mongoBatchInsert
+import jobmanifest
+
+PLATFORM_CONFIG_FILE = 'platform.ini'
+STAGES = ['collector', 'processor', 'inserter']
+COLLECTOR = 'track'
+PROCESSORS = 1
+INSERTERS = 1
+QUEUE_SIZE = 4
+SCAN_SECONDS = 10
+RESTART_SECONDS = 5
+MAX_RESTART_SECONDS = 300
+STATUS_SECONDS = 60
+# a raw file is handed off only once nothing has written to it for this long
+SETTLE_SECONDS = 2
+LOG_FORMAT = '%(asctime)s %(name)-12s %(levelname)-8s %(message)s'
+LOG_DATEFMT = '%m-%d %H:%M'
+
+
+def file_logger(name, log_file):
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.INFO)
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    fh = logging.handlers.TimedRotatingFileHandler(log_file, 'D', 1, 30, None, False, False)
+    fh.setLevel(logging.INFO)
+    fh.setFormatter(logging.Formatter(LOG_FORMAT, LOG_DATEFMT))
+    logger.addHandler(fh)
+    return logger
+
+def cpu_seconds():
+    times = os.times()
+    return times[0] + times[1]
+
+# utime + stime of another process from /proc, or None where there is no /proc
+def process_cpu_seconds(pid):
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+# Puts name on a bounded queue, waiting while it is full unless stop is set.
+def hand_off(out_queue, name, stop):
+    while not stop.is_set():
+        try:
+            out_queue.put(name, timeout=1)
+            return True
+        except Queue.Full:
+            continue
+    return False
+
+
+class ProcessorStage(object):
+    """ What preprocess.py does with a claimed raw file. Returns the processed
+        file, now in the insert queue, for the inserters.
+    """
+    log_file = './logs/log-processor.out'
+    logger_name = 'preprocess'
+
+    def __init__(self, Config, logger):
+        self.Config = Config
+        self.logger = logger
+        self.tweet_quarantine = quarantine.quarantine_from_config(Config, 'preprocess', logger)
+        retweet_cache_size = platformconfig.get_int_option(Config, 'processing', 'retweet_cache_size', tweetprocessing.RETWEET_CACHE_SIZE)
+        self.rt_cache = tweetprocessing.RetweetCache(retweet_cache_size) if retweet_cache_size > 0 else None
+        self.profiler = stageprofiler.profiler_from_config(Config, 'preprocess')
+        self.manifest = jobmanifest.manifest_from_config(Config, logger)
+        self.terms_file = Config.get('files', 'terms_file', 0)
+        self.terms_mtime = None
+        self.track_list = []
+
+    # the terms file is only read again when it changes
+    def current_track_list(self):
+        mtime = os.path.getmtime(self.terms_file)
+        if mtime != self.terms_mtime:
+            with open(self.terms_file) as f:
+                self.track_list = f.read().splitlines()
+            self.terms_mtime = mtime
+        return self.track_list
+
+    # Returns (lines read, file for the next stage or None)
+    def handle(self, claimed_file):
+        processed_tweets_file = preprocess.get_processed_tweets_file_name(self.Config, workqueue.unclaimed_name(claimed_file))
+        processed, lost = preprocess.process_raw_file(self.Config, claimed_file, processed_tweets_file, self.current_track_list(),
+            self.tweet_quarantine, self.logger, rt_cache=self.rt_cache, profiler=self.profiler)
+        queued_file = preprocess.queue_up_processed_tweets(self.Config, processed_tweets_file, self.logger)
+        preprocess.archive_processed_file(self.Config, claimed_file, self.logger)
+        if self.manifest:
+            raw_file = workqueue.unclaimed_name(claimed_file)
+            self.manifest.set_state(raw_file, 'processed')
+            self.manifest.add('insert', queued_file, 'queued', source=raw_file)
+        return processed + lost, queued_file
+
+    def close(self):
+        self.tweet_quarantine.close()
+        if self.manifest:
+            self.manifest.close()
+
+class InserterStage(object):
+    """ What mongoBatchInsert.py does with a claimed processed file. """
+    log_file = './logs/log-inserter.out'
+    logger_name = 'mongo_insert'
+
+    def __init__(self, Config, logger):
+        self.Config = Config
+        self.logger = logger
+        self.tweet_storage = storage.storage_from_config(Config, logger)
+        self.tweet_quarantine = quarantine.quarantine_from_config(Config, 'insert', logger)
+        self.profiler = stageprofiler.profiler_from_config(Config, 'mongo_insert')
+        self.manifest = jobmanifest.manifest_from_config(Config, logger)
+
+    def handle(self, claimed_file):
+        lines, inserted, lost = mongoBatchInsert.insert_processed_file(self.Config, claimed_file, self.tweet_storage,
+            self.tweet_quarantine, self.logger, profiler=self.profiler)
+        if self.manifest:
+            # still in the queue when some batches could not be written
+            queued_file = workqueue.unclaimed_name(claimed_file)
+            self.manifest.set_state(queued_file, 'queued' if os.path.exists(queued_file) else 'done')
+        return lines, None
+
+    def close(self):
+        self.tweet_quarantine.close()
+        self.tweet_storage.close()
+        if self.manifest:
+            self.manifest.close()
+
+# Body of a processor or inserter child: claims the files named on in_queue one at a
+# time and reports each to the supervisor, until stop is set between files.
+def run_worker(stage_class, Config, in_queue, out_queue, status_queue, stop, retry_seconds):
+    # the supervisor coordinates shutdown; ctrl-c reaches the whole process group
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # the parent's Mongo connections are not safe to share across the fork
+    mongoclient.forget_client()
+
+    logger = file_logger(stage_class.logger_name, stage_class.log_file)
+    stage = stage_class(Config, logger)
+    worker = workqueue.worker_id()
+    lease_seconds = workqueue.lease_seconds_from_config(Config)
+    logger.info('Supervised %s worker %s started' % (stage_class.logger_name, worker))
+
+    while not stop.is_set():
+        try:
+            queued_file = in_queue.get(timeout=1)
+        except Queue.Empty:
+            continue
+        claimed_file = workqueue.claim_file(queued_file, worker)
+        if claimed_file is None:
+            # another worker, or a second hand off of the same name, got there first
+            continue
+        with workqueue.Lease(claimed_file, lease_seconds, logger):
+            lines, next_file = stage.handle(claimed_file)
+        status_queue.put((os.getpid(), lines, cpu_seconds()))
+        if next_file and out_queue is not None:
+            hand_off(out_queue, next_file, stop)
+        if os.path.exists(queued_file):
+            # left in the queue to be retried (e.g. mongo is down); do not spin on it
+            stop.wait(retry_seconds)
+
+    stage.close()
+    status_queue.put((os.getpid(), 0, cpu_seconds()))
+    logger.info('Supervised %s worker %s stopped' % (stage_class.logger_name, worker))
+
+
+class ManagedWorker(object):
+    """ One supervised child, a multiprocessing.Process or, for the collector, a
+        subprocess.Popen, with the restart policy shared by every stage.
+    """
+    def __init__(self, stage, name, start_function, restart_seconds, max_restart_seconds, logger):
+        self.stage = stage
+        self.name = name
+        self.start_function = start_function
+        self.restart_seconds = restart_seconds
+        self.max_restart_seconds = max_restart_seconds
+        self.logger = logger
+        self.process = None
+        self.started_at = None
+        self.delay = 0
+        self.restart_at = None
+        self.restarts = 0
+
+    def start(self):
+        self.process = self.start_function()
+        self.started_at = time.time()
+        self.restart_at = None
+        self.logger.info('Started %s (pid %d)' % (self.name, self.process.pid))
+
+    def alive(self):
+        if self.process is None:
+            return False
+        if isinstance(self.process, subprocess.Popen):
+            return self.process.poll() is None
+        return self.process.is_alive()
+
+    def exitcode(self):
+        if isinstance(self.process, subprocess.Popen):
+            return self.process.returncode
+        return self.process.exitcode
+
+    # Restarts the worker once its backoff has passed. Called from the supervisor loop.
+    def check(self, now):
+        if self.alive():
+            return
+        if self.restart_at is None:
+            uptime = now - self.started_at
+            if uptime >= self.max_restart_seconds or not self.delay:
+                self.delay = self.restart_seconds
+            else:
+                self.delay = min(self.delay * 2, self.max_restart_seconds)
+            self.restart_at = now + self.delay
+            self.logger.warning('%s (pid %d) exited with code %s after %.0fs, restarting in %ds' % (self.name, self.process.pid, self.exitcode(), uptime, self.delay))
+        elif now >= self.restart_at:
+            self.restarts += 1
+            self.start()
+
+    # Waits up to timeout seconds for the worker to exit by itself, then kills it.
+    def stop(self, timeout):
+        if not self.alive():
+            return
+        deadline = time.time() + timeout
+        while self.alive() and time.time() < deadline:
+            time.sleep(0.5)
+        if self.alive():
+            self.logger.warning('%s (pid %d) did not stop within %ds, terminating it' % (self.name, self.process.pid, timeout))
+            self.process.terminate()
+        if isinstance(self.process, subprocess.Popen):
+            self.process.wait()
+        else:
+            self.process.join()
+
+
+class Supervisor(object):
+    def __init__(self, Config, logger):
+        self.Config = Config
+        self.logger = logger
+        self.collector = platformconfig.get_option(Config, 'supervisor', 'collector', COLLECTOR)
+        self.processors = platformconfig.get_int_option(Config, 'supervisor', 'processors', PROCESSORS)
+        self.inserters = platformconfig.get_int_option(Config, 'supervisor', 'inserters', INSERTERS)
+        queue_size = platformconfig.get_int_option(Config, 'supervisor', 'queue_size', QUEUE_SIZE)
+        self.scan_seconds = platformconfig.get_int_option(Config, 'supervisor', 'scan_seconds', SCAN_SECONDS)
+        self.restart_seconds = platformconfig.get_int_option(Config, 'supervisor', 'restart_seconds', RESTART_SECONDS)
+        self.max_restart_seconds = platformconfig.get_int_option(Config, 'supervisor', 'max_restart_seconds', MAX_RESTART_SECONDS)
+        self.status_seconds = platformconfig.get_int_option(Config, 'supervisor', 'status_seconds', STATUS_SECONDS)
+        self.lease_seconds = workqueue.lease_seconds_from_config(Config)
+
+        self.raw_queue = multiprocessing.Queue(queue_size)
+        self.insert_queue = multiprocessing.Queue(queue_size)
+        self.status_queue = multiprocessing.Queue()
+        self.processor_stop = multiprocessing.Event()
+        self.inserter_stop = multiprocessing.Event()
+        self.stopping = threading.Event()
+
+        # stage -> {pid: [files, lines, cpu seconds]}
+        self.stage_stats = dict((stage, {}) for stage in STAGES)
+        self.stats_lock = threading.Lock()
+        self.last_cpu = dict((stage, 0.0) for stage in STAGES)
+
+        self.workers = []
+        if self.collector != 'none':
+            self.workers.append(ManagedWorker('collector', 'collector-' + self.collector, self.start_collector,
+                self.restart_seconds, self.max_restart_seconds, logger))
+        for i in range(self.processors):
+            self.workers.append(ManagedWorker('processor', 'processor-%d' % i,
+                self.process_starter(ProcessorStage, self.raw_queue, self.insert_queue, self.processor_stop),
+                self.restart_seconds, self.max_restart_seconds, logger))
+        for i in range(self.inserters):
+            self.workers.append(ManagedWorker('inserter', 'inserter-%d' % i,
+                self.process_starter(InserterStage, self.insert_queue, None, self.inserter_stop),
+                self.restart_seconds, self.max_restart_seconds, logger))
+
+    def start_collector(self):
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ThreadedCollector.py')
+        # like the other workers it ignores ctrl-c and is stopped with SIGTERM
+        return subprocess.Popen([sys.executable, script, self.collector], preexec_fn=lambda: signal.signal(signal.SIGINT, signal.SIG_IGN))
+
+    def process_starter(self, stage_class, in_queue, out_queue, stop):
+        def start():
+            process = multiprocessing.Process(target=run_worker,
+                args=(stage_class, self.Config, in_queue, out_queue, self.status_queue, stop, self.restart_seconds))
+            process.start()
+            return process
+        return start
+
+    # Hands completed raw files and already processed files to the workers. Names
+    # stay in handed while they are listed, so a name is queued once; a name that
+    # disappears (claimed) and comes back (released or reclaimed) is queued again.
+    # With the job manifest the files come from it instead, oldest first.
+    def scanner(self):
+        raw_path = self.Config.get('files', 'raw_tweets_file_path', 0)
+        insert_path = self.Config.get('files', 'tweet_insert_queue', 0)
+        handed_raw = set()
+        handed_insert = set()
+        # opened here, so the connection belongs to this thread
+        manifest = jobmanifest.manifest_from_config(self.Config, self.logger)
+        if manifest:
+            raw_reader = jobmanifest.queue_reader_from_config(self.Config, manifest, 'raw', raw_path,
+                lambda: preprocess.get_tweet_file_queue(self.Config), 'sealed', 'processing', self.logger)
+            insert_reader = jobmanifest.queue_reader_from_config(self.Config, manifest, 'insert', insert_path,
+                lambda: mongoBatchInsert.get_processed_tweet_file_queue(self.Config), 'queued', 'inserting', self.logger)
+        while not self.stopping.is_set():
+            if manifest:
+                try:
+                    if self.processors:
+                        self.feed(raw_reader, self.raw_queue)
+                    if self.inserters:
+                        self.feed(insert_reader, self.insert_queue)
+                except (IOError, OSError, sqlite3.Error), e:
+                    self.logger.warning('Reading the job manifest failed: %s' % e)
+                self.stopping.wait(self.scan_seconds)
+                continue
+            try:
+                workqueue.reclaim_stale(raw_path, self.lease_seconds, self.logger)
+                workqueue.reclaim_stale(insert_path, self.lease_seconds, self.logger)
+                if self.processors:
+                    self.scan(sorted(preprocess.get_tweet_file_queue(self.Config)), handed_raw, self.raw_queue, SETTLE_SECONDS)
+                if self.inserters:
+                    self.scan(sorted(mongoBatchInsert.get_processed_tweet_file_queue(self.Config)), handed_insert, self.insert_queue, 0)
+            except (IOError, OSError), e:
+                self.logger.warning('Scanning the queue directories failed: %s' % e)
+            self.stopping.wait(self.scan_seconds)
+
+    def scan(self, file_list, handed, out_queue, settle_seconds):
+        handed.intersection_update(file_list)
+        now = time.time()
+        for file_name in file_list:
+            if file_name in handed:
+                continue
+            try:
+                if now - os.path.getmtime(file_name) < settle_seconds:
+                    continue
+            except OSError:
+                continue
+            try:
+                out_queue.put_nowait(file_name)
+            except Queue.Full:
+                # the workers are busy; the rest waits for the next scan
+                return
+            handed.add(file_name)
+
+    # Takes the oldest waiting files from the manifest while out_queue has room
+    def feed(self, reader, out_queue):
+        worker = workqueue.worker_id()
+        while not out_queue.full():
+            path = reader.take_file(worker)
+            if path is None:
+                return
+            try:
+                out_queue.put_nowait(path)
+            except Queue.Full:
+                # back to waiting for the next scan
+                reader.manifest.set_state(path, reader.state)
+                return
+
+    def status_reader(self):
+        while True:
+            message = self.status_queue.get()
+            if message is None:
+                return
+            pid, lines, cpu = message
+            stage = self.stage_of(pid)
+            if stage is None:
+                continue
+            with self.stats_lock:
+                stats = self.stage_stats[stage].setdefault(pid, [0, 0, 0.0])
+                if lines:
+                    stats[0] += 1
+                    stats[1] += lines
+                stats[2] = cpu
+
+    def stage_of(self, pid):
+        for worker in self.workers:
+            if worker.process is not None and worker.process.pid == pid:
+                return worker.stage
+        return None
+
+    # Files, lines and CPU seconds per stage since the supervisor started, plus the
+    # share of one core each stage used over the last interval.
+    def log_status(self, interval):
+        for worker in self.workers:
+            if worker.stage == 'collector' and worker.alive():
+                cpu = process_cpu_seconds(worker.process.pid)
+                if cpu is not None:
+                    with self.stats_lock:
+                        self.stage_stats['collector'].setdefault(worker.process.pid, [0, 0, 0.0])[2] = cpu
+        parts = []
+        with self.stats_lock:
+            for stage in STAGES:
+                workers = [worker for worker in self.workers if worker.stage == stage]
+                if not workers:
+                    continue
+                stats = self.stage_stats[stage].values()
+                files = sum(s[0] for s in stats)
+                lines = sum(s[1] for s in stats)
+                cpu = sum(s[2] for s in stats)
+                share = 100.0 * (cpu - self.last_cpu[stage]) / interval if interval else 0.0
+                self.last_cpu[stage] = cpu
+                alive = len([worker for worker in workers if worker.alive()])
+                parts.append('%s %d/%d up, %d files, %d lines, %.1fs CPU (%.0f%% of a core), %d restarts' % (
+                    stage, alive, len(workers), files, lines, cpu, share, sum(worker.restarts for worker in workers)))
+        parts.append('queues raw %d, insert %d' % (self.raw_queue.qsize(), self.insert_queue.qsize()))
+        self.logger.info('; '.join(parts))
+
+    def request_stop(self, signum=None, frame=None):
+        if not self.stopping.is_set():
+            self.logger.info('Stop requested')
+            self.stopping.set()
+
+    def run_flag(self, tweet_storage):
+        try:
+            flags = tweet_storage.get_flags('supervisor')
+        except Exception, e:
+            self.logger.warning('Could not read the supervisor flags: %s' % e)
+            return True
+        # without a supervisor flag module, run until signalled
+        return flags is None or bool(flags.get('run', 1))
+
+    def run(self, tweet_storage):
+        signal.signal(signal.SIGTERM, self.request_stop)
+        signal.signal(signal.SIGINT, self.request_stop)
+
+        for worker in self.workers:
+            worker.start()
+        threads = [threading.Thread(target=self.scanner, name='scanner'),
+                   threading.Thread(target=self.status_reader, name='status')]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        last_status = time.time()
+        while not self.stopping.is_set():
+            self.stopping.wait(1)
+            now = time.time()
+            if not self.stopping.is_set():
+                for worker in self.workers:
+                    worker.check(now)
+            if now - last_status >= self.status_seconds:
+                if not self.run_flag(tweet_storage):
+                    self.logger.info('Supervisor run flag is 0')
+                    self.stopping.set()
+                self.log_status(now - last_status)
+                last_status = now
+
+        self.shutdown(last_status)
+
+    # The collector stops first so nothing new arrives, then the processors and
+    # then the inserters each finish the file they are on. Whatever is still
+    # queued stays on disk for the next start.
+    def shutdown(self, last_status):
+        for stage, stop in [('collector', None), ('processor', self.processor_stop), ('inserter', self.inserter_stop)]:
+            workers = [worker for worker in self.workers if worker.stage == stage]
+            if stop is not None:
+                stop.set()
+            elif workers:
+                for worker in workers:
+                    if worker.alive():
+                        worker.process.send_signal(signal.SIGTERM)
+            for worker in workers:
+                self.logger.info('Stopping %s' % worker.name)
+                worker.stop(self.lease_seconds)
+        time.sleep(0.5)
+        self.status_queue.put(None)
+        self.log_status(time.time() - last_status)
+        self.logger.info('Supervisor stopped')
+
+
+if __name__ == '__main__':
+
+    Config = ConfigParser.ConfigParser()
+    Config.read(PLATFORM_CONFIG_FILE)
+    mongoclient.configure(Config)
+
+    logDir = Config.get('files', 'log_dir', 0)
+    if not os.path.exists(logDir):
+        os.makedirs(logDir)
+    logger = file_logger('supervisor', './logs/log-supervisor.out')
+    logger.info('Starting supervisor')
+
+    supervisor = Supervisor(Config, logger)
+    supervisor.run(storage.storage_from_config(Config, logger))
+    print 'Exiting supervisor...'
@@ -0,0 +1,387 @@
+#-------------------------------------------------------------------------------
+# Name:        Local inverted index over the archive.
+# Purpose:     Finds the tweets with a track keyword, hashtag, mention or user
+#              id in a range of days straight from the archive, without Mongo.
+#
+# Keys are kw:<track keyword>, tag:<hashtag>, at:<mention> and user:<user id>.
+# The processor feeds every processed file through an IndexWriter (a tweet
+# sink, see preprocess.open_tweet_sinks), which writes one run per day of
+# created_ts under index_dir/<YYYYMMDD>/:
+#   <name>.post   the postings: the sorted tweet ids of each key as varint deltas
+#   <name>.loc    (tweet id, source, byte offset) records sorted by id, locating
+#                 each tweet in the processed file it came from
+#   <name>.keys   a JSON header with the source files, then one sorted
+#                 "key<TAB>count<TAB>offset<TAB>length" line per key; it is
+#                 renamed into place last, so a run without it is ignored
+# A day's runs are searched one by one; python tweetindex.py merge folds them
+# into one. Queries read the records from the processed files in
+# tweet_archive_dir, or from the processed segments archivecompactor.py made
+# of them once the files are compacted.
+#
+#   python tweetindex.py query <key> [<key> ...] [--from YYYY-MM-DD] [--to YYYY-MM-DD] [--ids | --count]
+#       the processed tweets with every key, from and to (excluded) the given days
+#   python tweetindex.py build <processed file> [<processed file> ...]
+#       indexes files that were processed before the index was enabled
+#   python tweetindex.py merge [YYYYMMDD ...]
+#       merges the runs of the given days, or of every day before today
+#
+# [index] enabled turns the sink on; index_dir names the directory (./index/).
+#-------------------------------------------------------------------------------
+
+import os
+import sys
+import glob
+import time
+import mmap
+import struct
+import logging
+import ConfigParser
+from datetime import datetime
+
+import simplejson
+import linereader
+import platformconfig
+import archivecompactor
+
+PLATFORM_CONFIG_FILE = 'platform.ini'
+INDEX_DIR = './index/'
+KEY_KINDS = ['kw', 'tag', 'at', 'user']
+LOCATION_RECORD = struct.Struct('<qIQ')
+
+logger = logging.getLogger('tweet_index')
+
+
+def index_enabled(Config):
+    return platformconfig.get_boolean_option(Config, 'index', 'enabled', False)
+
+def index_dir_from_config(Config):
+    return platformconfig.get_option(Config, 'index', 'index_dir', INDEX_DIR)
+
+def encode_postings(ids):
+    out = []
+    previous = 0
+    for tweet_id in ids:
+        delta = tweet_id - previous
+        previous = tweet_id
+        while delta > 0x7f:
+            out.append(chr((delta & 0x7f) | 0x80))
+            delta >>= 7
+        out.append(chr(delta))
+    return ''.join(out)
+
+def decode_postings(data):
+    ids = []
+    tweet_id = 0
+    delta = 0
+    shift = 0
+    for byte in data:
+        byte = ord(byte)
+        delta |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            tweet_id += delta
+            ids.append(tweet_id)
+            delta = 0
+            shift = 0
+    return ids
+
+# The index keys of a processed tweet
+def tweet_keys(tweet):
+    keys = set()
+    for matched in tweet.get('track_kw', {}).itervalues():
+        keys.update('kw:' + keyword for keyword in matched)
+    keys.update('tag:' + hashtag for hashtag in tweet.get('hashtags', []))
+    keys.update('at:' + mention for mention in tweet.get('mentions', []))
+    if 'user' in tweet and 'id' in tweet['user']:
+        keys.add('user:%d' % tweet['user']['id'])
+    # the keys file is tab separated, one key a line
+    return [key.encode('utf-8') for key in keys if '\t' not in key and '\n' not in key]
+
+def write_run(day_dir, name, sources, postings, locations):
+    if not os.path.exists(day_dir):
+        os.makedirs(day_dir)
+    base = os.path.join(day_dir, name)
+    key_lines = []
+    with open(base + '.post.tmp', 'wb') as f:
+        for key in sorted(postings):
+            ids = sorted(set(postings[key]))
+            data = encode_postings(ids)
+            key_lines.append('%s\t%d\t%d\t%d\n' % (key, len(ids), f.tell(), len(data)))
+            f.write(data)
+    locations.sort()
+    with open(base + '.loc.tmp', 'wb') as f:
+        f.write(''.join(LOCATION_RECORD.pack(*location) for location in locations))
+    with open(base + '.keys.tmp', 'wb') as f:
+        f.write(simplejson.dumps({'sources': sources, 'tweets': len(locations), 'created': time.strftime('%Y-%m-%d %H:%M:%S')}) + '\n')
+        f.writelines(key_lines)
+    for extension in ['.post', '.loc', '.keys']:
+        os.rename(base + extension + '.tmp', base + extension)
+    return base
+
+
+class IndexWriter(object):
+    """ A tweet sink: collects the keys and offsets of the tweets of one processed
+        file and writes a run for each day of created_ts on close().
+    """
+    def __init__(self, index_dir, processed_tweets_file, logger):
+        self.index_dir = index_dir
+        self.source = os.path.basename(processed_tweets_file)
+        self.logger = logger
+        self.days = {}
+
+    def add(self, tweet, offset=None):
+        if offset is None or 'created_ts' not in tweet or 'id' not in tweet:
+            return
+        day = tweet['created_ts'][:10].replace('-', '')
+        postings, locations = self.days.setdefault(day, ({}, []))
+        for key in tweet_keys(tweet):
+            postings.setdefault(key, []).append(tweet['id'])
+        locations.append((tweet['id'], 0, offset))
+
+    def close(self):
+        name = os.path.splitext(self.source)[0]
+        for day, (postings, locations) in sorted(self.days.items()):
+            write_run(os.path.join(self.index_dir, day), name, [self.source], postings, locations)
+            self.logger.info('Indexed %d tweets and %d keys of %s for %s' % (len(locations), len(postings), self.source, day))
+        self.days = {}
+
+def index_writer_from_config(Config, processed_tweets_file, logger):
+    if not index_enabled(Config):
+        return None
+    return IndexWriter(index_dir_from_config(Config), processed_tweets_file, logger)
+
+
+class Run(object):
+    """ One run of a day: run.header, run.postings(key), run.locate(tweet_id). """
+    def __init__(self, keys_file):
+        self.base = keys_file[:-len('.keys')]
+        self.keys_file = keys_file
+        with open(keys_file, 'rb') as f:
+            self.header = simplejson.loads(f.readline())
+            self.first_key = f.tell()
+
+    # (offset, length) of the postings of key, by binary search of the sorted
+    # key lines: the lines before low have smaller keys, the lines from high on
+    # do not
+    def key_entry(self, key):
+        with open(self.keys_file, 'rb') as f:
+            low = self.first_key
+            high = os.fstat(f.fileno()).st_size
+            while low < high:
+                start = linereader.line_start(f, (low + high) / 2)
+                if start >= high:
+                    break
+                f.seek(start)
+                line = f.readline()
+                if line.split('\t', 1)[0] < key:
+                    low = start + len(line)
+                else:
+                    high = start
+            f.seek(low)
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if fields[0] >= key:
+                    if fields[0] == key:
+                        return int(fields[2]), int(fields[3])
+                    break
+        return None
+
+    def postings(self, key):
+        entry = self.key_entry(key)
+        if entry is None:
+            return []
+        with open(self.base + '.post', 'rb') as f:
+            f.seek(entry[0])
+            return decode_postings(f.read(entry[1]))
+
+    def keys(self):
+        with open(self.keys_file, 'rb') as f:
+            f.readline()
+            for line in f:
+                key, count, offset, length = line.rstrip('\n').split('\t')
+                yield key, int(offset), int(length)
+
+    def locations(self):
+        with open(self.base + '.loc', 'rb') as f:
+            data = f.read()
+        return [LOCATION_RECORD.unpack_from(data, offset) for offset in range(0, len(data), LOCATION_RECORD.size)]
+
+    # (source file name, byte offset) of a tweet, or None
+    def locate(self, tweet_id):
+        size = os.path.getsize(self.base + '.loc')
+        if not size:
+            return None
+        with open(self.base + '.loc', 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            low, high = 0, size / LOCATION_RECORD.size
+            while low < high:
+                middle = (low + high) / 2
+                if LOCATION_RECORD.unpack_from(data, middle * LOCATION_RECORD.size)[0] < tweet_id:
+                    low = middle + 1
+                else:
+                    high = middle
+            if low * LOCATION_RECORD.size < size:
+                found_id, source, offset = LOCATION_RECORD.unpack_from(data, low * LOCATION_RECORD.size)
+                if found_id == tweet_id:
+                    return self.header['sources'][source], offset
+        finally:
+            data.close()
+        return None
+
+def day_runs(index_dir, day):
+    return [Run(keys_file) for keys_file in sorted(glob.glob(os.path.join(index_dir, day, '*.keys')))]
+
+def index_days(index_dir):
+    return sorted(os.path.basename(path) for path in glob.glob(os.path.join(index_dir, '[0-9]' * 8)))
+
+# {day: [tweet ids]} of the tweets with every key, in [start, end)
+def query(index_dir, keys, start, end):
+    matches = {}
+    for day in index_days(index_dir):
+        day_date = datetime.strptime(day, '%Y%m%d')
+        if (start and day_date < start) or (end and day_date >= end):
+            continue
+        runs = day_runs(index_dir, day)
+        day_ids = None
+        for key in keys:
+            key_ids = set()
+            for run in runs:
+                key_ids.update(run.postings(key))
+            day_ids = key_ids if day_ids is None else day_ids & key_ids
+        if day_ids:
+            matches[day] = sorted(day_ids)
+    return matches
+
+
+class RecordReader(object):
+    """ Reads the processed lines of tweets found in a day's runs, from the files
+        in tweet_archive_dir or from the processed segments of that day.
+    """
+    def __init__(self, Config, index_dir):
+        self.archive_dir = Config.get('files', 'tweet_archive_dir', 0)
+        self.settings = archivecompactor.ArchiveSettings(Config)
+        self.index_dir = index_dir
+        self.runs = {}
+        self.segments = {}
+
+    def segments_of(self, day):
+        if day not in self.segments:
+            self.segments[day] = [archivecompactor.Segment(segment) for segment in archivecompactor.list_segments(self.settings, 'processed')
+                if archivecompactor.segment_day(segment) == day]
+        return self.segments[day]
+
+    def record(self, day, tweet_id):
+        if day not in self.runs:
+            self.runs[day] = day_runs(self.index_dir, day)
+        for run in self.runs[day]:
+            location = run.locate(tweet_id)
+            if location is None:
+                continue
+            source, offset = location
+            path = os.path.join(self.archive_dir, source)
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    f.seek(offset)
+                    return f.readline()
+            # the file was compacted into a segment of the day in its name
+            source_day = archivecompactor.archive_file_date(source, self.settings.date_format)
+            for segment in self.segments_of(source_day.strftime('%Y%m%d') if source_day else day):
+                lines = segment.get(tweet_id)
+                if lines:
+                    return lines[0]
+        return None
+
+# Merges all the runs of a day into one. Returns the number of runs merged.
+def merge_day(index_dir, day, logger):
+    runs = day_runs(index_dir, day)
+    if len(runs) < 2:
+        return 0
+    sources = []
+    postings = {}
+    locations = []
+    for run in runs:
+        source_numbers = [len(sources) + number for number in range(len(run.header['sources']))]
+        sources.extend(run.header['sources'])
+        with open(run.base + '.post', 'rb') as f:
+            data = f.read()
+        for key, offset, length in run.keys():
+            postings.setdefault(key, []).extend(decode_postings(data[offset:offset + length]))
+        locations.extend((tweet_id, source_numbers[source], offset) for tweet_id, source, offset in run.locations())
+    base = write_run(os.path.join(index_dir, day), 'merged-%d' % int(time.time() * 1000), sources, postings, locations)
+    for run in runs:
+        for extension in ['.keys', '.post', '.loc']:
+            os.remove(run.base + extension)
+    logger.info('Merged %d runs of %s into %s: %d keys, %d tweets' % (len(runs), day, base, len(postings), len(locations)))
+    return len(runs)
+
+# Indexes a processed file that is already in the archive.
+def build(index_dir, processed_file, logger):
+    writer = IndexWriter(index_dir, processed_file, logger)
+    for offset, line in linereader.iter_lines(processed_file):
+        try:
+            writer.add(simplejson.loads(line), offset)
+        except ValueError:
+            pass
+    writer.close()
+
+
+if __name__ == '__main__':
+
+    commands = ['query', 'build', 'merge']
+    if len(sys.argv) < 2 or sys.argv[1] not in commands or (sys.argv[1] in ('query', 'build') and len(sys.argv) < 3):
+        print "To run: python tweetindex.py query <%s>:<value> [<key> ...] [--from YYYY-MM-DD] [--to YYYY-MM-DD] [--ids | --count]" % '|'.join(KEY_KINDS)
+        print "        python tweetindex.py build <processed file> [<processed file> ...]"
+        print "        python tweetindex.py merge [YYYYMMDD ...]"
+        sys.exit()
+
+    Config = ConfigParser.ConfigParser()
+    Config.read(PLATFORM_CONFIG_FILE)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s', datefmt='%m-%d %H:%M')
+    logger = logging.getLogger('tweet_index')
+
+    index_dir = index_dir_from_config(Config)
+    command = sys.argv[1]
+    args = sys.argv[2:]
+
+    if command == 'query':
+        start = end = None
+        output = 'records'
+        keys = []
+        while args:
+            arg = args.pop(0)
+            if arg == '--from':
+                start = datetime.strptime(args.pop(0), '%Y-%m-%d')
+            elif arg == '--to':
+                end = datetime.strptime(args.pop(0), '%Y-%m-%d')
+            elif arg in ('--ids', '--count'):
+                output = arg[2:]
+            else:
+                # hashtags and mentions are indexed lower case
+                keys.append(arg if arg.startswith('user:') else arg.lower())
+        matches = query(index_dir, keys, start, end)
+        if output == 'count':
+            for day in sorted(matches):
+                print '%s %d' % (day, len(matches[day]))
+            print 'total %d' % sum(len(ids) for ids in matches.values())
+        else:
+            reader = RecordReader(Config, index_dir)
+            for day in sorted(matches):
+                for tweet_id in matches[day]:
+                    if output == 'ids':
+                        print tweet_id
+                        continue
+                    record = reader.record(day, tweet_id)
+                    if record is None:
+                        logger.warning('Tweet %d of %s is in the index but not in the archive' % (tweet_id, day))
+                    else:
+                        sys.stdout.write(record)
+    elif command == 'build':
+        for processed_file in args:
+            build(index_dir, processed_file, logger)
+    elif command == 'merge':
+        today = datetime.now().strftime('%Y%m%d')
+        days = args or [day for day in index_days(index_dir) if day < today]
+        print 'Merged %d runs' % sum(merge_day(index_dir, day, logger) for day in days)
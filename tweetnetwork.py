@@ -0,0 +1,366 @@
+#-------------------------------------------------------------------------------
+# Name:        Retweet and mention network builder.
+# Purpose:     Keeps the edges between users as the tweets are processed, so
+#              networks for any window are read from small binary files
+#              instead of pulling every tweet back out of Mongo.
+#
+# A NetworkWriter (a tweet sink, see preprocess.open_tweet_sinks) takes from
+# every processed tweet the edges from its author to:
+#   retweet   the author of retweeted_status
+#   quote     the author of quoted_status
+#   reply     in_reply_to_user_id
+#   mention   each user in entities.user_mentions (not for retweets: their
+#             mentions are the original tweet's)
+# User ids are mapped to dense integers (1, 2, 3, ...) in a SQLite table that
+# also keeps each user's screen name, shared by every processor. Once a file
+# is processed its edges are written, in EDGE_RECORD records (type, source,
+# target, created time, tweet id), to one file per hour of created_at:
+#   network_dir/<YYYYMMDD>/<HH>-<processed file>.edges
+# At 21 bytes an edge, a window is read back with one unpack per record and
+# no JSON parsing.
+#
+#   python tweetnetwork.py export <start YYYYmmddHH> <end YYYYmmddHH> <edgelist | graphml> [output file] [--types retweet,mention,...] [--weighted]
+#       the edges created in [start, end); edge lists have one "source target
+#       type time tweet_id" line per edge (or "source target type weight" with
+#       --weighted), user ids as in Twitter; GraphML is always weighted and
+#       carries screen names
+#   python tweetnetwork.py build <processed file> [<processed file> ...]
+#       adds the edges of files processed before the network was enabled
+#   python tweetnetwork.py stats [<start YYYYmmddHH> <end YYYYmmddHH>]
+#       users mapped and edges per type
+#
+# [network] enabled turns the sink on; network_dir names the directory
+# (./network/), types the edge types kept and user_map the SQLite file of the
+# dense ids (network_dir/users.sqlite).
+#-------------------------------------------------------------------------------
+
+import os
+import sys
+import glob
+import time
+import struct
+import sqlite3
+import logging
+import ConfigParser
+from datetime import datetime
+from xml.sax.saxutils import escape
+
+import linereader
+import simplejson
+import platformconfig
+from freshness import created_time
+
+PLATFORM_CONFIG_FILE = 'platform.ini'
+NETWORK_DIR = './network/'
+USER_MAP_FILE = 'users.sqlite'
+EDGE_TYPES = ['retweet', 'quote', 'reply', 'mention']
+EDGE_RECORD = struct.Struct('<BIIIq')
+# SQLite's limit on the parameters of one statement is 999
+LOOKUP_CHUNK = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    dense INTEGER PRIMARY KEY,
+    user_id INTEGER UNIQUE NOT NULL,
+    screen_name TEXT
+);
+"""
+
+logger = logging.getLogger('tweet_network')
+
+
+def network_enabled(Config):
+    return platformconfig.get_boolean_option(Config, 'network', 'enabled', False)
+
+def network_dir_from_config(Config):
+    return platformconfig.get_option(Config, 'network', 'network_dir', NETWORK_DIR)
+
+def edge_types_from_config(Config):
+    types = platformconfig.get_option(Config, 'network', 'types', ','.join(EDGE_TYPES))
+    return [edge_type.strip() for edge_type in types.split(',') if edge_type.strip() in EDGE_TYPES]
+
+# [(type, source user id, target user id)] and {user id: screen name} of a tweet
+def tweet_edges(tweet, edge_types):
+    user = tweet['user']
+    source = user['id']
+    edges = []
+    names = {source: user.get('screen_name')}
+    retweeted = tweet.get('retweeted_status')
+    if 'retweet' in edge_types and retweeted and 'user' in retweeted:
+        edges.append(('retweet', source, retweeted['user']['id']))
+        names[retweeted['user']['id']] = retweeted['user'].get('screen_name')
+    quoted = tweet.get('quoted_status')
+    if 'quote' in edge_types and quoted and 'user' in quoted:
+        edges.append(('quote', source, quoted['user']['id']))
+        names[quoted['user']['id']] = quoted['user'].get('screen_name')
+    if 'reply' in edge_types and tweet.get('in_reply_to_user_id') is not None:
+        edges.append(('reply', source, tweet['in_reply_to_user_id']))
+        names.setdefault(tweet['in_reply_to_user_id'], tweet.get('in_reply_to_screen_name'))
+    if 'mention' in edge_types and not retweeted:
+        mentioned = set()
+        for mention in tweet.get('entities', {}).get('user_mentions', []):
+            if mention.get('id') is not None and mention['id'] not in mentioned:
+                mentioned.add(mention['id'])
+                edges.append(('mention', source, mention['id']))
+                names.setdefault(mention['id'], mention.get('screen_name'))
+    return edges, names
+
+
+class UserMap(object):
+    """ User id <-> dense id, in a SQLite table shared by every processor; each
+        process keeps the ids it has seen in memory.
+    """
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript(SCHEMA)
+        self.dense = {}
+
+    def lookup(self, user_ids):
+        for start in range(0, len(user_ids), LOOKUP_CHUNK):
+            chunk = user_ids[start:start + LOOKUP_CHUNK]
+            for dense, user_id in self.connection.execute('SELECT dense, user_id FROM users WHERE user_id IN (%s)' % ','.join('?' * len(chunk)), chunk):
+                self.dense[user_id] = dense
+
+    # Maps every user of names ({user id: screen name}) to a dense id, adding new
+    # users in one transaction. Returns {user id: dense id}.
+    def map(self, names):
+        missing = [user_id for user_id in names if user_id not in self.dense]
+        self.lookup(missing)
+        missing = [user_id for user_id in missing if user_id not in self.dense]
+        if missing:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                self.connection.executemany('INSERT OR IGNORE INTO users (user_id, screen_name) VALUES (?, ?)',
+                    [(user_id, names[user_id]) for user_id in missing])
+                self.connection.execute('COMMIT')
+            except:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.lookup(missing)
+        return self.dense
+
+    # {dense id: (user id, screen name)}
+    def users(self, dense_ids):
+        dense_ids = list(dense_ids)
+        users = {}
+        for start in range(0, len(dense_ids), LOOKUP_CHUNK):
+            chunk = dense_ids[start:start + LOOKUP_CHUNK]
+            for dense, user_id, screen_name in self.connection.execute('SELECT dense, user_id, screen_name FROM users WHERE dense IN (%s)' % ','.join('?' * len(chunk)), chunk):
+                users[dense] = (user_id, screen_name)
+        return users
+
+    def count(self):
+        return self.connection.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+def user_map_from_config(Config):
+    return UserMap(platformconfig.get_option(Config, 'network', 'user_map', os.path.join(network_dir_from_config(Config), USER_MAP_FILE)))
+
+
+class NetworkWriter(object):
+    """ A tweet sink: collects the edges of one processed file and writes them,
+        with dense user ids, to one edge file per hour on close().
+    """
+    def __init__(self, network_dir, user_map, edge_types, processed_tweets_file, logger):
+        self.network_dir = network_dir
+        self.user_map = user_map
+        self.edge_types = edge_types
+        self.name = os.path.splitext(os.path.basename(processed_tweets_file))[0]
+        self.logger = logger
+        self.hours = {}
+        self.names = {}
+
+    def add(self, tweet, offset=None):
+        created = created_time(tweet)
+        if created is None or 'user' not in tweet or 'created_ts' not in tweet or 'id' not in tweet:
+            return
+        edges, names = tweet_edges(tweet, self.edge_types)
+        if not edges:
+            return
+        self.names.update(names)
+        hour = tweet['created_ts'][:13]
+        created = int(created)
+        self.hours.setdefault(hour, []).extend((EDGE_TYPES.index(edge_type), source, target, created, tweet['id'])
+            for edge_type, source, target in edges)
+
+    def close(self):
+        if not self.hours:
+            self.user_map.close()
+            return
+        dense = self.user_map.map(self.names)
+        for hour, edges in sorted(self.hours.items()):
+            day_dir = os.path.join(self.network_dir, hour[:10].replace('-', ''))
+            if not os.path.exists(day_dir):
+                os.makedirs(day_dir)
+            edge_file = os.path.join(day_dir, '%s-%s.edges' % (hour[11:13], self.name))
+            with open(edge_file + '.tmp', 'wb') as f:
+                f.write(''.join(EDGE_RECORD.pack(edge_type, dense[source], dense[target], created, tweet_id)
+                    for edge_type, source, target, created, tweet_id in edges))
+            os.rename(edge_file + '.tmp', edge_file)
+        self.logger.info('Wrote %d edges of %s in %d hours' % (sum(len(edges) for edges in self.hours.values()), self.name, len(self.hours)))
+        self.hours = {}
+        self.names = {}
+        self.user_map.close()
+
+def network_writer_from_config(Config, processed_tweets_file, logger):
+    if not network_enabled(Config):
+        return None
+    return NetworkWriter(network_dir_from_config(Config), user_map_from_config(Config), edge_types_from_config(Config),
+        processed_tweets_file, logger)
+
+
+# The edge files of the hours in [start, end), both datetimes
+def edge_files(network_dir, start, end):
+    files = []
+    for day_dir in sorted(glob.glob(os.path.join(network_dir, '[0-9]' * 8))):
+        for edge_file in sorted(glob.glob(os.path.join(day_dir, '*.edges'))):
+            hour = datetime.strptime(os.path.basename(day_dir) + os.path.basename(edge_file)[:2], '%Y%m%d%H')
+            if start <= hour < end:
+                files.append(edge_file)
+    return files
+
+# Yields (type, source, target, created, tweet id) with dense ids
+def read_edges(edge_file):
+    with open(edge_file, 'rb') as f:
+        data = f.read()
+    unpack_from = EDGE_RECORD.unpack_from
+    for offset in range(0, len(data) - EDGE_RECORD.size + 1, EDGE_RECORD.size):
+        yield unpack_from(data, offset)
+
+def window_edges(network_dir, start, end, edge_types):
+    type_numbers = set(EDGE_TYPES.index(edge_type) for edge_type in edge_types)
+    for edge_file in edge_files(network_dir, start, end):
+        for edge in read_edges(edge_file):
+            if edge[0] in type_numbers:
+                yield edge
+
+# {(type, source, target): weight}
+def weigh_edges(edges):
+    weights = {}
+    for edge_type, source, target, created, tweet_id in edges:
+        key = (edge_type, source, target)
+        weights[key] = weights.get(key, 0) + 1
+    return weights
+
+def write_edgelist(out, user_map, edges, weighted):
+    if weighted:
+        weights = weigh_edges(edges)
+        users = user_map.users(set(key[1] for key in weights) | set(key[2] for key in weights))
+        for (edge_type, source, target), weight in sorted(weights.iteritems()):
+            out.write('%d %d %s %d\n' % (users[source][0], users[target][0], EDGE_TYPES[edge_type], weight))
+        return len(weights)
+    written = 0
+    # one chunk at a time, so the user lookups stay batched without holding every edge
+    chunk = []
+    for edge in edges:
+        chunk.append(edge)
+        if len(chunk) == 100000:
+            written += write_edge_chunk(out, user_map, chunk)
+            chunk = []
+    return written + write_edge_chunk(out, user_map, chunk)
+
+def write_edge_chunk(out, user_map, chunk):
+    users = user_map.users(set(edge[1] for edge in chunk) | set(edge[2] for edge in chunk))
+    for edge_type, source, target, created, tweet_id in chunk:
+        out.write('%d %d %s %d %d\n' % (users[source][0], users[target][0], EDGE_TYPES[edge_type], created, tweet_id))
+    return len(chunk)
+
+def write_graphml(out, user_map, edges):
+    weights = weigh_edges(edges)
+    users = user_map.users(set(key[1] for key in weights) | set(key[2] for key in weights))
+    out.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+    out.write('<graphml xmlns="http://graphml.graphdrawing.org/xmlns">\n')
+    out.write('  <key id="user_id" for="node" attr.name="user_id" attr.type="string"/>\n')
+    out.write('  <key id="screen_name" for="node" attr.name="screen_name" attr.type="string"/>\n')
+    out.write('  <key id="type" for="edge" attr.name="type" attr.type="string"/>\n')
+    out.write('  <key id="weight" for="edge" attr.name="weight" attr.type="int"/>\n')
+    out.write('  <graph id="G" edgedefault="directed">\n')
+    for dense, (user_id, screen_name) in sorted(users.iteritems()):
+        out.write('    <node id="n%d"><data key="user_id">%d</data><data key="screen_name">%s</data></node>\n'
+            % (dense, user_id, escape(screen_name or '').encode('utf-8')))
+    for (edge_type, source, target), weight in sorted(weights.iteritems()):
+        out.write('    <edge source="n%d" target="n%d"><data key="type">%s</data><data key="weight">%d</data></edge>\n'
+            % (source, target, EDGE_TYPES[edge_type], weight))
+    out.write('  </graph>\n</graphml>\n')
+    return len(weights)
+
+# Adds the edges of a processed file that is already in the archive.
+def build(Config, processed_file, logger):
+    writer = NetworkWriter(network_dir_from_config(Config), user_map_from_config(Config), edge_types_from_config(Config),
+        processed_file, logger)
+    for offset, line in linereader.iter_lines(processed_file):
+        try:
+            writer.add(simplejson.loads(line), offset)
+        except (ValueError, TypeError, KeyError):
+            pass
+    writer.close()
+
+
+if __name__ == '__main__':
+
+    commands = ['export', 'build', 'stats']
+    if len(sys.argv) < 2 or sys.argv[1] not in commands or (sys.argv[1] == 'export' and len(sys.argv) < 5) \
+            or (sys.argv[1] == 'build' and len(sys.argv) < 3):
+        print "To run: python tweetnetwork.py export <start YYYYmmddHH> <end YYYYmmddHH> <edgelist | graphml> [output file] [--types %s] [--weighted]" % ','.join(EDGE_TYPES)
+        print "        python tweetnetwork.py build <processed file> [<processed file> ...]"
+        print "        python tweetnetwork.py stats [<start YYYYmmddHH> <end YYYYmmddHH>]"
+        sys.exit()
+
+    Config = ConfigParser.ConfigParser()
+    Config.read(PLATFORM_CONFIG_FILE)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s', datefmt='%m-%d %H:%M')
+    logger = logging.getLogger('tweet_network')
+
+    network_dir = network_dir_from_config(Config)
+    command = sys.argv[1]
+
+    if command == 'build':
+        for processed_file in sys.argv[2:]:
+            build(Config, processed_file, logger)
+        sys.exit()
+
+    args = sys.argv[2:]
+    edge_types = EDGE_TYPES
+    weighted = False
+    if '--types' in args:
+        position = args.index('--types')
+        edge_types = [edge_type for edge_type in args[position + 1].split(',') if edge_type in EDGE_TYPES]
+        del args[position:position + 2]
+    if '--weighted' in args:
+        weighted = True
+        args.remove('--weighted')
+
+    user_map = user_map_from_config(Config)
+    if command == 'stats':
+        start = datetime.strptime(args[0], '%Y%m%d%H') if len(args) > 1 else datetime.min
+        end = datetime.strptime(args[1], '%Y%m%d%H') if len(args) > 1 else datetime.max
+        counts = [0] * len(EDGE_TYPES)
+        files = edge_files(network_dir, start, end)
+        for edge_file in files:
+            for edge in read_edges(edge_file):
+                counts[edge[0]] += 1
+        print '%d users mapped, %d edge files' % (user_map.count(), len(files))
+        for edge_type, count in zip(EDGE_TYPES, counts):
+            print '%-8s %d' % (edge_type, count)
+        sys.exit()
+
+    start = datetime.strptime(args[0], '%Y%m%d%H')
+    end = datetime.strptime(args[1], '%Y%m%d%H')
+    output_format = args[2]
+    out = open(args[3], 'w') if len(args) > 3 else sys.stdout
+    began = time.time()
+    edges = window_edges(network_dir, start, end, edge_types)
+    if output_format == 'graphml':
+        written = write_graphml(out, user_map, edges)
+    else:
+        written = write_edgelist(out, user_map, edges, weighted)
+    if out is not sys.stdout:
+        out.close()
+    logger.info('Exported %d %sedges from %s to %s in %.1fs' % (written, 'weighted ' if weighted or output_format == 'graphml' else '', args[0], args[1], time.time() - began))
@@ -12,8 +12,15 @@ import simplejson
 import re
 import hashlib
 import string
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import traceback
+from timeit import default_timer as timer
+
+RETWEET_CACHE_SIZE = 10000
+# the top level keys enrich_tweet adds, next to user.created_ts
+DERIVED_KEYS = ('hashtags', 'codes', 'mentions', 'track_kw', 'counts', 'text_hash', 'created_ts')
+USER_KEY = re.compile(r'"user"\s*:\s*\{')
+json_decoder = simplejson.JSONDecoder()
 
 
 # Parse Twitter created_at datestring and turn it into
@@ -30,6 +37,68 @@ def ck_coded_url(urlstring):
 	else:
 		return None
 
+class RetweetCache(object):
+    """ Bounded LRU cache of the sets derived from a retweeted_status, keyed
+    on the original tweet's id_str. A viral tweet can be retweeted thousands
+    of times in one file, and its entities and text never change between them.
+    """
+    def __init__(self, max_size=RETWEET_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, original_id):
+        try:
+            derived = self.entries.pop(original_id)
+        except KeyError:
+            self.misses += 1
+            return None
+        # re-insert so the entry becomes the most recently used
+        self.entries[original_id] = derived
+        self.hits += 1
+        return derived
+
+    def put(self, original_id, derived):
+        self.entries[original_id] = derived
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0.0
+        return float(self.hits) / lookups
+
+    def stats_string(self):
+        return 'retweet cache: %d hits, %d misses, %d evictions, hit rate %.1f%%, %d entries' % (self.hits, self.misses, self.evictions, 100 * self.hit_rate(), len(self.entries))
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+# Lower cased hashtags, mentions, text tokens and urls of a retweeted_status,
+# plus its url count. These are unioned with the retweet's own values.
+def extract_retweet_sets(retweeted_status, punct):
+    rt_hashtags = set()
+    rt_mentions = set()
+
+    for hashtag in retweeted_status['entities']['hashtags']:
+        rt_hashtags.add(hashtag['text'].lower())
+    for mention in retweeted_status['entities']['user_mentions']:
+        rt_mentions.add(mention['screen_name'].lower())
+
+    rt_text = re.sub('[%s]' % punct, ' ', retweeted_status['text'])
+    rt_tokens = set(rt_text.lower().split())
+
+    rt_urls = set([url['url'] for url in retweeted_status['entities']['urls']])
+    rt_urls_num = len(retweeted_status['entities']['urls'])
+
+    return (frozenset(rt_hashtags), frozenset(rt_mentions), frozenset(rt_tokens), frozenset(rt_urls), rt_urls_num)
+
 def parse_url(url_entity):
     url_code = None
     if 'long-url' in url_entity and url_entity['long-url'] is not None:
@@ -43,9 +112,73 @@ def parse_url(url_entity):
         url_entity['hashtag'] = url_code[1]
         return url_entity['code']
     
-def process_tweet(line, track_list, expand_url=False):
+# With splice the derived fields are spliced into the raw line (see process_line)
+# instead of encoding the whole tweet again; the output decodes to the same tweet.
+def process_tweet(line, track_list, expand_url=False, rt_cache=None, splice=False):
+
+    if splice:
+        return process_line(line, track_list, expand_url=expand_url, rt_cache=rt_cache)[1]
 
     tweet = simplejson.loads(line)
+    tweet = enrich_tweet(tweet, track_list, expand_url=expand_url, rt_cache=rt_cache)
+
+    return tweet_to_string(tweet)
+
+# The offset of the closing brace of the top level user object in line, found by
+# decoding the objects under "user" keys until one equals user. None if there is
+# no such object or more than one (a retweet of the user's own tweet).
+def find_user_end(line, user):
+    user_end = None
+    for match in USER_KEY.finditer(line):
+        candidate, end = json_decoder.raw_decode(line, match.end() - 1)
+        if candidate == user:
+            if user_end is not None:
+                return None
+            user_end = end - 1
+    return user_end
+
+# Decodes and enriches one raw line. Returns (tweet, processed line). A plain tweet
+# object gets its processed line by splicing the derived fields into the raw JSON:
+# user.created_ts before the user object's closing brace and the top level keys
+# before the last one, so only those few fields are encoded. Anything else (notices,
+# tweets that already have a derived key, expanded urls, a user object that cannot
+# be told apart) is encoded whole with tweet_to_string.
+def process_line(line, track_list, expand_url=False, rt_cache=None, profiler=None):
+
+    if profiler: stage_t = timer()
+    tweet = simplejson.loads(line)
+    if profiler: profiler.add('loads', stage_t)
+
+    body = line.strip()
+    user_end = None
+    if not expand_url and isinstance(tweet, dict) and isinstance(tweet.get('user'), dict) and body.endswith('}') \
+            and 'created_ts' not in tweet['user'] and not any(key in tweet for key in DERIVED_KEYS):
+        if profiler: stage_t = timer()
+        user_end = find_user_end(body, tweet['user'])
+        user_empty = not tweet['user']
+        if profiler: profiler.add('find_user', stage_t)
+
+    tweet = enrich_tweet(tweet, track_list, expand_url=expand_url, rt_cache=rt_cache, profiler=profiler)
+
+    if profiler: stage_t = timer()
+    if user_end is None or 'created_ts' not in tweet:
+        tweet_out_string = tweet_to_string(tweet)
+        if profiler: profiler.add('dumps', stage_t)
+        return tweet, tweet_out_string
+
+    derived = simplejson.dumps(dict((key, tweet[key]) for key in DERIVED_KEYS))
+    user_created = simplejson.dumps({'created_ts': tweet['user']['created_ts']})
+    tweet_out_string = ''.join([body[:user_end], user_created[1:-1] if user_empty else ',' + user_created[1:-1],
+        body[user_end:-1], ',', derived[1:-1], '}\n'])
+    if profiler: profiler.add('splice', stage_t)
+    return tweet, tweet_out_string
+
+# Adds the derived fields (hashtags, mentions, track_kw, counts, text_hash and
+# created_ts) to a decoded tweet. Messages without entities are left untouched.
+# Pass a RetweetCache as rt_cache to reuse the work done for earlier retweets
+# of the same original tweet. profiler is a sampled StageProfiler (or None)
+# that gets the time spent in each step.
+def enrich_tweet(tweet, track_list, expand_url=False, rt_cache=None, profiler=None):
 
     track_set = set(track_list)
     # List of punct to remove from string for track keyword matching
@@ -54,6 +187,8 @@ def process_tweet(line, track_list, expand_url=False):
 
     if "entities" in tweet and "created_at" in tweet and "created_at" in tweet['user']:
 
+        if profiler: stage_t = timer()
+
         tweet['hashtags'] = []
         # hashtag_num = 0
         if "hashtags" in tweet['entities']:         
@@ -78,36 +213,40 @@ def process_tweet(line, track_list, expand_url=False):
                 if "screen_name" in tweet['entities']['user_mentions'][index]:
                     tweet['mentions'].append(tweet['entities']['user_mentions'][index]['screen_name'].lower())
                     
+        if profiler: stage_t = profiler.add('entities', stage_t)
+
         tweet['track_kw'] = {}
         # Check to see if we have a retweet
         if "retweeted_status" in tweet and "entities" in tweet['retweeted_status']:
             # In case of the retweet losing part of text or entities contained in its original tweet
-            rt_hashtags = []
-            rt_mentions = []
-            
-            for index in range(len(tweet['retweeted_status']['entities']['hashtags'])):
-                rt_hashtags.append(tweet['retweeted_status']['entities']['hashtags'][index]['text'].lower())
-            for index in range(len(tweet['retweeted_status']['entities']['user_mentions'])):
-                rt_mentions.append(tweet['retweeted_status']['entities']['user_mentions'][index]['screen_name'].lower())
-                           
-            tweet['hashtags'] = list(set(tweet['hashtags']).union(set(rt_hashtags)))
-            tweet['mentions'] = list(set(tweet['mentions']).union(set(rt_mentions)))
+            original_id = tweet['retweeted_status'].get('id_str')
+            rt_sets = None
+            if rt_cache is not None and original_id is not None:
+                rt_sets = rt_cache.get(original_id)
+            if rt_sets is None:
+                rt_sets = extract_retweet_sets(tweet['retweeted_status'], punct)
+                if rt_cache is not None and original_id is not None:
+                    rt_cache.put(original_id, rt_sets)
+            rt_hashtags, rt_mentions, rt_tokens, rt_urls, rt_urls_num = rt_sets
+
+            tweet['hashtags'] = list(set(tweet['hashtags']).union(rt_hashtags))
+            tweet['mentions'] = list(set(tweet['mentions']).union(rt_mentions))
 
             if urls_num == 0:
-                urls_num = len(tweet['retweeted_status']['entities']['urls'])
+                urls_num = rt_urls_num
             else:
-                urls_num = len(set([url['url'] for url in tweet['entities']['urls']]).union(set([url['url'] for url in tweet['retweeted_status']['entities']['urls']])))
+                urls_num = len(set([url['url'] for url in tweet['entities']['urls']]).union(rt_urls))
             if expand_url:
                 for url in tweet['retweeted_status']['entities']['urls']:
                     tweet['codes'] = tweet['codes'].append(parse_url(url))
                 tweet['codes'] = list(set(tweet['codes']))
+
+            if profiler: stage_t = profiler.add('retweet', stage_t)
             
             # Track rule matches in text
             tweet_text = re.sub('[%s]' % punct, ' ', tweet['text'])
-            rt_text = re.sub('[%s]' % punct, ' ', tweet['retweeted_status']['text'])
             tweet_text = tweet_text.lower().split()
-            rt_text = rt_text.lower().split()
-            union_text = set(rt_text).union(set(tweet_text))
+            union_text = rt_tokens.union(tweet_text)
             tweet['track_kw']['text'] = list(union_text.intersection(track_set))
         else:
             # Track rule matches in text      
@@ -136,7 +275,11 @@ def process_tweet(line, track_list, expand_url=False):
             'coded_urls': len(tweet['codes'])
             };
 
+        if profiler: stage_t = profiler.add('keywords', stage_t)
+
         tweet['text_hash'] = hashlib.md5(tweet['text'].encode("utf-8")).hexdigest()
+
+        if profiler: stage_t = profiler.add('text_hash', stage_t)
         
         # Convert dates 2012-09-22 00:10:46
         # Note that we convert these to a datetime object and then convert back to string
@@ -151,8 +294,14 @@ def process_tweet(line, track_list, expand_url=False):
         t = to_datetime(tweet['user']['created_at'])
         tweet['user']['created_ts'] = t.strftime('%Y-%m-%d %H:%M:%S')
 
+        if profiler: profiler.add('to_datetime', stage_t)
+
         #print tweet['created_ts']
 
+    return tweet
+
+def tweet_to_string(tweet):
+
     tweet_out_string = simplejson.dumps(tweet).encode('utf-8') + '\n'
 
     return tweet_out_string
@@ -0,0 +1,117 @@
+#-------------------------------------------------------------------------------
+# Name:        Work claiming for queue directories.
+# Purpose:     Lets several preprocess.py or mongoBatchInsert.py workers, on one
+#              box or on several sharing the queue volume, drain the same
+#              directory without picking the same file.
+#
+# A worker claims a file by renaming it to <file>.claimed-<worker id>. The
+# rename is atomic, so only one worker wins and the claimed name no longer
+# matches the queue's glob. While it works on the file the worker holds a
+# lease: a heartbeat thread touches the claimed file every lease_seconds / 3.
+# A claimed file whose mtime is older than lease_seconds belongs to a worker
+# that died, and the next worker to look renames it back into the queue.
+#
+# [workers] lease_seconds sets the lease (default 600).
+#-------------------------------------------------------------------------------
+
+import os
+import re
+import glob
+import time
+import socket
+import threading
+
+import platformconfig
+
+CLAIM_MARK = '.claimed-'
+LEASE_SECONDS = 600
+
+
+def worker_id():
+    host = re.sub('[^A-Za-z0-9_]', '_', socket.gethostname().split('.')[0])
+    return '%s-%d' % (host, os.getpid())
+
+def lease_seconds_from_config(Config):
+    return platformconfig.get_int_option(Config, 'workers', 'lease_seconds', LEASE_SECONDS)
+
+def is_claimed(file_name):
+    return CLAIM_MARK in os.path.basename(file_name)
+
+# The queue name of a claimed file; other names are returned unchanged.
+def unclaimed_name(file_name):
+    if not is_claimed(file_name):
+        return file_name
+    return file_name[:file_name.rindex(CLAIM_MARK)]
+
+# Returns the claimed name, or None if another worker got the file first.
+def claim_file(file_name, worker):
+    claimed_name = file_name + CLAIM_MARK + worker
+    try:
+        os.rename(file_name, claimed_name)
+    except OSError:
+        return None
+    # the lease starts now, not when the file was last written
+    os.utime(claimed_name, None)
+    return claimed_name
+
+# Claims the first file of the list nobody else has. Returns the claimed name or None.
+def claim_first(file_list, worker):
+    for file_name in file_list:
+        claimed_name = claim_file(file_name, worker)
+        if claimed_name:
+            return claimed_name
+    return None
+
+# Puts a claimed file back in the queue, e.g. when it has to be retried.
+def release_file(claimed_name):
+    try:
+        os.rename(claimed_name, unclaimed_name(claimed_name))
+        return True
+    except OSError:
+        return False
+
+# Renames claims in directory whose lease has run out back to their queue names.
+# Returns the reclaimed queue names.
+def reclaim_stale(directory, lease_seconds, logger):
+    reclaimed = []
+    now = time.time()
+    for claimed_name in glob.glob(os.path.join(directory, '*' + CLAIM_MARK + '*')):
+        try:
+            age = now - os.path.getmtime(claimed_name)
+        except OSError:
+            continue
+        if age > lease_seconds and release_file(claimed_name):
+            logger.warning('Reclaimed %s, its lease expired %d seconds ago' % (claimed_name, age - lease_seconds))
+            reclaimed.append(unclaimed_name(claimed_name))
+    return reclaimed
+
+
+class Lease(object):
+    """ Keeps a claimed file's lease alive while the with block runs:
+            with workqueue.Lease(claimed_name, lease_seconds, logger):
+                ...
+    """
+    def __init__(self, claimed_name, lease_seconds, logger):
+        self.claimed_name = claimed_name
+        self.interval = max(lease_seconds / 3.0, 1.0)
+        self.logger = logger
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.heartbeat, name='lease-heartbeat')
+        self.thread.daemon = True
+
+    def heartbeat(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                os.utime(self.claimed_name, None)
+            except OSError, e:
+                self.logger.warning('Lost the lease on %s: %s' % (self.claimed_name, e))
+                return
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stopped.set()
+        self.thread.join()
+        return False